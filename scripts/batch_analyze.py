@@ -0,0 +1,382 @@
+#!/usr/bin/python
+#
+# batch_analyze.py collection_dir [--analyses=name,name,...]
+#                  [--output-dir=dir] [--pattern=glob] [--segmented]
+#                  [--processes=N] [--max-tasks=N] [--memory-limit=MB]
+#                  [--cache=dir] [--force] [--watch] [--poll=seconds]
+#                  [--idle=seconds]
+#
+# Runs analyses on every trace in a collection, e.g. the
+# mytrace.N.json files written by the bots of a parade.py run, and
+# writes a consolidated report.
+#
+# The analyses are listed in ANALYSES (default: DEFAULT_ANALYSES); each
+# runs a sltrace_analyze.py command and produces one output file per
+# trace in --output-dir (default collection_dir/analysis).  As with
+# make, outputs which are newer than their trace are up to date and
+# skipped unless --force is given.  Outputs are written to temporary
+# files and renamed when complete, so an interrupted run never leaves an
+# output which looks up to date.
+#
+# Traces are matched by --pattern (default *.json).  With --segmented,
+# files named like trace.N.json are treated as the segments of
+# trace.json (see trace_events.segment_filenames) rather than as
+# separate traces.
+#
+# Each trace is handled by one task in a pool of --processes worker
+# processes (default: the number of CPUs), which runs all of the
+# trace's out of date analyses with the trace loaded once (see
+# object_path.share_traces).  Workers are replaced after --max-tasks
+# tasks (default 1), which returns the memory used for each trace to
+# the system, and --memory-limit caps each worker's address space.
+# --cache sets the trace cache directory (see trace_cache.py) shared by
+# all the workers.
+#
+# --watch processes traces while they are being collected: each trace
+# is queued as soon as it's complete, i.e. its bot has exited and closed
+# the trace, or it hasn't changed for --idle seconds (default 600,
+# e.g. because its bot crashed).  The directory is checked every --poll
+# seconds (default 10) until all traces are complete and processed.
+#
+# Progress, aggregated from all the workers, is reported on stderr.
+#
+# The report, a JSON list of results for each trace and analysis with
+# the summaries from the stats analysis, is written to report.json in
+# the output directory and summarized on stdout.
+
+import os, os.path
+import re
+import sys
+import glob
+import time
+import traceback
+try:
+    import simplejson as json
+except:
+    import json
+from trace_events import segment_filenames
+from util.progress_bar import ProgressBar, WorkerProgress, shared_counter
+
+# name -> (sltrace_analyze command, output suffix, argument builder,
+# whether the output is the command's stdout).  Argument builders take
+# the trace file and output file.
+ANALYSES = {
+    'quake' : ('quake', '.quake.txt', lambda trace, out: [trace, out], False),
+    'archive' : ('quake', '.slma', lambda trace, out: [trace, os.devnull, '--archive=' + out], False),
+    'graph' : ('graph', '.paths.png', lambda trace, out: [trace, '--output=' + out], False),
+    'heatmap' : ('graph', '.heatmap.png', lambda trace, out: [trace, '--heatmap', '--output=' + out], False),
+    'stats' : ('stats', '.stats.json', lambda trace, out: ['--json', trace], True),
+    'kinematics' : ('kinematics', '.kinematics.json', lambda trace, out: ['--json', trace], True),
+    'proximity' : ('proximity', '.proximity.txt', lambda trace, out: [trace], True),
+    }
+DEFAULT_ANALYSES = ('quake', 'graph', 'stats')
+
+REPORT_FILE = 'report.json'
+
+# Progress of this worker process, set by _init_worker
+_progress = None
+
+_SEGMENT_RE = re.compile(r'^(.*)\.(\d+)(\.[^.]*)$')
+
+def find_traces(collection_dir, pattern='*.json', segmented=False):
+    """
+    Returns the sorted list of trace files in collection_dir matching
+    pattern.  If segmented is True, segments are replaced by the name of
+    the trace they belong to.
+    """
+    traces = set()
+    for filename in glob.glob(os.path.join(collection_dir, pattern)):
+        if segmented:
+            match = _SEGMENT_RE.match(filename)
+            if match: filename = match.group(1) + match.group(3)
+        traces.add(filename)
+    return sorted(traces)
+
+def trace_name(trace_file):
+    return os.path.splitext(os.path.basename(trace_file))[0]
+
+def output_filename(output_dir, trace_file, analysis):
+    return os.path.join(output_dir, trace_name(trace_file) + ANALYSES[analysis][1])
+
+def is_up_to_date(output_file, trace_file):
+    """
+    Returns True if output_file exists and is newer than every file
+    making up trace_file.
+    """
+    try:
+        out_mtime = os.stat(output_file).st_mtime
+    except OSError:
+        return False
+    for segment in segment_filenames(trace_file):
+        try:
+            if os.stat(segment).st_mtime > out_mtime: return False
+        except OSError:
+            return False
+    return True
+
+def is_complete(trace_file, idle):
+    """
+    Returns True if the bot writing trace_file is finished with it: the
+    trace (or its last segment) has been closed, or hasn't changed for
+    idle seconds.
+    """
+    last = segment_filenames(trace_file)[-1]
+    try:
+        st = os.stat(last)
+    except OSError:
+        return False
+    if time.time() - st.st_mtime >= idle: return True
+    fp = open(last, 'rb')
+    try:
+        fp.seek(max(st.st_size - 16, 0))
+        return fp.read().rstrip().endswith(']')
+    finally:
+        fp.close()
+
+def _temp_output(output_file):
+    # Keep the extension, which e.g. selects the graph format
+    dirname, basename = os.path.split(output_file)
+    return os.path.join(dirname, '.tmp.%d.%s' % (os.getpid(), basename))
+
+def _run_analysis(trace_file, analysis, output_file):
+    import sltrace_analyze
+    command, suffix, build_args, to_stdout = ANALYSES[analysis]
+    tmp_output = _temp_output(output_file)
+    saved_stdout = sys.stdout
+    if to_stdout: sys.stdout = open(tmp_output, 'w')
+    else: sys.stdout = open(os.devnull, 'w')
+    try:
+        status = sltrace_analyze.run_command(command, build_args(trace_file, tmp_output))
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved_stdout
+    if status == 0 and os.path.exists(tmp_output):
+        os.rename(tmp_output, output_file)
+    elif os.path.exists(tmp_output):
+        os.unlink(tmp_output)
+    return status
+
+def process_trace(task):
+    """
+    Runs the analyses for one trace, in a worker process.  task is
+    (trace_file, [(analysis, output_file), ...]).  Returns a list of
+    result dicts.
+    """
+    import object_path
+    trace_file, outputs = task
+    object_path.share_traces()
+    results = []
+    try:
+        for analysis,output_file in outputs:
+            result = { 'trace' : trace_file, 'analysis' : analysis, 'output' : output_file }
+            start = time.time()
+            try:
+                status = _run_analysis(trace_file, analysis, output_file)
+                if status == 0: result['status'] = 'ok'
+                else:
+                    result['status'] = 'failed'
+                    result['error'] = 'exit status %d' % status
+            except Exception:
+                result['status'] = 'failed'
+                result['error'] = traceback.format_exc()
+            result['seconds'] = time.time() - start
+            results.append(result)
+            if _progress is not None: _progress.add()
+    finally:
+        object_path.share_traces(False)
+    return results
+
+def _init_worker(memory_limit, counter):
+    global _progress
+    # Analyses take long enough that every one can be reported
+    _progress = WorkerProgress(counter, flush_interval=0.0)
+    if memory_limit:
+        import resource
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+class BatchRunner:
+    """
+    BatchRunner schedules the analyses of traces on a process pool and
+    collects their results.
+    """
+
+    def __init__(self, output_dir, analyses=DEFAULT_ANALYSES, processes=None,
+                 max_tasks=1, memory_limit=None, force=False):
+        import multiprocessing
+        self.output_dir = output_dir
+        self.analyses = analyses
+        self.force = force
+        self.results = []
+        self._pending = []
+        self.progress = ProgressBar(0, fp=sys.stderr, label='batch', counter=shared_counter())
+        self._pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                          initargs=(memory_limit, self.progress.counter),
+                                          maxtasksperchild=max_tasks)
+        if not os.path.isdir(output_dir): os.makedirs(output_dir)
+
+    def submit(self, trace_file):
+        """Queues the out of date analyses of trace_file."""
+        outputs = []
+        for analysis in self.analyses:
+            output_file = output_filename(self.output_dir, trace_file, analysis)
+            if not self.force and is_up_to_date(output_file, trace_file):
+                self.results.append({ 'trace' : trace_file, 'analysis' : analysis,
+                                      'output' : output_file, 'status' : 'skipped' })
+                continue
+            outputs.append( (analysis, output_file) )
+        if outputs:
+            self.progress.duration += len(outputs)
+            self._pending.append(self._pool.apply_async(process_trace, [(trace_file, outputs)]))
+
+    def collect(self, wait=False):
+        """
+        Collects the results of finished tasks, or all tasks if wait, and
+        reports progress.  Returns the number of tasks still running.
+        """
+        self.progress.poll()
+        still_pending = []
+        for async_result in self._pending:
+            if wait or async_result.ready():
+                self.results.extend(async_result.get())
+            else:
+                still_pending.append(async_result)
+        self._pending = still_pending
+        return len(self._pending)
+
+    def close(self):
+        self.collect(wait=True)
+        self._pool.close()
+        self._pool.join()
+        if self.progress.duration:
+            self.progress.finish(mark_complete=False)
+
+    def report(self):
+        """
+        Returns the consolidated report: the results, and the summaries
+        written by the stats analysis.
+        """
+        stats = []
+        for result in self.results:
+            if result['analysis'] != 'stats' or result['status'] == 'failed': continue
+            try:
+                for line in open(result['output']):
+                    stats.append(json.loads(line))
+            except (IOError, ValueError):
+                pass
+        results = sorted(self.results, key=lambda res: (res['trace'], res['analysis']))
+        return { 'results' : results, 'stats' : stats }
+
+def run_batch(collection_dir, output_dir=None, analyses=DEFAULT_ANALYSES, pattern='*.json',
+              segmented=False, processes=None, max_tasks=1, memory_limit=None,
+              force=False, watch=False, poll=10.0, idle=600.0):
+    """Runs the batch (see above), returning the report."""
+    if output_dir is None: output_dir = os.path.join(collection_dir, 'analysis')
+    runner = BatchRunner(output_dir, analyses, processes=processes, max_tasks=max_tasks,
+                         memory_limit=memory_limit, force=force)
+    try:
+        submitted = set()
+        while True:
+            incomplete = 0
+            for trace_file in find_traces(collection_dir, pattern, segmented):
+                if trace_file in submitted: continue
+                if watch and not is_complete(trace_file, idle):
+                    incomplete += 1
+                    continue
+                submitted.add(trace_file)
+                runner.submit(trace_file)
+            # Report progress while waiting for the tasks to finish
+            next_poll = time.time() + poll
+            while True:
+                pending = runner.collect()
+                if not pending or time.time() >= next_poll: break
+                time.sleep(min(0.2, poll))
+            if not watch or (incomplete == 0 and pending == 0 and submitted): break
+            time.sleep(max(next_poll - time.time(), 0))
+    finally:
+        runner.close()
+
+    report = runner.report()
+    fp = open(os.path.join(output_dir, REPORT_FILE), 'w')
+    json.dump(report, fp, indent=2)
+    fp.close()
+    return report
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    options = {
+        'analyses' : DEFAULT_ANALYSES,
+        'output_dir' : None,
+        'pattern' : '*.json',
+        'segmented' : False,
+        'processes' : None,
+        'max_tasks' : 1,
+        'memory_limit' : None,
+        'force' : False,
+        'watch' : False,
+        'poll' : 10.0,
+        'idle' : 600.0,
+        }
+    cache_dir = None
+    args = []
+    for arg in argv:
+        if arg.startswith('--analyses='):
+            options['analyses'] = arg.split('=', 1)[1].split(',')
+        elif arg.startswith('--output-dir='):
+            options['output_dir'] = arg.split('=', 1)[1]
+        elif arg.startswith('--pattern='):
+            options['pattern'] = arg.split('=', 1)[1]
+        elif arg == '--segmented':
+            options['segmented'] = True
+        elif arg.startswith('--processes='):
+            options['processes'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--max-tasks='):
+            options['max_tasks'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--memory-limit='):
+            options['memory_limit'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--cache='):
+            cache_dir = arg.split('=', 1)[1]
+        elif arg == '--force':
+            options['force'] = True
+        elif arg == '--watch':
+            options['watch'] = True
+        elif arg.startswith('--poll='):
+            options['poll'] = float(arg.split('=', 1)[1])
+        elif arg.startswith('--idle='):
+            options['idle'] = float(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
+
+    if len(args) < 1:
+        print "Usage: batch_analyze.py collection_dir [--analyses=%s] [--output-dir=dir] [--watch] ..." % \
+            ','.join(DEFAULT_ANALYSES)
+        print "Analyses:", ', '.join(sorted(ANALYSES.keys()))
+        return -1
+    for analysis in options['analyses']:
+        if analysis not in ANALYSES:
+            print "Unknown analysis:", analysis
+            return -1
+
+    # Workers open their caches with trace_cache.open_cache(), which
+    # falls back to the environment
+    if cache_dir: os.environ['SLTRACE_CACHE_DIR'] = cache_dir
+
+    report = run_batch(args[0], **options)
+
+    counts = {}
+    for result in report['results']:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if result['status'] == 'failed':
+            print "FAILED %s %s: %s" % (result['trace'], result['analysis'],
+                                        result['error'].strip().splitlines()[-1])
+    print "Analyses: %d ok, %d skipped, %d failed" % (counts.get('ok', 0), counts.get('skipped', 0),
+                                                      counts.get('failed', 0))
+    for summ in report['stats']:
+        print "%s: %d objects, %d avatars, %s" % (summ['trace_file'], summ['objects'], summ['avatars'],
+                                                 summ['duration'] is not None and ('%.1fs' % summ['duration']) or 'no duration')
+
+    if counts.get('failed', 0): return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
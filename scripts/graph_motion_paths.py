@@ -1,53 +1,192 @@
 #!/usr/bin/python
 
-# quake_motion_path.py input_trace_file [output_dir]
+# graph_motion_paths.py input_trace_file|motion_archive [--output=file.png|file.svg]
+#                       [--heatmap] [--size=pixels] [--dpi=dpi] [--cache=dir]
+#                       [--lod] [--time=start,end] [--extent=xmin,ymin,xmax,ymax]
+#                       [--tile=x,y]
 #
-# Generates motion path files in the same format as the Quake motion
-# path files used in CBR. Each motion path is stored in a file named
-# by the object UUID, stored in the specified output directory, or the
-# current working directory if one isn't specified.
+# Graphs the motion paths of all objects in a trace over the 256x256
+# sim.  By default the graph is shown interactively; with --output it
+# is rendered without a display and saved to the specified file, in
+# the format given by its extension.
+#
+# All paths are drawn as a single line collection and their points
+# are decimated to the output resolution (--size, the width/height of
+# the graph in pixels, default 800), so even traces with thousands of
+# objects render quickly.
+#
+# --heatmap draws a rasterized occupancy map instead of paths: the
+# amount of time objects spent in each square meter of the sim,
+# computed by resampling every path once a second.
+#
+# The input may also be a motion archive written by
+# quake_motion_path.py --archive, which loads much faster than the
+# original trace.
+#
+# --cache caches the paths extracted from the trace in the given
+# directory (default $SLTRACE_CACHE_DIR, see trace_cache.py).
+#
+# --time and --extent graph only the given time span (in seconds) and
+# area, and --tile the given tile of a grid of 64m squares.  --lod draws
+# paths from a motion pyramid (see motion_pyramid.py) at the coarsest
+# level of detail which is still accurate to a pixel, which with a
+# cache makes redrawing large traces at different zoom levels fast.
 
 import sys
-from motion_path import MotionPath
-from object_path import ObjectPathTrace
-
-import matplotlib.path as mpath
-import matplotlib.pyplot as plt
+from motion_path import MotionPath, resample_paths
+from object_path import load_trace
+from trace_cache import open_cache
+from motion_archive import MotionArchive, is_motion_archive
+from motion_pyramid import MotionPyramid, build_levels, DEFAULT_TOLERANCES, DEFAULT_TILE_SIZE
 import util.colors as colors
 
-def main():
-    if len(sys.argv) < 2:
-        print "Specify a file."
-        return -1
-
-    trace_file = sys.argv[1]
+SIM_SIZE = 256
 
-    trace = ObjectPathTrace(sys.argv[1])
-    trace.fill_parents(report=True)
+def _decimate(coords, cell_size):
+    """
+    Drops points from an (N,2) array of coordinates which fall in the
+    same cell_size square as the point before them, since they would
+    be drawn on the same pixel anyway.  The last point is always kept.
+    """
+    import numpy
+    cells = numpy.floor(coords / cell_size)
+    keep = numpy.ones(len(coords), dtype=bool)
+    keep[1:] = numpy.any(cells[1:] != cells[:-1], axis=1)
+    keep[-1] = True
+    return coords[keep]
 
-    motions = trace.sim_motions(trace.roots())
-
-    Path = mpath.Path
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    for objid,mots in motions.items():
+def _path_segments(motions_iter, cell_size):
+    """
+    Returns a list of decimated (N,2) coordinate arrays and a list of
+    colors, one per motion path, each object getting its own color.
+    """
+    import numpy
+    segments = []
+    segment_colors = []
+    for objid,mots in motions_iter:
         col = colors.get_random_color()
-
         for mot in mots:
             mot.squeeze(fudge=0.05)
             if len(mot) <= 1: continue
+            coords = numpy.asarray(mot.points(), dtype=float)[:,0:2]
+            segments.append( _decimate(coords, cell_size) )
+            segment_colors.append(col)
+    return segments, segment_colors
 
-            first_t, first_pos = mot[0]
-            coord_seq = [ (pos[0],pos[1]) for t,pos in mot ]
-            x,y = zip(*coord_seq)
-            line, = ax.plot(x, y, color=col, marker='.')
+def _draw_paths(ax, motions_iter, cell_size):
+    from matplotlib.collections import LineCollection
+    import numpy
 
-    ax.grid()
-    ax.set_xlim(0,256)
-    ax.set_ylim(0,256)
+    segments, segment_colors = _path_segments(motions_iter, cell_size)
+    ax.add_collection( LineCollection(segments, colors=segment_colors) )
+    if segments:
+        points = numpy.concatenate(segments)
+        point_colors = [col for seg,col in zip(segments, segment_colors) for pt in seg]
+        ax.scatter(points[:,0], points[:,1], c=point_colors, marker='.', s=4, linewidths=0)
     ax.set_title('object paths')
-    plt.show()
+
+def _draw_heatmap(ax, motions_iter, interval=1.0):
+    import numpy
+    from matplotlib.colors import LogNorm
+
+    occupancy = numpy.zeros((SIM_SIZE, SIM_SIZE))
+    edges = numpy.arange(SIM_SIZE+1)
+    for objid,mots in motions_iter:
+        for mot in resample_paths(mots, interval):
+            if mot is None: continue
+            coords = numpy.asarray(mot.points(), dtype=float)
+            counts, xedges, yedges = numpy.histogram2d(coords[:,0], coords[:,1], bins=(edges, edges))
+            occupancy += counts * interval
+
+    # histogram2d indexes by [x,y], imshow by [row,col]
+    image = numpy.ma.masked_equal(occupancy.T, 0)
+    img = ax.imshow(image, origin='lower', extent=(0, SIM_SIZE, 0, SIM_SIZE),
+                    interpolation='nearest', norm=LogNorm())
+    ax.figure.colorbar(img, ax=ax, label='seconds occupied')
+    ax.set_title('object occupancy')
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    output_file = None
+    heatmap = False
+    size = 800
+    dpi = 100
+    cache_dir = None
+    lod = False
+    time_range = None
+    extent = None
+    args = []
+    for arg in argv:
+        if arg.startswith('--output='):
+            output_file = arg.split('=', 1)[1]
+        elif arg == '--heatmap':
+            heatmap = True
+        elif arg.startswith('--size='):
+            size = int(arg.split('=', 1)[1])
+        elif arg.startswith('--dpi='):
+            dpi = int(arg.split('=', 1)[1])
+        elif arg.startswith('--cache='):
+            cache_dir = arg.split('=', 1)[1]
+        elif arg == '--lod':
+            lod = True
+        elif arg.startswith('--time='):
+            time_range = tuple([float(val) for val in arg.split('=', 1)[1].split(',')])
+        elif arg.startswith('--extent='):
+            extent = tuple([float(val) for val in arg.split('=', 1)[1].split(',')])
+        elif arg.startswith('--tile='):
+            x, y = [int(val) for val in arg.split('=', 1)[1].split(',')]
+            extent = (x * DEFAULT_TILE_SIZE, y * DEFAULT_TILE_SIZE,
+                      (x+1) * DEFAULT_TILE_SIZE, (y+1) * DEFAULT_TILE_SIZE)
+        else:
+            args.append(arg)
+
+    if len(args) < 1:
+        print "Specify a file."
+        return -1
+
+    # The backend must be selected before pyplot is imported, so
+    # matplotlib is only imported once we know whether a display is
+    # needed.
+    import matplotlib
+    if output_file: matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    view = extent or (0, 0, SIM_SIZE, SIM_SIZE)
+    use_pyramid = lod or time_range is not None or extent is not None
+    if is_motion_archive(args[0]):
+        motions_iter = iter(MotionArchive(args[0]))
+        if use_pyramid:
+            pyramid = MotionPyramid(DEFAULT_TOLERANCES, levels=build_levels(dict(motions_iter)))
+    else:
+        trace = load_trace(args[0], event_types=['add', 'kill', 'loc'],
+                           cache=open_cache(cache_dir))
+        trace.fill_parents(report=True)
+        if use_pyramid:
+            pyramid = trace.motion_pyramid(trace.roots())
+        else:
+            motions_iter = trace.sim_motions_iter(trace.roots())
+    if use_pyramid:
+        resolution = None
+        if lod: resolution = float(view[2] - view[0]) / size
+        motions_iter = pyramid.query(time_range=time_range, bbox=extent,
+                                     resolution=resolution).iteritems()
+
+    fig = plt.figure(figsize=(size/float(dpi), size/float(dpi)), dpi=dpi)
+    ax = fig.add_subplot(111)
+
+    if heatmap:
+        _draw_heatmap(ax, motions_iter)
+    else:
+        _draw_paths(ax, motions_iter, float(view[2] - view[0]) / size)
+        ax.grid()
+
+    ax.set_xlim(view[0],view[2])
+    ax.set_ylim(view[1],view[3])
+
+    if output_file:
+        fig.savefig(output_file, dpi=dpi)
+    else:
+        plt.show()
 
     return 0
 
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# interval_tree -- a static centered interval tree for answering "which
+# intervals contain time t" and "which intervals overlap [t0,t1]"
+# queries, plus logarithmic time counts of the same.
+
+import bisect
+
+class _Node:
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+class IntervalTree:
+    """
+    IntervalTree stores a fixed set of closed intervals (start, end,
+    value) and supports fast stabbing and overlap queries. Queries
+    return the values of matching intervals in no particular order.
+    The tree is built once up front and can't be modified.
+    """
+
+    def __init__(self, intervals):
+        """
+        Build a tree from a list of (start, end, value) tuples, where
+        start <= end.
+        """
+        self._intervals = list(intervals)
+        self._starts = sorted([iv[0] for iv in self._intervals])
+        self._ends = sorted([iv[1] for iv in self._intervals])
+        self._root = self._build(self._intervals)
+
+    def _build(self, intervals):
+        if not intervals: return None
+
+        node = _Node()
+        endpoints = sorted([iv[0] for iv in intervals] + [iv[1] for iv in intervals])
+        node.center = endpoints[len(endpoints)/2]
+
+        left, right, center = [], [], []
+        for iv in intervals:
+            if iv[1] < node.center: left.append(iv)
+            elif iv[0] > node.center: right.append(iv)
+            else: center.append(iv)
+
+        node.by_start = sorted(center, key=lambda iv: iv[0])
+        node.by_end = sorted(center, key=lambda iv: iv[1], reverse=True)
+        node.left = self._build(left)
+        node.right = self._build(right)
+        return node
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def intervals(self):
+        return self._intervals
+
+    def at(self, t):
+        """Returns the values of all intervals containing t."""
+        results = []
+        node = self._root
+        while node is not None:
+            if t < node.center:
+                for iv in node.by_start:
+                    if iv[0] > t: break
+                    results.append(iv[2])
+                node = node.left
+            elif t > node.center:
+                for iv in node.by_end:
+                    if iv[1] < t: break
+                    results.append(iv[2])
+                node = node.right
+            else:
+                results.extend([iv[2] for iv in node.by_start])
+                break
+        return results
+
+    def overlapping(self, t0, t1):
+        """Returns the values of all intervals overlapping [t0, t1]."""
+        results = []
+        to_visit = [self._root]
+        while to_visit:
+            node = to_visit.pop()
+            if node is None: continue
+            if t1 < node.center:
+                # Only intervals starting by t1 can overlap
+                for iv in node.by_start:
+                    if iv[0] > t1: break
+                    results.append(iv[2])
+                to_visit.append(node.left)
+            elif t0 > node.center:
+                # Only intervals ending at or after t0 can overlap
+                for iv in node.by_end:
+                    if iv[1] < t0: break
+                    results.append(iv[2])
+                to_visit.append(node.right)
+            else:
+                # The query contains the center, so all of these overlap
+                results.extend([iv[2] for iv in node.by_start])
+                to_visit.append(node.left)
+                to_visit.append(node.right)
+        return results
+
+    def count_at(self, t):
+        """Returns the number of intervals containing t."""
+        return (bisect.bisect_right(self._starts, t) -
+                bisect.bisect_left(self._ends, t))
+
+    def count_overlapping(self, t0, t1):
+        """Returns the number of intervals overlapping [t0, t1]."""
+        return (bisect.bisect_right(self._starts, t1) -
+                bisect.bisect_left(self._ends, t0))
+
+    def counts(self, times):
+        """
+        Returns the number of intervals containing each of the given
+        times, e.g. for computing interest set size over time.
+        """
+        return [self.count_at(t) for t in times]
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+#
+# kinematics.py [--json] [--per-object] [--bins=N] trace_file [trace_file ...]
+#
+# Computes kinematic statistics for every object in a trace at once:
+# speed, acceleration, update interval and path length, both derived
+# from consecutive positions and from the velocities and angular
+# velocities recorded with each update.  Reports percentiles and
+# histograms of each quantity over the whole trace and per sim, and
+# optionally a summary per object.
+#
+# The loc events are loaded into columns (see LocColumns) and all the
+# quantities are computed with numpy array operations in one pass over
+# them, rather than by walking MotionPaths point by point.
+#
+# Positions are used as recorded, so for child objects they are
+# relative to their parent, as in ObjectPathTrace.motion().
+#
+# --json prints the summary as JSON instead of a report.  --per-object
+# includes the per object summaries.  --bins sets the number of
+# histogram bins (default DEFAULT_BINS).
+
+import sys
+try:
+    import simplejson as json
+except:
+    import json
+from object_path import parse_time, parse_vec3
+from trace_events import iter_trace_events
+
+DEFAULT_BINS = 20
+
+_NAN_VEC3 = (float('nan'), float('nan'), float('nan'))
+
+class LocColumns:
+    """
+    LocColumns holds position updates as parallel numpy arrays: obj
+    (index into objids), sim (index into sims), time (seconds), and
+    pos, vel and angvel (n x 3).  Missing velocities are NaN.
+    """
+
+    def __init__(self, objids, sims, obj, sim, time, pos, vel, angvel):
+        import numpy
+        self.objids = objids
+        self.sims = sims
+        self.obj = numpy.asarray(obj, dtype=numpy.intp)
+        self.sim = numpy.asarray(sim, dtype=numpy.intp)
+        self.time = numpy.asarray(time, dtype=float)
+        self.pos = numpy.asarray(pos, dtype=float).reshape(-1, 3)
+        self.vel = numpy.asarray(vel, dtype=float).reshape(-1, 3)
+        self.angvel = numpy.asarray(angvel, dtype=float).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.time)
+
+class _Indexer:
+    """Assigns consecutive indices to values as they're seen."""
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def __call__(self, value):
+        idx = self._index.get(value)
+        if idx is None:
+            idx = len(self.values)
+            self._index[value] = idx
+            self.values.append(value)
+        return idx
+
+def _vec3_or_nan(evt, field):
+    if field not in evt: return _NAN_VEC3
+    return parse_vec3(evt[field])
+
+def load_loc_columns(trace_file):
+    """
+    Streams the loc events in trace_file into a LocColumns.  Updates
+    are attributed to the sim in their 'source' field (see
+    merge_traces.py), or otherwise the sim the trace started in.
+    """
+    objids = _Indexer()
+    sims = _Indexer()
+    obj, sim, time, pos, vel, angvel = [], [], [], [], [], []
+    trace_sim = None
+    for evt in iter_trace_events(trace_file, event_types=['started', 'loc'],
+                                 fields=['id', 'time', 'pos', 'vel', 'angvel', 'sim', 'source']):
+        if evt['event'] == 'started':
+            if trace_sim is None: trace_sim = evt.get('sim')
+            continue
+        obj.append(objids(evt['id']))
+        sim.append(sims(evt.get('source', trace_sim)))
+        time.append(parse_time(evt['time']))
+        pos.append(parse_vec3(evt['pos']))
+        vel.append(_vec3_or_nan(evt, 'vel'))
+        angvel.append(_vec3_or_nan(evt, 'angvel'))
+    return LocColumns(objids.values, sims.values, obj, sim, time, pos, vel, angvel)
+
+def motion_columns(motions, sim=None):
+    """
+    Builds a LocColumns from motions, a dict of object id -> MotionPath
+    or list of MotionPaths, using the MotionPaths' velocities if they
+    carry them.
+    """
+    objids = []
+    obj, time, pos, vel = [], [], [], []
+    for objid,paths in motions.items():
+        if not isinstance(paths, (list, tuple)): paths = [paths]
+        idx = len(objids)
+        objids.append(objid)
+        for path in paths:
+            obj.extend([idx] * len(path))
+            time.extend(path.timestamps())
+            pos.extend(path.points())
+            vels = path.velocities()
+            if vels is None: vels = [_NAN_VEC3] * len(path)
+            vel.extend(vels)
+    return LocColumns(objids, [sim], obj, [0] * len(obj), time, pos, vel,
+                      [_NAN_VEC3] * len(obj))
+
+def _norms(vecs):
+    import numpy
+    return numpy.sqrt((vecs * vecs).sum(axis=1))
+
+def _percentiles(values, pcts):
+    """Nearest-rank percentiles, as in trace_stats.percentiles."""
+    import numpy
+    if len(values) == 0: return [None for p in pcts]
+    values = numpy.sort(values)
+    return [float(values[int(round((p / 100.0) * (len(values)-1)))]) for p in pcts]
+
+class Kinematics:
+    """
+    Kinematics computes kinematic quantities for all the updates in a
+    LocColumns at once.  Each quantity is a sample per update (recorded
+    speed, angular speed), per pair of consecutive updates of an object
+    (speed, update interval, path step, recorded acceleration) or per
+    three consecutive updates (acceleration).
+    """
+
+    PERCENTILES = (50, 90, 99, 100)
+    QUANTITIES = ('speed', 'acceleration', 'update_interval', 'path_step',
+                  'recorded_speed', 'recorded_acceleration', 'angular_speed')
+
+    def __init__(self, columns, bins=DEFAULT_BINS):
+        import numpy
+        self.columns = columns
+        self.bins = bins
+
+        # Group updates by object, in time order
+        order = numpy.lexsort((columns.time, columns.obj))
+        obj = columns.obj[order]
+        sim = columns.sim[order]
+        time = columns.time[order]
+        pos = columns.pos[order]
+        vel = columns.vel[order]
+
+        # Consecutive updates of the same object, with a time between them
+        dt = numpy.diff(time)
+        pairs = (obj[1:] == obj[:-1])
+        step = _norms(numpy.diff(pos, axis=0))
+        moving = pairs & (dt > 0)
+        safe_dt = numpy.where(moving, dt, 1.0)
+        step_vel = numpy.diff(pos, axis=0) / safe_dt[:,None]
+        recorded_acc = _norms(numpy.diff(vel, axis=0)) / safe_dt
+
+        # Derived accelerations between consecutive steps, over the time
+        # between their midpoints
+        acc_pairs = moving[1:] & moving[:-1]
+        mid_dt = (dt[1:] + dt[:-1]) / 2.0
+        acc = _norms(numpy.diff(step_vel, axis=0)) / numpy.where(acc_pairs, mid_dt, 1.0)
+
+        recorded_speed = _norms(vel)
+        angular_speed = _norms(columns.angvel[order])
+
+        self._obj = {
+            'speed' : obj[1:][moving],
+            'acceleration' : obj[2:][acc_pairs],
+            'update_interval' : obj[1:][pairs],
+            'path_step' : obj[1:][pairs],
+            'recorded_speed' : obj,
+            'recorded_acceleration' : obj[1:][moving],
+            'angular_speed' : obj,
+            }
+        self._sim = {
+            'speed' : sim[1:][moving],
+            'acceleration' : sim[2:][acc_pairs],
+            'update_interval' : sim[1:][pairs],
+            'path_step' : sim[1:][pairs],
+            'recorded_speed' : sim,
+            'recorded_acceleration' : sim[1:][moving],
+            'angular_speed' : sim,
+            }
+        self._values = {
+            'speed' : _norms(step_vel)[moving],
+            'acceleration' : acc[acc_pairs],
+            'update_interval' : dt[pairs],
+            'path_step' : step[pairs],
+            'recorded_speed' : recorded_speed,
+            'recorded_acceleration' : recorded_acc[moving],
+            'angular_speed' : angular_speed,
+            }
+        # Drop samples missing recorded data
+        for name in self.QUANTITIES:
+            valid = numpy.isfinite(self._values[name])
+            if valid.all(): continue
+            self._values[name] = self._values[name][valid]
+            self._obj[name] = self._obj[name][valid]
+            self._sim[name] = self._sim[name][valid]
+
+        self._updates = numpy.bincount(obj, minlength=len(columns.objids))
+        nobjs = len(columns.objids)
+        self._first = numpy.full(nobjs, numpy.nan)
+        self._last = numpy.full(nobjs, numpy.nan)
+        if len(obj):
+            starts = numpy.concatenate([[True], ~pairs])
+            ends = numpy.concatenate([~pairs, [True]])
+            self._first[obj[starts]] = time[starts]
+            self._last[obj[ends]] = time[ends]
+
+    def values(self, name, sim=None):
+        """Returns the samples of a quantity, optionally for one sim."""
+        values = self._values[name]
+        if sim is None: return values
+        return values[self._sim[name] == self.columns.sims.index(sim)]
+
+    def distribution(self, name, sim=None):
+        """
+        Returns a dict with the count, mean, percentiles and histogram
+        (bin edges and counts) of a quantity.
+        """
+        import numpy
+        values = self.values(name, sim)
+        result = {
+            'count' : int(len(values)),
+            'mean' : None,
+            'percentiles' : dict(zip(self.PERCENTILES, _percentiles(values, self.PERCENTILES))),
+            'histogram' : None,
+            }
+        if len(values):
+            counts, edges = numpy.histogram(values, bins=self.bins)
+            result['mean'] = float(values.mean())
+            result['histogram'] = { 'edges' : [float(e) for e in edges],
+                                    'counts' : [int(c) for c in counts] }
+        return result
+
+    def _per_object_sum(self, name):
+        import numpy
+        return numpy.bincount(self._obj[name], weights=self._values[name],
+                              minlength=len(self.columns.objids))
+
+    def _per_object_count(self, name):
+        import numpy
+        return numpy.bincount(self._obj[name], minlength=len(self.columns.objids))
+
+    def _per_object_max(self, name):
+        import numpy
+        result = numpy.full(len(self.columns.objids), numpy.nan)
+        if len(self._values[name]):
+            numpy.fmax.at(result, self._obj[name], self._values[name])
+        return result
+
+    def per_object(self):
+        """Returns a dict of object id -> summary dict."""
+        import numpy
+        def mean(name):
+            counts = self._per_object_count(name)
+            return self._per_object_sum(name) / numpy.maximum(counts, 1), counts
+
+        path_length = self._per_object_sum('path_step')
+        duration = self._last - self._first
+        mean_interval, nintervals = mean('update_interval')
+        mean_recorded, nrecorded = mean('recorded_speed')
+        mean_angular, nangular = mean('angular_speed')
+        max_speed = self._per_object_max('speed')
+        max_recorded = self._per_object_max('recorded_speed')
+        max_acc = self._per_object_max('acceleration')
+
+        def value(arr, idx, valid=True):
+            if not valid or not numpy.isfinite(arr[idx]): return None
+            return float(arr[idx])
+
+        results = {}
+        for idx,objid in enumerate(self.columns.objids):
+            results[str(objid)] = {
+                'updates' : int(self._updates[idx]),
+                'duration' : value(duration, idx),
+                'path_length' : float(path_length[idx]),
+                'mean_speed' : value(path_length / numpy.where(duration > 0, duration, numpy.nan), idx),
+                'max_speed' : value(max_speed, idx),
+                'max_acceleration' : value(max_acc, idx),
+                'mean_update_interval' : value(mean_interval, idx, nintervals[idx] > 0),
+                'mean_recorded_speed' : value(mean_recorded, idx, nrecorded[idx] > 0),
+                'max_recorded_speed' : value(max_recorded, idx),
+                'mean_angular_speed' : value(mean_angular, idx, nangular[idx] > 0),
+                }
+        return results
+
+    def summary(self, per_object=False):
+        """
+        Returns a dict with the distribution of each quantity over the
+        whole trace and per sim, the distribution of path lengths, and
+        optionally the per object summaries.
+        """
+        import numpy
+        path_lengths = self._per_object_sum('path_step')[self._updates > 0]
+        summ = {
+            'updates' : len(self.columns),
+            'objects' : int((self._updates > 0).sum()),
+            'distributions' : dict([(name, self.distribution(name)) for name in self.QUANTITIES]),
+            'path_length' : {
+                'total' : float(path_lengths.sum()),
+                'percentiles' : dict(zip(self.PERCENTILES, _percentiles(path_lengths, self.PERCENTILES))),
+                },
+            'sims' : {},
+            }
+        if len(self.columns.sims) > 1:
+            for sim in self.columns.sims:
+                summ['sims'][str(sim)] = dict([(name, self.distribution(name, sim))
+                                               for name in self.QUANTITIES])
+        if per_object:
+            summ['per_object'] = self.per_object()
+        return summ
+
+    def report(self, fp=None, per_object=False):
+        """Prints a human readable version of summary() to fp."""
+        if not fp: fp = sys.stdout
+        summ = self.summary(per_object)
+
+        def row(label, dist):
+            pcts = '/'.join([_format(dist['percentiles'][p]) for p in self.PERCENTILES])
+            print >>fp, "  %-24s %8d %12s  %s" % (label, dist['count'], _format(dist['mean']), pcts)
+
+        print >>fp, "Updates:", summ['updates']
+        print >>fp, "Objects:", summ['objects']
+        print >>fp, "Total path length: %.3f" % summ['path_length']['total']
+        print >>fp, "Path length per object (p50/p90/p99/max):", \
+            '/'.join([_format(summ['path_length']['percentiles'][p]) for p in self.PERCENTILES])
+        print >>fp
+        print >>fp, "  %-24s %8s %12s  %s" % ('Quantity', 'Samples', 'Mean', 'p50/p90/p99/max')
+        for name in self.QUANTITIES:
+            row(name, summ['distributions'][name])
+        for sim,dists in sorted(summ['sims'].items()):
+            print >>fp
+            print >>fp, "Sim:", sim
+            for name in self.QUANTITIES:
+                row(name, dists[name])
+
+        for name in self.QUANTITIES:
+            hist = summ['distributions'][name]['histogram']
+            if hist is None: continue
+            print >>fp
+            print >>fp, "Histogram of %s:" % name
+            edges, counts = hist['edges'], hist['counts']
+            for idx in range(len(counts)):
+                print >>fp, "  [%10s, %10s) %d" % (_format(edges[idx]), _format(edges[idx+1]), counts[idx])
+
+        if per_object:
+            print >>fp
+            print >>fp, "%-36s %8s %10s %10s %10s %10s" % ('Object', 'Updates', 'Path', 'Mean spd', 'Max spd', 'Mean dt')
+            for objid,info in sorted(summ['per_object'].items()):
+                print >>fp, "%-36s %8d %10s %10s %10s %10s" % (
+                    objid, info['updates'], _format(info['path_length']), _format(info['mean_speed']),
+                    _format(info['max_speed']), _format(info['mean_update_interval']))
+
+def _format(val):
+    if val is None: return 'n/a'
+    return '%.4g' % val
+
+def main(args=None):
+    if args is None: args = sys.argv[1:]
+
+    as_json = False
+    per_object = False
+    bins = DEFAULT_BINS
+    trace_files = []
+    for arg in args:
+        if arg == '--json':
+            as_json = True
+        elif arg == '--per-object':
+            per_object = True
+        elif arg.startswith('--bins='):
+            bins = int(arg.split('=', 1)[1])
+        else:
+            trace_files.append(arg)
+
+    if not trace_files:
+        print "Usage: kinematics.py [--json] [--per-object] [--bins=N] trace_file [trace_file ...]"
+        return -1
+
+    for trace_file in trace_files:
+        kin = Kinematics(load_loc_columns(trace_file), bins=bins)
+        if as_json:
+            print json.dumps(kin.summary(per_object))
+        else:
+            kin.report(per_object=per_object)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# merge_traces.py [--keep-duplicates] [--run-size=N] output_file
+#                 trace_file [trace_file ...]
+#
+# Merges object path traces collected by several bots at once, e.g. by
+# parade.py in neighboring sims, into a single global trace.
+#
+# Traces are aligned by the wall clock start times in their 'started'
+# events: event times in the output are relative to the earliest start.
+# Each trace is put in time order with time_order.sort_events, which
+# spills runs of up to --run-size events to disk for large traces, and
+# the events of all traces are then merged by time with a streaming
+# k-way merge, so beyond the sort runs only per-object state is held in
+# memory.
+#
+# Bots in neighboring sims see many of the same objects, so the same
+# object appears in several traces.  Each object is owned by one trace
+# at a time, the first to add it, and only the owner's events for it are
+# kept.  When the owner kills the object (it left that bot's interest
+# set), ownership passes to another trace which still has the object, if
+# any, so the object's path continues without a kill.  Properties are
+# kept once per object.  --keep-duplicates disables this and keeps all
+# events.
+#
+# Local IDs are only unique within a sim, so they are offset by
+# LOCAL_ID_OFFSET times the index of the trace they came from, and each
+# event records the sim of the trace it came from in a 'source' field.
+
+import sys
+import heapq
+import datetime
+from object_path import parse_time
+from trace_events import iter_trace_events, TraceWriter
+from time_order import sort_events, DEFAULT_RUN_SIZE
+
+LOCAL_ID_OFFSET = 1 << 32
+
+# Format of the 'started' time written by sltrace, DateTime.ToString()
+# in the en-US culture
+_STARTED_FORMATS = ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S')
+
+def parse_started_time(val):
+    """
+    Parses the wall clock time in a 'started' event, returning a
+    datetime, or None if it isn't in a known format.
+    """
+    for fmt in _STARTED_FORMATS:
+        try:
+            return datetime.datetime.strptime(val, fmt)
+        except ValueError:
+            pass
+    return None
+
+def format_time(seconds):
+    """Formats a time since the start of a trace as stored in events."""
+    return ('%.4f' % (seconds * 1000.0)).rstrip('0').rstrip('.') + 'ms'
+
+def _started_events(trace_file):
+    return list(iter_trace_events(trace_file, event_types=['started']))
+
+def _source_events(idx, trace_file, offset, run_size):
+    """
+    Generates (time, idx, seq, event) for the events in trace_file, in
+    time order, with times shifted by offset seconds.  Events without times are
+    given the time of the event before them so they stay in place, and
+    seq keeps events with equal times in their original order.
+    """
+    t = offset
+    seq = 0
+    for evt in sort_events(iter_trace_events(trace_file), run_size=run_size):
+        if evt['event'] == 'started': continue
+        if 'time' in evt:
+            t = parse_time(evt['time']) + offset
+            evt['time'] = format_time(t)
+        yield (t, idx, seq, evt)
+        seq += 1
+
+class _Deduper:
+    """
+    Tracks which source owns each object, deciding which events to keep
+    (see above).
+    """
+
+    def __init__(self, nsources):
+        self._owners = {} # id -> source index
+        self._present = [set() for idx in range(nsources)] # ids each source has
+        self._adds = [{} for idx in range(nsources)] # id -> latest add event
+        self._emitted_parent = {} # id -> parent in the last add kept
+        self._properties = set() # ids whose properties have been kept
+
+    def _keep_add(self, evt):
+        self._emitted_parent[evt['id']] = evt.get('parent_local')
+        return [evt]
+
+    def process(self, src, evt):
+        """Returns the list of events to output for evt from source src."""
+        evt_type = evt['event']
+        if 'id' not in evt: return [evt]
+        objid = evt['id']
+        owner = self._owners.get(objid)
+
+        if evt_type == 'add':
+            self._present[src].add(objid)
+            self._adds[src][objid] = evt
+            if owner is None:
+                self._owners[objid] = src
+                owner = src
+            if owner == src: return self._keep_add(evt)
+            return []
+
+        if evt_type == 'kill':
+            self._present[src].discard(objid)
+            self._adds[src].pop(objid, None)
+            if owner != src: return []
+            # Hand the object to another source which still sees it
+            for other in range(len(self._present)):
+                if objid not in self._present[other]: continue
+                self._owners[objid] = other
+                add = self._adds[other][objid]
+                if add.get('parent_local') != self._emitted_parent.get(objid):
+                    add = dict(add)
+                    add['time'] = evt['time']
+                    return self._keep_add(add)
+                return []
+            del self._owners[objid]
+            return [evt]
+
+        if evt_type == 'properties':
+            if objid in self._properties: return []
+            self._properties.add(objid)
+            return [evt]
+
+        if owner is None and objid in self._present[src]:
+            self._owners[objid] = src
+            owner = src
+        if owner == src: return [evt]
+        return []
+
+def merge_traces(trace_files, output_file, dedupe=True, run_size=DEFAULT_RUN_SIZE):
+    """
+    Merges trace_files into output_file (see above).  Returns the
+    number of events written.
+    """
+    # Align sources by their wall clock start times
+    starts = []
+    started = []
+    sims = []
+    for trace_file in trace_files:
+        evts = _started_events(trace_file)
+        started.extend(evts)
+        start = None
+        if evts: start = parse_started_time(evts[0]['time'])
+        if start is None:
+            print >>sys.stderr, "Warning: no usable start time in %s, assuming it started first." % trace_file
+        starts.append(start)
+        sims.append(evts and evts[0].get('sim'))
+    known = [start for start in starts if start is not None]
+    global_start = None
+    if known: global_start = min(known)
+    offsets = []
+    for start in starts:
+        if start is None: offsets.append(0.0)
+        else: offsets.append(_total_seconds(start - global_start))
+
+    writer = TraceWriter(output_file)
+    # The earliest start comes first, so it's used as the trace's start
+    started.sort(key=lambda evt: parse_started_time(evt['time']) or datetime.datetime.min)
+    for evt in started: writer.write(evt)
+
+    deduper = None
+    if dedupe: deduper = _Deduper(len(trace_files))
+    sources = [_source_events(idx, trace_file, offsets[idx], run_size)
+               for idx,trace_file in enumerate(trace_files)]
+    for t,src,seq,evt in heapq.merge(*sources):
+        if 'local' in evt: evt['local'] += src * LOCAL_ID_OFFSET
+        if 'parent_local' in evt: evt['parent_local'] += src * LOCAL_ID_OFFSET
+        evt['source'] = sims[src]
+        if deduper is None:
+            writer.write(evt)
+            continue
+        for out_evt in deduper.process(src, evt):
+            writer.write(out_evt)
+    writer.close()
+    return writer.count
+
+def _total_seconds(delta):
+    return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1000000.0
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    dedupe = True
+    run_size = DEFAULT_RUN_SIZE
+    args = []
+    for arg in argv:
+        if arg == '--keep-duplicates':
+            dedupe = False
+        elif arg.startswith('--run-size='):
+            run_size = int(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
+
+    if len(args) < 2:
+        print "Usage: merge_traces.py [--keep-duplicates] [--run-size=N] output_file trace_file [trace_file ...]"
+        return -1
+
+    count = merge_traces(args[1:], args[0], dedupe=dedupe, run_size=run_size)
+    print "Wrote %d events to %s" % (count, args[0])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
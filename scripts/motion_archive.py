@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#
+# motion_archive.py -- a compact binary archive format for sets of
+# MotionPaths, e.g. as extracted by quake_motion_path.py.
+#
+# An archive contains a header, the encoded paths for each object, and
+# finally an object table mapping object UUIDs to the location of
+# their paths.  Each path is stored as a point count followed by
+# timestamps in milliseconds and positions quantized to a grid whose
+# spacing guarantees every decoded position is within the archive's
+# error bound of the original.  Both are delta encoded against the
+# previous point and written as zigzag varints, so slowly moving
+# objects take only a few bytes per point.
+#
+# Since positions are quantized before delta encoding, errors don't
+# accumulate along a path.  The reader memory maps the archive and only
+# decodes an object's paths when they are requested.
+#
+# Layout (little endian):
+#   header: 'SLMA', uint16 version, uint16 unused, float64 error bound,
+#           float64 position step, float64 time step (seconds),
+#           uint32 object count, uint64 object table offset,
+#           uint32 start string length, start string
+#   per object: varint path count, then per path: varint point count,
+#               point count * (time, x, y, z) zigzag varint deltas
+#   object table: per object: 16 byte UUID, uint64 offset, uint32 length
+
+import sys
+import math
+import mmap
+import struct
+from uuid import UUID
+from motion_path import MotionPath
+
+MAGIC = 'SLMA'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHdddIQI')
+_TABLE_ENTRY = struct.Struct('<16sQI')
+
+def _zigzag(val):
+    if val >= 0: return val << 1
+    return ((-val) << 1) - 1
+
+def _unzigzag(val):
+    if val & 1: return -((val + 1) >> 1)
+    return val >> 1
+
+def _write_varint(out, val):
+    while val >= 0x80:
+        out.append((val & 0x7f) | 0x80)
+        val >>= 7
+    out.append(val)
+
+def is_motion_archive(filename):
+    """Returns True if the file looks like a motion archive."""
+    try:
+        fp = open(filename, 'rb')
+    except IOError:
+        return False
+    try:
+        return fp.read(len(MAGIC)) == MAGIC
+    finally:
+        fp.close()
+
+class ArchiveWriter:
+    """
+    ArchiveWriter streams sets of MotionPaths for objects into a new
+    archive.  Call add() for each object and close() when finished.
+    """
+
+    def __init__(self, filename, error=0.01, start=None):
+        """
+        Keyword arguments:
+        error -- maximum distance between a stored position and the
+                 original (default 0.01)
+        start -- the start time shared by the MotionPaths (default None)
+        """
+        self.error = float(error)
+        # Rounding to a grid with this spacing moves a point at most
+        # half a step on each axis, i.e. sqrt(3)*step/2 = error overall
+        self.step = 2.0 * self.error / math.sqrt(3.0)
+        self.time_step = 0.001
+        self.start = start
+        self._table = []
+        self._fp = open(filename, 'wb')
+        self._write_header(0)
+
+    def _write_header(self, table_offset):
+        start = self.start
+        if start is None: start = ''
+        start = str(start)
+        self._fp.write(_HEADER.pack(MAGIC, VERSION, 0, self.error, self.step,
+                                    self.time_step, len(self._table),
+                                    table_offset, len(start)))
+        self._fp.write(start)
+
+    def add(self, objid, paths):
+        """Adds the list of MotionPaths for objid to the archive."""
+        out = bytearray()
+        _write_varint(out, len(paths))
+        for path in paths:
+            _write_varint(out, len(path))
+            last = (0, 0, 0, 0)
+            for t,pos in path:
+                cur = (int(round(t / self.time_step)),
+                       int(round(pos[0] / self.step)),
+                       int(round(pos[1] / self.step)),
+                       int(round(pos[2] / self.step)))
+                for idx in range(4):
+                    _write_varint(out, _zigzag(cur[idx] - last[idx]))
+                last = cur
+
+        offset = self._fp.tell()
+        self._fp.write(out)
+        self._table.append( (objid.bytes, offset, len(out)) )
+
+    def close(self):
+        table_offset = self._fp.tell()
+        for entry in self._table:
+            self._fp.write(_TABLE_ENTRY.pack(*entry))
+        # Now that we know where the table is, fill in the header
+        self._fp.seek(0)
+        self._write_header(table_offset)
+        self._fp.close()
+
+def write_archive(filename, motions, error=0.01, start=None):
+    """
+    Writes motions, a dict (or list of pairs) of UUID -> [MotionPath,
+    list], to a new archive.
+    """
+    if hasattr(motions, 'items'): motions = motions.items()
+    writer = ArchiveWriter(filename, error=error, start=start)
+    for objid,paths in motions:
+        writer.add(objid, paths)
+    writer.close()
+
+class MotionArchive:
+    """
+    MotionArchive provides read access to an archive.  Only the header
+    and object table are read up front; paths are decoded on demand.
+    """
+
+    def __init__(self, filename):
+        self._fp = open(filename, 'rb')
+        self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, unused, self.error, self.step, self.time_step,
+         count, table_offset, start_len) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %d motion archive' % (filename, VERSION))
+        self.start = self._map[_HEADER.size:_HEADER.size+start_len] or None
+
+        self._order = []
+        self._index = {}
+        for idx in range(count):
+            objid_bytes, offset, length = _TABLE_ENTRY.unpack_from(
+                self._map, table_offset + idx * _TABLE_ENTRY.size)
+            objid = UUID(bytes=objid_bytes)
+            self._order.append(objid)
+            self._index[objid] = (offset, length)
+
+    def close(self):
+        self._map.close()
+        self._fp.close()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, objid):
+        return objid in self._index
+
+    def objects(self):
+        """Returns the list of object UUIDs, in the order they were added."""
+        return self._order
+
+    def paths(self, objid):
+        """Decodes and returns the list of MotionPaths for objid."""
+        offset, length = self._index[objid]
+        data = bytearray(self._map[offset:offset+length])
+
+        # Inline varint decoding, since this is the hot loop
+        pos = [0]
+        def read_varint():
+            result = 0
+            shift = 0
+            idx = pos[0]
+            while True:
+                byte = data[idx]
+                idx += 1
+                result |= (byte & 0x7f) << shift
+                if byte < 0x80: break
+                shift += 7
+            pos[0] = idx
+            return result
+
+        step, time_step = self.step, self.time_step
+        paths = []
+        for path_idx in range(read_varint()):
+            npoints = read_varint()
+            t, x, y, z = 0, 0, 0, 0
+            points = []
+            for point_idx in range(npoints):
+                t += _unzigzag(read_varint())
+                x += _unzigzag(read_varint())
+                y += _unzigzag(read_varint())
+                z += _unzigzag(read_varint())
+                points.append( (t * time_step, (x * step, y * step, z * step)) )
+            if points:
+                paths.append( MotionPath(self.start, points) )
+        return paths
+
+    def __iter__(self):
+        """Iterates over (UUID, [MotionPath, list]) for each object."""
+        for objid in self._order:
+            yield (objid, self.paths(objid))
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 1:
+        print "Usage: motion_archive.py archive_file"
+        return -1
+
+    archive = MotionArchive(argv[0])
+    npaths = 0
+    npoints = 0
+    for objid,paths in archive:
+        npaths += len(paths)
+        npoints += sum([len(path) for path in paths])
+    print "Archive file:", argv[0]
+    print "Error bound:", archive.error
+    print "Number of objects:", len(archive)
+    print "Number of paths:", npaths
+    print "Number of points:", npoints
+    archive.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
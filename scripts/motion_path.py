@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import sys
+import math
 import vec3
 import bisect
 
@@ -10,11 +11,19 @@ class MotionPath:
     iterator is over an ordered list of (time, pos_vec3) tuples.  Note
     that the timestamps are actually deltas w.r.t. a starting time,
     stored in MotionPath.start.
+
+    A MotionPath may optionally carry the velocity recorded with each
+    waypoint, which enables dead-reckoned and Hermite interpolation
+    and dead-reckoning based compression.
     """
 
-    def __init__(self, start, points=None):
+    def __init__(self, start, points=None, velocities=None):
         self.start = start
         self._timestamps, self._points = zip(*points)
+        self._velocities = None
+        if velocities is not None:
+            assert len(velocities) == len(self._points)
+            self._velocities = tuple(velocities)
 
     def __getitem__(self,key):
         return (self._timestamps[key], self._points[key])
@@ -35,6 +44,13 @@ class MotionPath:
     def points(self):
         return self._points
 
+    def velocities(self):
+        """Returns the recorded velocities, or None if not available."""
+        return self._velocities
+
+    def has_velocities(self):
+        return self._velocities is not None
+
     def start_time(self):
         return self._timestamps[0]
 
@@ -56,32 +72,143 @@ class MotionPath:
         if fudge > 0.0: equals_func = vec3.create_delta_equals(fudge)
 
         last = None
-        new_timestamps = []
-        new_points = []
+        keep = []
         for time,point in self.waypoints_iter():
-            if equals_func(point, last): continue
+            keep.append(not equals_func(point, last))
+            if keep[-1]: last = point
+
+        return self._filter(keep)
+
+    def squeeze_predictable(self, tolerance):
+        """
+        Drop updates which could have been predicted by dead reckoning
+        from the last kept update, i.e. whose position is within
+        tolerance of last_pos + last_vel * dt.  This mirrors how the
+        sim decides whether to send a terse update.  Requires
+        velocities.
+
+        Keyword arguments:
+        tolerance -- maximum distance between an update and the
+        position predicted for it for the update to be dropped
+        """
+        assert self.has_velocities()
+
+        tolerance2 = tolerance*tolerance
+        keep = [True] * len(self)
+        last_t, last_pos = self[0]
+        last_vel = self._velocities[0]
+        for idx in range(1, len(self)-1):
+            t, pos = self[idx]
+            predicted = vec3.add(last_pos, vec3.scale(last_vel, t - last_t))
+            if vec3.dist2(pos, predicted) < tolerance2:
+                keep[idx] = False
+                continue
+            last_t, last_pos, last_vel = t, pos, self._velocities[idx]
+
+        return self._filter(keep)
+
+    def simplify(self, tolerance):
+        """
+        Simplify this motion path by removing waypoints which can be
+        reconstructed by interpolation to within the given tolerance.
+        This is a time-aware variant of the Douglas-Peucker algorithm:
+        the error for a waypoint is measured against the position
+        interpolated at the waypoint's own timestamp, so changes in
+        speed are preserved as well as changes in direction.  The
+        first and last waypoints are always kept.
+
+        Keyword arguments:
+        tolerance -- maximum distance allowed between any original
+        waypoint and the simplified path at that waypoint's time
+        """
+
+        npoints = len(self)
+        if npoints <= 2: return self
+
+        timestamps = self._timestamps
+        points = self._points
+        tolerance2 = tolerance*tolerance
+
+        keep = [False] * npoints
+        keep[0] = keep[-1] = True
+
+        # Explicit stack of (first, last) index ranges instead of
+        # recursion, since long paths would exceed the recursion limit
+        ranges = [(0, npoints-1)]
+        while ranges:
+            first, last = ranges.pop()
+            if last - first < 2: continue
+
+            first_t, first_pos = timestamps[first], points[first]
+            last_t, last_pos = timestamps[last], points[last]
+            dt = float(last_t - first_t)
+            delta = vec3.sub(last_pos, first_pos)
+
+            max_err2, max_idx = -1.0, None
+            for idx in range(first+1, last):
+                if dt > 0.0:
+                    alpha = (timestamps[idx] - first_t) / dt
+                else:
+                    alpha = 0.0
+                interp = vec3.add(first_pos, vec3.scale(delta, alpha))
+                err2 = vec3.dist2(points[idx], interp)
+                if err2 > max_err2:
+                    max_err2, max_idx = err2, idx
 
-            new_timestamps.append(time)
-            new_points.append(point)
-            last = point
+            if max_err2 > tolerance2:
+                keep[max_idx] = True
+                ranges.append((first, max_idx))
+                ranges.append((max_idx, last))
 
-        self._timestamps = new_timestamps
-        self._points = new_points
+        return self._filter(keep)
+
+    def _filter(self, keep):
+        """
+        Retain only the waypoints (and velocities) whose entry in the
+        list of booleans keep is True.
+        """
+        self._timestamps = [t for t,k in zip(self._timestamps, keep) if k]
+        self._points = [p for p,k in zip(self._points, keep) if k]
+        if self._velocities is not None:
+            self._velocities = [v for v,k in zip(self._velocities, keep) if k]
         return self
 
-    def interpolate(self, t):
+    def resample(self, interval, start=None, end=None):
+        """
+        Returns a new MotionPath sampled at a fixed interval, or None
+        if no sample times fall within the path.  See resample_paths().
+        """
+        return resample_paths([self], interval, start, end)[0]
+
+    def interpolate(self, t, method='linear'):
         """
         Interpolates the position of the object on this path at the
-        specified time.  Times outside the range of updates are always
-        clamped to the first or last location update.
+        specified time.  Times before the first update are always
+        clamped to the first location update.  Times after the last
+        update are clamped to the last location update, except when
+        dead reckoning, where the last update is extrapolated.
+
+        Keyword arguments:
+        method -- 'linear' interpolates linearly between updates,
+                  'dead-reckoning' extrapolates from the previous
+                  update using its velocity, and 'hermite' uses a
+                  cubic Hermite spline with the velocities as
+                  tangents. The latter two require velocities.
+                  (Default: 'linear')
         """
+        assert method in ('linear', 'dead-reckoning', 'hermite')
+        assert method == 'linear' or self.has_velocities()
 
         # Standard bounds checks
         first_update_t,first_update_pos = self[0]
         if t <= first_update_t: return first_update_pos
 
         last_update_t,last_update_pos = self[-1]
-        if t >= last_update_t: return last_update_pos
+        if t >= last_update_t:
+            if method == 'dead-reckoning':
+                return vec3.add(last_update_pos,
+                                vec3.scale(self._velocities[-1], t - last_update_t))
+            return last_update_pos
 
         # Otherwise, find the right pair of updates
 
@@ -93,9 +220,95 @@ class MotionPath:
         for idx in range(start_idx+1,len(self)):
             cur_t,cur_pos = self[idx]
             if t >= prev_t and t < cur_t:
-                alpha = float(t - prev_t) / float(cur_t - prev_t)
+                if method == 'dead-reckoning':
+                    return vec3.add(prev_pos,
+                                    vec3.scale(self._velocities[idx-1], t - prev_t))
+                dt = float(cur_t - prev_t)
+                alpha = float(t - prev_t) / dt
+                if method == 'hermite':
+                    return self._hermite(prev_pos, self._velocities[idx-1],
+                                         cur_pos, self._velocities[idx],
+                                         dt, alpha)
                 return vec3.add(vec3.scale(cur_pos, alpha), vec3.scale(prev_pos, (1.0 - alpha)))
 
             prev_t,prev_pos = cur_t,cur_pos
 
         print t, self.timestamps(), start_idx
+
+    def _hermite(self, p0, v0, p1, v1, dt, alpha):
+        """
+        Evaluates the cubic Hermite spline between p0 and p1, with
+        tangents v0 and v1 (velocities, scaled by the interval dt), at
+        alpha in [0,1].
+        """
+        a2 = alpha*alpha
+        a3 = a2*alpha
+        h00 = 2*a3 - 3*a2 + 1
+        h10 = a3 - 2*a2 + alpha
+        h01 = -2*a3 + 3*a2
+        h11 = a3 - a2
+        return vec3.add(vec3.add(vec3.scale(p0, h00), vec3.scale(v0, h10*dt)),
+                        vec3.add(vec3.scale(p1, h01), vec3.scale(v1, h11*dt)))
+
+def resample_paths(paths, interval, start=None, end=None):
+    """
+    Resamples a list of MotionPaths at a fixed interval, returning a
+    list of new MotionPaths in the same order.  Samples are taken at
+    multiples of interval (relative to the trace start, so all paths
+    share the same sample times) which fall within both the path's
+    own time span and [start, end], if specified.  A path with no
+    samples in its range results in None.
+
+    Interpolation is linear and vectorized over all the paths at
+    once, so resampling in batches is much faster than calling
+    MotionPath.interpolate() per sample.  This requires numpy.
+
+    Keyword arguments:
+    interval -- time between samples, in seconds
+    start -- earliest time to sample (default None, i.e. path start)
+    end -- latest time to sample (default None, i.e. path end)
+    """
+    # numpy is only required for resampling, so it is imported lazily
+    import numpy
+
+    if not paths: return []
+
+    # Per-path sample times, as indices of multiples of interval
+    sample_times = []
+    for path in paths:
+        span_start, span_end = path.start_time(), path.end_time()
+        if start is not None: span_start = max(span_start, start)
+        if end is not None: span_end = min(span_end, end)
+        first_idx = int(math.ceil(span_start / interval - 1e-9))
+        last_idx = int(math.floor(span_end / interval + 1e-9))
+        sample_times.append(numpy.arange(first_idx, last_idx+1) * interval)
+
+    # Interpolate all paths with a single numpy.interp call per axis
+    # by laying the paths out end to end on the time axis, each offset
+    # by more than the total time range so they can't interact.
+    lo = min([path.start_time() for path in paths] + [0.0])
+    hi = max([path.end_time() for path in paths])
+    width = (hi - lo) + 1.0
+    offsets = [idx*width - lo for idx in range(len(paths))]
+
+    xp = numpy.concatenate([numpy.asarray(path.timestamps(), dtype=float) + off
+                            for path,off in zip(paths, offsets)])
+    fp = numpy.concatenate([numpy.asarray(path.points(), dtype=float)
+                            for path in paths])
+    x = numpy.concatenate([times + off
+                           for times,off in zip(sample_times, offsets)])
+    interp = numpy.column_stack([numpy.interp(x, xp, fp[:,axis])
+                                 for axis in range(3)])
+
+    results = []
+    pos_idx = 0
+    for path,times in zip(paths, sample_times):
+        count = len(times)
+        if count == 0:
+            results.append(None)
+            continue
+        points = [tuple(pos) for pos in interp[pos_idx:pos_idx+count].tolist()]
+        results.append( MotionPath(path.start, zip(times.tolist(), points)) )
+        pos_idx += count
+
+    return results
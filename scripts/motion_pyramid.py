@@ -0,0 +1,249 @@
+#!/usr/bin/python
+#
+# motion_pyramid.py -- multi-resolution sets of MotionPaths, for
+# interactive viewers and graph_motion_paths.py, which need paths at a
+# level of detail appropriate to the time span and area shown rather
+# than at full resolution.
+#
+# A pyramid has one level per tolerance in DEFAULT_TOLERANCES (or as
+# specified): level 0 holds the paths as given, and each following
+# level simplifies the level before it (see MotionPath.simplify) with a
+# larger tolerance, so a path at level k is within about 4/3 times its
+# tolerance of the original.  Each level keeps the time span and
+# bounding box of every path in numpy arrays, so queries only touch
+# paths which overlap the requested time span and area, and paths are
+# clipped to them.
+#
+# ObjectPathTrace.motion_pyramid() builds pyramids for traces and
+# stores each level as a separate TraceCache entry, so a viewer
+# showing a coarse overview only loads the coarse levels.
+
+import sys
+import bisect
+from motion_path import MotionPath
+
+DEFAULT_TOLERANCES = (0.0, 0.1, 0.4, 1.6, 6.4)
+DEFAULT_TILE_SIZE = 64
+
+class PyramidLevel:
+    """
+    PyramidLevel holds the paths for one level of a pyramid, as a list
+    of (object id, MotionPath) pairs, with their extents.
+    """
+
+    def __init__(self, tolerance, entries):
+        import numpy
+        self.tolerance = tolerance
+        self.entries = entries
+        # t0, t1, xmin, ymin, xmax, ymax per path
+        self.extents = numpy.zeros((len(entries), 6))
+        for idx,(objid,path) in enumerate(entries):
+            points = numpy.asarray(path.points(), dtype=float)
+            self.extents[idx] = (path.start_time(), path.end_time(),
+                                 points[:,0].min(), points[:,1].min(),
+                                 points[:,0].max(), points[:,1].max())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def points(self):
+        return sum([len(path) for objid,path in self.entries])
+
+    def overlapping(self, time_range=None, bbox=None):
+        """
+        Returns the indices of the paths overlapping time_range, a
+        (start, end) tuple either of which may be None, and bbox,
+        (xmin, ymin, xmax, ymax).
+        """
+        import numpy
+        ext = self.extents
+        mask = numpy.ones(len(ext), dtype=bool)
+        if time_range is not None:
+            start, end = time_range
+            if start is not None: mask &= (ext[:,1] >= start)
+            if end is not None: mask &= (ext[:,0] <= end)
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            mask &= (ext[:,4] >= xmin) & (ext[:,2] <= xmax)
+            mask &= (ext[:,5] >= ymin) & (ext[:,3] <= ymax)
+        return numpy.nonzero(mask)[0]
+
+def _copy_path(path):
+    return MotionPath(path.start, path.waypoints(), path.velocities())
+
+def _slice_path(path, first, last):
+    waypoints = path.waypoints()[first:last]
+    vels = path.velocities()
+    if vels is not None: vels = vels[first:last]
+    return MotionPath(path.start, waypoints, vels)
+
+def _clip_time(path, start, end):
+    """
+    Returns the part of path within [start, end], including the
+    waypoints on either side so the path reaches the boundaries.
+    """
+    timestamps = path.timestamps()
+    first = 0
+    if start is not None: first = max(bisect.bisect_left(timestamps, start) - 1, 0)
+    last = len(path)
+    if end is not None: last = min(bisect.bisect_right(timestamps, end) + 1, len(path))
+    if first == 0 and last == len(path): return path
+    return _slice_path(path, first, last)
+
+def _clip_bbox(path, bbox):
+    """
+    Returns a list of the parts of path inside bbox, including the
+    waypoints on either side of each part so segments crossing the
+    edges are kept.
+    """
+    import numpy
+    xmin, ymin, xmax, ymax = bbox
+    points = numpy.asarray(path.points(), dtype=float)
+    inside = (points[:,0] >= xmin) & (points[:,0] <= xmax) & \
+        (points[:,1] >= ymin) & (points[:,1] <= ymax)
+    if inside.all(): return [path]
+    keep = inside.copy()
+    keep[1:] |= inside[:-1]
+    keep[:-1] |= inside[1:]
+    # Split into runs of consecutive kept waypoints
+    changes = numpy.diff(numpy.concatenate([[0], keep.astype(int), [0]]))
+    starts = numpy.nonzero(changes == 1)[0]
+    ends = numpy.nonzero(changes == -1)[0]
+    return [_slice_path(path, first, last) for first,last in zip(starts, ends)]
+
+def build_levels(motions, tolerances=DEFAULT_TOLERANCES):
+    """
+    Builds the levels of a pyramid from motions, a dict of object id ->
+    list of MotionPaths, returning a list of PyramidLevels.  The given
+    MotionPaths are used as level 0 (or simplified in place if the
+    first tolerance isn't 0) and are not copied.
+    """
+    entries = [(objid, path) for objid,paths in motions.items()
+               for path in paths if len(path) > 0]
+    levels = []
+    for tolerance in tolerances:
+        if levels:
+            entries = [(objid, _copy_path(path).simplify(tolerance))
+                       for objid,path in entries]
+        elif tolerance > 0.0:
+            for objid,path in entries: path.simplify(tolerance)
+        levels.append(PyramidLevel(tolerance, entries))
+    return levels
+
+class MotionPyramid:
+    """
+    MotionPyramid answers queries for the paths overlapping a time span
+    and area at a given level of detail.  Levels are either given as a
+    list of PyramidLevels or loaded on demand by calling load(idx).
+    """
+
+    def __init__(self, tolerances, levels=None, load=None):
+        assert levels is not None or load is not None
+        self.tolerances = tuple(tolerances)
+        self._levels = {}
+        if levels is not None:
+            self._levels = dict(enumerate(levels))
+        self._load = load
+
+    def __len__(self):
+        return len(self.tolerances)
+
+    def level(self, idx):
+        """Returns the PyramidLevel at idx, loading it if necessary."""
+        if idx not in self._levels:
+            self._levels[idx] = self._load(idx)
+        return self._levels[idx]
+
+    def level_for_resolution(self, resolution):
+        """
+        Returns the index of the coarsest level whose tolerance is at
+        most resolution, e.g. the size of a pixel, so its error isn't
+        visible.
+        """
+        best = 0
+        for idx,tolerance in enumerate(self.tolerances):
+            if tolerance <= resolution: best = idx
+        return best
+
+    def query(self, time_range=None, bbox=None, resolution=None, level=None, clip=True):
+        """
+        Returns a dict of object id -> list of MotionPaths for the paths
+        overlapping time_range ((start, end), either may be None) and
+        bbox ((xmin, ymin, xmax, ymax)).
+
+        Keyword arguments:
+        resolution -- use the coarsest level accurate to this distance
+                      (default None, i.e. full resolution)
+        level -- use this level, overriding resolution (default None)
+        clip -- clip the paths to time_range and bbox (default True).
+                Clipped paths share no waypoints with the pyramid, and
+                unclipped ones must not be modified.
+        """
+        if level is None:
+            level = 0
+            if resolution is not None: level = self.level_for_resolution(resolution)
+        lvl = self.level(level)
+
+        results = {}
+        for idx in lvl.overlapping(time_range, bbox):
+            objid, path = lvl.entries[idx]
+            parts = [path]
+            if clip and time_range is not None:
+                parts = [_clip_time(path, time_range[0], time_range[1])]
+            if clip and bbox is not None:
+                parts = [sub for part in parts for sub in _clip_bbox(part, bbox)]
+            results.setdefault(objid, []).extend(parts)
+        return results
+
+    def tile(self, x, y, tile_size=DEFAULT_TILE_SIZE, time_range=None, resolution=None, level=None):
+        """
+        Returns the paths in tile (x, y) of a grid of tile_size squares
+        over the sim, clipped to the tile (see query()).
+        """
+        bbox = (x * tile_size, y * tile_size, (x+1) * tile_size, (y+1) * tile_size)
+        return self.query(time_range=time_range, bbox=bbox, resolution=resolution, level=level)
+
+def cached_pyramid(cache, key, tolerances, build):
+    """
+    Returns a MotionPyramid whose levels are stored in cache, a
+    TraceCache, under keys derived from key.  Levels missing from the
+    cache are built by calling build(), which returns the list of
+    PyramidLevels, and stored.
+    """
+    keys = [cache.key(key, idx) for idx in range(len(tolerances))]
+    def load(idx):
+        found, level = cache.get(keys[idx])
+        if found: return level
+        levels = build()
+        for level_key,level in zip(keys, levels):
+            cache.put(level_key, level)
+        pyramid._levels.update(enumerate(levels))
+        return levels[idx]
+    pyramid = MotionPyramid(tolerances, load=load)
+    return pyramid
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 1:
+        print "Usage: motion_pyramid.py trace_file|motion_archive"
+        return -1
+
+    from object_path import load_trace
+    from motion_archive import MotionArchive, is_motion_archive
+    if is_motion_archive(argv[0]):
+        pyramid = MotionPyramid(DEFAULT_TOLERANCES,
+                                levels=build_levels(dict(iter(MotionArchive(argv[0])))))
+    else:
+        trace = load_trace(argv[0], event_types=['add', 'kill', 'loc'])
+        trace.fill_parents()
+        pyramid = trace.motion_pyramid(trace.roots())
+
+    print "%-6s %10s %10s %10s" % ('Level', 'Tolerance', 'Paths', 'Points')
+    for idx in range(len(pyramid)):
+        level = pyramid.level(idx)
+        print "%-6d %10g %10d %10d" % (idx, level.tolerance, len(level), level.points())
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
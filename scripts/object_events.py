@@ -12,6 +12,7 @@ try:
 except:
     import json
 from uuid import UUID
+from trace_events import iter_trace_events
 
 class ObjectPathTrace:
     """
@@ -70,17 +71,19 @@ class ObjectPathTrace:
 
         return self._objects
 
-def main():
-    if len(sys.argv) < 3:
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 2:
         print "Usage: object_events.py objid tracefile"
         return -1
 
-    objid = sys.argv[1]
-    trace_file = sys.argv[2]
+    objid = argv[0]
+    trace_file = argv[1]
 
-    orig = json.load(open(trace_file))
-    filtered = [evt for evt in orig
-                if 'id' in evt and evt['id'] == objid]
+    # Only events for the object are decoded, the rest are skipped
+    # while parsing
+    filtered = [evt for evt in iter_trace_events(trace_file, ids=[objid])
+                if 'id' in evt]
 
     print json.dumps(filtered, sort_keys=False, indent=2)
 
@@ -1,13 +1,18 @@
 #!/usr/bin/python
 
 import sys
+import functools
 try:
     import simplejson as json
 except:
     import json
 from uuid import UUID
 import vec3
-from motion_path import MotionPath
+from interval_tree import IntervalTree
+from motion_path import MotionPath, resample_paths
+from motion_pyramid import MotionPyramid, build_levels, cached_pyramid, DEFAULT_TOLERANCES
+from trace_events import iter_trace_events, load_trace_events_parallel, segment_filenames, load_json
+from trace_cache import open_cache
 
 def parse_time(val):
     """
@@ -24,6 +29,25 @@ def parse_vec3(val):
     assert ('x' in val and 'y' in val and 'z' in val)
     return ( float(val['x']), float(val['y']), float(val['z']) )
 
+def _cache_arg(arg):
+    # Collections of ids are order independent
+    if isinstance(arg, (list, tuple, set, frozenset)): return sorted(arg)
+    return arg
+
+def _cached(method):
+    """
+    Decorator for ObjectPathTrace methods whose results depend only on
+    the trace's events and the method's arguments. If the trace has a
+    TraceCache, results are looked up in and stored to it.
+    """
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._caching(): return method(self, *args, **kwargs)
+        key = self._method_key(name, *args, **kwargs)
+        return self._cache.memoize(key, lambda: method(self, *args, **kwargs))
+    return wrapper
+
 class ObjectPathTrace:
     """
     ObjectPathTrace provides a convenient interface to object path trace data
@@ -35,29 +59,68 @@ class ObjectPathTrace:
     to fill in missing parent information).
     """
 
-    def __init__(self, trace_file=None, raw=None, start_time=None):
+    def __init__(self, trace_file=None, raw=None, start_time=None,
+                 event_types=None, ids=None, time_range=None, processes=None,
+                 cache=None):
         """
         Create a new ObjectPathTrace. Only one source of data should be
         specified.
 
         Keyword arguments:
-        trace_file -- name of JSON trace file
+        trace_file -- name of JSON trace file, or of a segmented trace
+                      (see trace_events.segment_filenames)
         raw -- raw Python representation of JSON, i.e. an array of
                events (default None)
         start_time -- start time to use for this trace. Overrides any start
                       time specified in the raw trace. (default None)
+
+        When loading from a trace file, events can be filtered as they
+        are parsed, so that events which aren't needed are never
+        decoded (see trace_events.iter_trace_events):
+        event_types -- only load events of these types. 'started'
+                       events are always loaded. (default None)
+        ids -- only load events for these object UUIDs (default None)
+        time_range -- (start, end) in seconds; only load events in
+                      this range (default None)
+
+        processes -- if specified, decode the trace file in parallel
+                     using this many processes. Event order is
+                     preserved. (default None, i.e. decode serially)
+
+        Events are put in time order (see time_order.time_ordered), which
+        the per-object algorithms below rely on, since sltrace doesn't
+        record them strictly in order.
+
+        cache -- a trace_cache.TraceCache to persist derived results
+                 such as sim_motions() and clusters() in (default:
+                 trace_cache.open_cache(), i.e. SLTRACE_CACHE_DIR if set).
+                 Only traces loaded from files are cached.
         """
 
         # Get raw data
+        if event_types is not None:
+            event_types = set(event_types) | set(['started'])
         if raw: self._orig = raw
+        elif trace_file and processes:
+            self._orig = load_trace_events_parallel(trace_file, processes=processes,
+                                                    event_types=event_types,
+                                                    ids=ids, time_range=time_range)
+        elif trace_file and (event_types or ids or time_range or
+                             segment_filenames(trace_file) != [trace_file]):
+            self._orig = list(iter_trace_events(trace_file, event_types=event_types,
+                                                ids=ids, time_range=time_range))
         elif trace_file:
             try:
-                self._orig = json.load(open(trace_file))
+                self._orig = load_json(trace_file)
             except ValueError:
                 self._orig = []
         else: self._orig = []
+        # Imported here since time_order uses parse_time from this module
+        from time_order import time_ordered
+        self._orig = time_ordered(self._orig)
         # Filter and set start time from data. If specified, override with
         # user start time
+        self._start_time = None
         started_evts = [x for x in self._orig if x['event'] == 'started']
         if len(started_evts) > 0:
             self._start_time = started_evts[0]['time'] # FIXME convert to datetime
@@ -75,6 +138,37 @@ class ObjectPathTrace:
 
         self._filled_parents = False
 
+        # Result cache, identified by the trace contents and the
+        # options it was loaded with
+        self._cache = cache or open_cache()
+        self._source = None
+        self._source_params = None
+        if trace_file and not raw:
+            self._source_params = (trace_file, event_types and sorted(event_types),
+                                   ids and sorted(ids), time_range, start_time)
+
+    def _caching(self):
+        return self._cache is not None and \
+            (self._source is not None or self._source_params is not None)
+
+    def _cache_source(self):
+        """Returns a key identifying this trace's events for caching."""
+        if self._source is None:
+            trace_file, event_types, ids, time_range, start_time = self._source_params
+            hashes = [self._cache.file_hash(segment)
+                      for segment in segment_filenames(trace_file)]
+            # 'time_ordered' distinguishes results from before events
+            # were sorted on load
+            self._source = self._cache.key(hashes, event_types, ids, time_range, start_time,
+                                           'time_ordered')
+        return self._source
+
+    def _method_key(self, name, *args, **kwargs):
+        """Returns the cache key for the result of method name (see _cached)."""
+        return self._cache.key(self._cache_source(), self._filled_parents, name,
+                               [_cache_arg(arg) for arg in args],
+                               sorted(kwargs.items()))
+
     def objects(self):
         """Returns a list of object UUIDs encountered in this trace."""
         if not self._objects:
@@ -130,10 +224,13 @@ class ObjectPathTrace:
             group_events[group].append(x)
 
         result_traces = []
-        for evt_list in group_events:
-            result_traces.append(
-                ObjectPathTrace(raw=evt_list, start_time=self._start_time)
-                )
+        for obj_set,evt_list in zip(obj_sets, group_events):
+            subtrace = ObjectPathTrace(raw=evt_list, start_time=self._start_time,
+                                       cache=self._cache)
+            if self._caching():
+                subtrace._source = self._cache.key(self._cache_source(), self._filled_parents,
+                                                   'subset', sorted(obj_set))
+            result_traces.append(subtrace)
         return result_traces
 
     def events(self):
@@ -366,9 +463,13 @@ class ObjectPathTrace:
         Each sublist is guaranteed to be disjoint from all other
         sublists.
         """
-
+        # Filling in parents is a side effect callers rely on, so it
+        # happens even when the result is cached
         self.fill_parents()
+        return self._clusters()
 
+    @_cached
+    def _clusters(self):
         # Our approach is to build up a graph of related objects and
         # then use that graph to isolate connected components as our
         # resulting subsets.
@@ -423,6 +524,56 @@ class ObjectPathTrace:
 
         return results
 
+    def end_time(self):
+        """
+        Returns the time of the last event in the trace, in seconds
+        since the start of the trace, or None if it has no timed events.
+        """
+        end = None
+        for evt in self._orig:
+            if 'time' not in evt or evt['event'] == 'started': continue
+            t = parse_time(evt['time'])
+            if end is None or t > end: end = t
+        return end
+
+    def lifetimes(self):
+        """
+        Returns a dict of UUID -> [(added_time, removed_time), ...],
+        the intervals during which each object was in the interest
+        set, i.e. from an 'add' event to the following 'kill' event.
+        Additional 'add' events while an object is present (e.g. for
+        parent changes) don't start a new interval.  Objects which are
+        never killed remain present until the end of the trace.
+        """
+        lifetimes = {}
+        added = {} # UUID -> time added, for objects currently present
+        for evt in self.events_by_type(['add', 'kill']):
+            evt_id = UUID(evt['id'])
+            t = parse_time(evt['time'])
+            if evt['event'] == 'add':
+                if evt_id not in added: added[evt_id] = t
+                lifetimes.setdefault(evt_id, [])
+            elif evt_id in added:
+                lifetimes[evt_id].append( (added.pop(evt_id), t) )
+
+        if added:
+            end = self.end_time()
+            for evt_id,t in added.items():
+                lifetimes[evt_id].append( (t, max(t, end)) )
+
+        return lifetimes
+
+    def lifetime_index(self):
+        """
+        Returns an IntervalTree over the lifetimes() of all objects,
+        whose values are object UUIDs, for answering queries like
+        which objects were present at time t or during [t0, t1], and
+        how many.
+        """
+        return IntervalTree([(start, end, objid)
+                             for objid,intervals in self.lifetimes().items()
+                             for start,end in intervals])
+
     def sizes(self):
         """
         Extract the sizes of each prim in the trace, returning a dict
@@ -458,6 +609,11 @@ class ObjectPathTrace:
         adding and removing children objects, as well as having them
         move relative to the root object).
         """
+        self.fill_parents()
+        return self._aggregate_sizes()
+
+    @_cached
+    def _aggregate_sizes(self):
         root_children = self.all_children(type='roots')
         obj_sizes = self.sizes()
         additions = self.addition_events()
@@ -491,30 +647,49 @@ class ObjectPathTrace:
 
         return agg_sizes
 
-    def motion(self, objid):
+    def _motion_path(self, loc_evts, velocities=False):
         """
-        Extract a MotionPath for the object with the specified UUID.
+        Generates a MotionPath from a list of loc events, optionally
+        including the recorded velocities.
         """
         waypoints = [(parse_time(evt['time']),parse_vec3(evt['pos']))
-                     for evt in self.loc_events()
-                     if UUID(evt['id']) == objid]
-        return MotionPath(start=self._start_time, points=waypoints)
+                     for evt in loc_evts]
+        vels = None
+        if velocities:
+            vels = [parse_vec3(evt['vel']) for evt in loc_evts]
+        return MotionPath(start=self._start_time, points=waypoints, velocities=vels)
+
+    def motion(self, objid, velocities=False):
+        """
+        Extract a MotionPath for the object with the specified UUID.
+
+        Keyword arguments:
+        velocities -- if True, the MotionPath will also carry the
+                      velocity recorded with each update (default False)
+        """
+        loc_evts = [evt for evt in self.loc_events()
+                    if UUID(evt['id']) == objid]
+        return self._motion_path(loc_evts, velocities)
 
-    def motions(self, objid_set):
+    def motions(self, objid_set, velocities=False):
         """
         Extract MotionPaths for the objects listed in
         objid_set. MotionPaths are returned as a dict of UUID ->
         MotionPath.
+
+        Keyword arguments:
+        velocities -- if True, the MotionPaths will also carry the
+                      velocity recorded with each update (default False)
         """
-        waypoints = dict([(objid,[]) for objid in objid_set])
+        obj_locs = dict([(objid,[]) for objid in objid_set])
         for evt in self.loc_events():
             evt_id = UUID(evt['id'])
-            if evt_id not in waypoints: continue
-            waypoints[evt_id].append( (parse_time(evt['time']),parse_vec3(evt['pos'])) )
+            if evt_id not in obj_locs: continue
+            obj_locs[evt_id].append(evt)
 
         paths = {}
-        for objid,waypoints in waypoints.items():
-            paths[objid] = MotionPath(start=self._start_time, points=waypoints)
+        for objid,loc_evts in obj_locs.items():
+            paths[objid] = self._motion_path(loc_evts, velocities)
 
         return paths
 
@@ -545,63 +720,81 @@ class ObjectPathTrace:
             without_pars[objid] = motions
         return without_pars
 
-    def motion_sequences_with_parents(self, objids):
+    def motion_sequences_with_parents(self, objids, velocities=False):
         """
         Extract MotionPath sequences for the objects listed in
         objid_set, including parent information. MotionPaths are
         returned as a dict of UUID -> [(parent1, MotionPath),
         (parent2, MotionPath)].
+
+        Keyword arguments:
+        velocities -- if True, the MotionPaths will also carry the
+                      velocity recorded with each update (default False)
         """
-        objid_set = set(objids)
-        # Get all adds, kills, and locs for these objects
-        adds_kills_locs = [evt
-                           for evt in self.events_by_type(['add', 'kill', 'loc'])
-                           if UUID(evt['id']) in objid_set]
-
-        # Split by kills and parent changes for each objid
-        # current subsequence for each objid
-        cur_subseq = dict([(objid,[]) for objid in objid_set])
-        # list of subsequences for each objid
-        subseqs = dict([(objid,[]) for objid in objid_set])
-        # last parent encountered for each objid
-        last_parent = dict([(objid,None) for objid in objid_set])
-        for evt in adds_kills_locs:
+        results = {}
+        for objid,motion_path_list in self.motion_sequences_with_parents_iter(objids, velocities):
+            results[objid] = motion_path_list
+        return results
+
+    def motion_sequences_with_parents_iter(self, objids, velocities=False):
+        """
+        Generator version of motion_sequences_with_parents(), yielding
+        (UUID, [(parent1, MotionPath), (parent2, MotionPath)]) pairs
+        one object at a time, in the order the objects are given.
+        Only references to the relevant events are indexed up front;
+        MotionPaths are generated as each object is yielded, so peak
+        memory is proportional to the largest single object rather
+        than the entire set of objects.
+        """
+        objids = list(objids)
+        # Bucket adds, kills, and locs for these objects, preserving
+        # the per-object ordering of events
+        obj_events = dict([(objid,[]) for objid in objids])
+        for evt in self._orig:
+            if evt['event'] not in ('add', 'kill', 'loc'): continue
             evt_id = UUID(evt['id'])
+            if evt_id not in obj_events: continue
+            obj_events[evt_id].append(evt)
+
+        for objid in objids:
+            # skip duplicates, which have already been yielded
+            if objid not in obj_events: continue
+            evts = obj_events.pop(objid)
+            yield (objid, self._motion_sequence_from_events(evts, velocities))
+
+    def _motion_sequence_from_events(self, evts, velocities=False):
+        """
+        Splits the add, kill, and loc events for a single object into
+        [(parent1, MotionPath), (parent2, MotionPath)]. A new
+        subsequence is started on each kill and each parent change.
+        """
+        subseqs = []
+        cur_subseq = [] # current subsequence
+        last_parent = None # last parent encountered
+        for evt in evts:
             need_new_subseq = False
             if evt['event'] == 'loc':
-                cur_subseq[evt_id].append(evt)
+                cur_subseq.append(evt)
             elif evt['event'] == 'kill': # kills always force a new subseq
                 need_new_subseq = True
                 new_parent = None
             elif evt['event'] == 'add':
                 new_parent = None
                 if 'parent' in evt: new_parent = UUID(evt['parent'])
-                need_new_subseq = (new_parent != last_parent[evt_id])
+                need_new_subseq = (new_parent != last_parent)
 
             if need_new_subseq:
-                if cur_subseq[evt_id]: subseqs[evt_id].append( (last_parent[evt_id], cur_subseq[evt_id]) )
-                cur_subseq[evt_id] = []
-                last_parent[evt_id] = new_parent
+                if cur_subseq: subseqs.append( (last_parent, cur_subseq) )
+                cur_subseq = []
+                last_parent = new_parent
         # if non-empty, append the last subsequence
-        for objid,cursub in cur_subseq.items():
-            if cursub: subseqs[objid].append( (last_parent[objid],cursub) )
-
-        # Generate waypoint lists from event lists
-        results = {}
-        for objid,subseqlist in subseqs.items():
-            motion_path_list = [ (par,
-                                  MotionPath(start=self._start_time,
-                                             points = [(parse_time(evt['time']),parse_vec3(evt['pos']))
-                                                       for evt in subseq]
-                                             )
-                                  )
-                                 for par,subseq in subseqlist]
-            results[objid] = motion_path_list
+        if cur_subseq: subseqs.append( (last_parent, cur_subseq) )
 
-        # And finally generate motion paths from waypoint lists
-        return results
+        # Generate motion paths from event lists
+        return [ (par, self._motion_path(subseq, velocities))
+                 for par,subseq in subseqs]
 
-    def sim_motions_iter(self, objids):
+    def sim_motions_iter(self, objids, batch_size=256):
         """
         Returns a dict of UUID -> [list, of, motion, paths], where the
         MotionPaths have all been converted to sim coordinates,
@@ -611,7 +804,36 @@ class ObjectPathTrace:
         Note that due to ordering, this may not give perfect results.
         This method assumes that fill_parents() has already been
         called, and any missing parents are ignored.
-        """
+
+        If the trace has a cache, results already cached by
+        sim_motions() for the same objects are loaded from it.
+        Otherwise objects are computed and cached in batches of
+        batch_size, so only one batch is held in memory at a time.
+        """
+        objids = list(objids)
+        if not self._caching(): return self._sim_motions_iter(objids)
+        return self._cached_sim_motions_iter(objids, batch_size)
+
+    def _cached_sim_motions_iter(self, objids, batch_size):
+        found, results = self._cache.get(self._method_key('sim_motions', objids))
+        if found:
+            for objid in objids:
+                yield (objid, results[objid])
+            return
+
+        path_seqs = None
+        for start in range(0, len(objids), batch_size):
+            batch = objids[start:start+batch_size]
+            key = self._method_key('sim_motions_batch', batch)
+            found, batch_results = self._cache.get(key)
+            if not found:
+                if path_seqs is None: path_seqs = self._sim_path_seqs()
+                batch_results = list(self._sim_motions_iter(batch, path_seqs))
+                self._cache.put(key, batch_results)
+            for item in batch_results:
+                yield item
+
+    def _sim_path_seqs(self):
         # We use the list of parent,motion lists for each object to
         # bootstrap. Generate but *don't* squeeze since a relative
         # position that is constant may turn into a varying
@@ -619,7 +841,10 @@ class ObjectPathTrace:
         # FIXME This could be more efficient by computing only the
         # parents, grandparents, etc that are required for the
         # specified object set instead of using self.objects()
-        path_seqs = self.motion_sequences_with_parents(self.objects())
+        return self.motion_sequences_with_parents(self.objects())
+
+    def _sim_motions_iter(self, objids, path_seqs=None):
+        if path_seqs is None: path_seqs = self._sim_path_seqs()
 
         # Returns (parent,motion_path) for the specified object and
         # time, i.e. gets the subsequence at the appropriate time.
@@ -663,26 +888,103 @@ class ObjectPathTrace:
                 obj_result.append( newmot )
             yield (objid,obj_result)
 
+    @_cached
     def sim_motions(self, objids):
         results = {}
-        for objid,obj_result in self.sim_motions_iter(objids):
+        for objid,obj_result in self._sim_motions_iter(objids):
             results[objid] = obj_result
         return results
 
-def main():
-    if len(sys.argv) < 2:
-        print "Specify a file."
-        return -1
+    @_cached
+    def squeezed_sim_motions(self, objids, fudge=0.0):
+        """
+        Like sim_motions(), but each MotionPath has been squeezed (see
+        MotionPath.squeeze) with the given fudge.
+        """
+        results = self.sim_motions(objids)
+        for mots in results.values():
+            for mot in mots: mot.squeeze(fudge=fudge)
+        return results
 
-    trace = ObjectPathTrace(sys.argv[1])
-    trace.fill_parents(report=True)
+    def motion_pyramid(self, objids, tolerances=DEFAULT_TOLERANCES, fudge=.05):
+        """
+        Returns a motion_pyramid.MotionPyramid of the squeezed sim
+        motions (see squeezed_sim_motions) of objids, simplified with
+        each of tolerances.  If this trace has a cache, each level is
+        stored in it separately and only loaded when it is used.
+        """
+        def build():
+            return build_levels(self.squeezed_sim_motions(objids, fudge=fudge), tolerances)
+        if not self._caching(): return MotionPyramid(tolerances, levels=build())
+        key = self._cache.key(self._cache_source(), self._filled_parents, 'motion_pyramid',
+                              _cache_arg(objids), tuple(tolerances), fudge)
+        return cached_pyramid(self._cache, key, tolerances, build)
+
+    def resampled_sim_motions_iter(self, objids, interval, start_time=None, end_time=None, batch_size=256):
+        """
+        Like sim_motions_iter(), but each MotionPath is resampled at a
+        fixed interval (see motion_path.resample_paths), restricted to
+        [start_time, end_time] if specified.  Paths with no samples in
+        that range are dropped.  Objects are resampled in batches of
+        batch_size so interpolation is vectorized while memory stays
+        bounded for long traces.
+        """
+        def flush(batch):
+            paths = [mot for objid,mots in batch for mot in mots]
+            resampled = iter(resample_paths(paths, interval, start_time, end_time))
+            for objid,mots in batch:
+                new_mots = [resampled.next() for mot in mots]
+                yield (objid, [mot for mot in new_mots if mot is not None])
+
+        batch = []
+        for objid,mots in self.sim_motions_iter(objids):
+            batch.append( (objid,mots) )
+            if len(batch) >= batch_size:
+                for result in flush(batch): yield result
+                batch = []
+        for result in flush(batch): yield result
+
+# Traces shared by the analyses run in one process, by trace file and
+# the options which affect their contents (see share_traces)
+_shared_traces = None
+
+def share_traces(enabled=True):
+    """
+    Enables or disables sharing of traces loaded with load_trace(),
+    e.g. so several analyses run by sltrace_analyze.py's batch mode
+    load a trace only once.
+    """
+    global _shared_traces
+    if enabled:
+        if _shared_traces is None: _shared_traces = {}
+    else:
+        _shared_traces = None
 
-    print "Trace file:", sys.argv[1]
-    print "Number of objects:", len(trace.objects())
-    print "Number of avatars:", len(trace.avatars())
-    print "Number of root objects:", len(trace.roots())
+def load_trace(trace_file, event_types=None, ids=None, time_range=None, start_time=None, **kwargs):
+    """
+    Returns an ObjectPathTrace for trace_file, constructed with the
+    given arguments.  If sharing is enabled (see share_traces), the
+    trace is loaded with all event types, regardless of event_types, and
+    returned to every caller asking for the same trace_file, ids,
+    time_range and start_time, with the same cache directory and
+    processes (see ObjectPathTrace).
+    """
+    if _shared_traces is None:
+        return ObjectPathTrace(trace_file, event_types=event_types, ids=ids,
+                               time_range=time_range, start_time=start_time, **kwargs)
+    cache = kwargs.get('cache')
+    key = (trace_file, ids and tuple(sorted(ids)), time_range, start_time,
+           cache and cache.directory, kwargs.get('processes'))
+    if key not in _shared_traces:
+        _shared_traces[key] = ObjectPathTrace(trace_file, ids=ids, time_range=time_range,
+                                              start_time=start_time, **kwargs)
+    return _shared_traces[key]
 
-    return 0
+def main():
+    # Summary statistics are computed by a single streaming pass
+    # rather than by loading the trace
+    import trace_stats
+    return trace_stats.main(sys.argv[1:])
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# packet_trace.py capture_file [--json] [--interval=seconds]
+#
+# Reads a binary packet capture written by sltrace's raw-packet tracer
+# (see RawPacketTracer.cs for the format) and reports per packet type
+# counts, rates and bandwidth, bandwidth per sim, and how much of the
+# traffic is object updates.
+#
+# The capture is streamed in chunks and each chunk is aggregated with
+# numpy, so memory use doesn't depend on the length of the capture.
+#
+# --interval additionally prints a time series of packets and bytes
+# (total and object updates) per interval, in seconds since the start
+# of the capture, for correlating network load with object path traces.
+# --json prints the summary as JSON instead of a report.
+
+import sys
+import struct
+try:
+    import simplejson as json
+except:
+    import json
+
+MAGIC = 'SLPK'
+VERSION = 1
+FLAG_PAYLOAD = 0x01
+
+_SIM_RECORD = 1
+_TYPE_RECORD = 2
+_PACKET_RECORD = 3
+
+_HEADER = struct.Struct('<4sHBq')
+_DEFINITION = struct.Struct('<HH') # index, name length
+_PACKET = struct.Struct('<HHqI') # sim, type, time (us), length
+
+_READ_SIZE = 1 << 20
+
+# Packet types carrying object state, i.e. the traffic behind the events
+# in object path traces
+OBJECT_UPDATE_TYPES = ('ObjectUpdate', 'ObjectUpdateCompressed', 'ObjectUpdateCached',
+                       'ImprovedTerseObjectUpdate', 'KillObject',
+                       'ObjectProperties', 'ObjectPropertiesFamily')
+
+class _Buffer:
+    """Reads a file in large blocks, keeping unconsumed data around."""
+    def __init__(self, fp):
+        self._fp = fp
+        self.data = ''
+        self.pos = 0
+
+    def need(self, nbytes):
+        """
+        Ensures nbytes are available from pos, returning False if the
+        file ends first.
+        """
+        while len(self.data) - self.pos < nbytes:
+            more = self._fp.read(max(_READ_SIZE, nbytes))
+            if not more: return False
+            self.data = self.data[self.pos:] + more
+            self.pos = 0
+        return True
+
+class PacketCapture:
+    """
+    PacketCapture streams the records in a packet capture.  Sim and
+    packet type names are available in sims and types, indexed as in
+    the records, once the records defining them have been read.
+    """
+
+    def __init__(self, capture_file):
+        self._fp = open(capture_file, 'rb')
+        header = self._fp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError('%s is not a packet capture' % capture_file)
+        magic, version, flags, start_us = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %d packet capture' % (capture_file, VERSION))
+        self.has_payload = bool(flags & FLAG_PAYLOAD)
+        self.start = start_us / 1000000.0 # unix time
+        self.sims = []
+        self.types = []
+
+    def close(self):
+        self._fp.close()
+
+    def packets(self, payloads=False):
+        """
+        Generates (time, sim index, type index, length, payload) for each
+        packet, where time is in seconds since the start of the capture
+        and payload is None unless payloads is True and the capture
+        includes them.  A truncated final record is ignored.
+        """
+        buf = _Buffer(self._fp)
+        while buf.need(1):
+            kind = ord(buf.data[buf.pos])
+            buf.pos += 1
+            if kind == _PACKET_RECORD:
+                if not buf.need(_PACKET.size): return
+                sim, ptype, time_us, length = _PACKET.unpack_from(buf.data, buf.pos)
+                buf.pos += _PACKET.size
+                payload = None
+                if self.has_payload:
+                    if not buf.need(length): return
+                    if payloads: payload = buf.data[buf.pos:buf.pos+length]
+                    buf.pos += length
+                yield (time_us / 1000000.0, sim, ptype, length, payload)
+            elif kind == _SIM_RECORD or kind == _TYPE_RECORD:
+                if not buf.need(_DEFINITION.size): return
+                idx, name_len = _DEFINITION.unpack_from(buf.data, buf.pos)
+                buf.pos += _DEFINITION.size
+                if not buf.need(name_len): return
+                name = buf.data[buf.pos:buf.pos+name_len].decode('utf-8')
+                buf.pos += name_len
+                names = self.sims
+                if kind == _TYPE_RECORD: names = self.types
+                assert idx == len(names)
+                names.append(name)
+            else:
+                raise ValueError('Corrupt packet capture: unknown record type %d' % kind)
+
+    def chunks(self, chunk_size=1 << 16):
+        """
+        Generates the packets in chunks of up to chunk_size packets, each
+        as a tuple of numpy arrays (times, sims, types, lengths).
+        """
+        chunk = []
+        for time,sim,ptype,length,payload in self.packets():
+            chunk.append( (time, sim, ptype, length) )
+            if len(chunk) >= chunk_size:
+                yield _chunk_arrays(chunk)
+                chunk = []
+        if chunk:
+            yield _chunk_arrays(chunk)
+
+def _chunk_arrays(chunk):
+    import numpy
+    times, sims, types, lengths = zip(*chunk)
+    return (numpy.array(times, dtype=float), numpy.array(sims, dtype=numpy.intp),
+            numpy.array(types, dtype=numpy.intp), numpy.array(lengths, dtype=float))
+
+def _add_counts(totals, idx, weights=None):
+    """Adds bincount(idx, weights) to totals, growing totals if needed."""
+    import numpy
+    counts = numpy.bincount(idx, weights=weights)
+    if len(counts) > len(totals):
+        totals = numpy.concatenate([totals, numpy.zeros(len(counts) - len(totals))])
+    totals[:len(counts)] += counts
+    return totals
+
+class PacketStats:
+    """
+    PacketStats aggregates a packet capture chunk by chunk.  Per second
+    totals are kept for each sim so peak bandwidth can be found, and per
+    interval totals if an interval is given.
+    """
+
+    def __init__(self, capture_file, interval=None):
+        import numpy
+        self.capture_file = capture_file
+        self.interval = interval
+        self._capture = PacketCapture(capture_file)
+        zeros = numpy.zeros(0)
+        self._type_packets = zeros
+        self._type_bytes = zeros
+        self._sim_packets = zeros
+        self._sim_bytes = zeros
+        self._sim_second_bytes = [] # per sim, bytes in each second
+        self._series = [zeros, zeros, zeros, zeros] # packets, bytes, object update packets/bytes
+        self._duration = 0.0
+
+    def run(self):
+        import numpy
+        capture = self._capture
+        for times, sims, types, lengths in capture.chunks():
+            self._type_packets = _add_counts(self._type_packets, types)
+            self._type_bytes = _add_counts(self._type_bytes, types, lengths)
+            self._sim_packets = _add_counts(self._sim_packets, sims)
+            self._sim_bytes = _add_counts(self._sim_bytes, sims, lengths)
+
+            seconds = times.astype(numpy.intp)
+            while len(self._sim_second_bytes) < len(capture.sims):
+                self._sim_second_bytes.append(numpy.zeros(0))
+            for sim in numpy.unique(sims):
+                mask = (sims == sim)
+                self._sim_second_bytes[sim] = _add_counts(self._sim_second_bytes[sim],
+                                                          seconds[mask], lengths[mask])
+
+            if self.interval is not None:
+                buckets = (times / self.interval).astype(numpy.intp)
+                object_types = [idx for idx,name in enumerate(capture.types)
+                                if name in OBJECT_UPDATE_TYPES]
+                is_object = numpy.in1d(types, object_types)
+                self._series[0] = _add_counts(self._series[0], buckets)
+                self._series[1] = _add_counts(self._series[1], buckets, lengths)
+                self._series[2] = _add_counts(self._series[2], buckets[is_object])
+                self._series[3] = _add_counts(self._series[3], buckets[is_object], lengths[is_object])
+
+            self._duration = max(self._duration, times[-1])
+        capture.close()
+        return self
+
+    def summary(self):
+        capture = self._capture
+        duration = self._duration
+        def rate(val):
+            if duration <= 0: return 0.0
+            return val / duration
+
+        total_packets = self._type_packets.sum()
+        total_bytes = self._type_bytes.sum()
+
+        types = {}
+        for idx,name in enumerate(capture.types):
+            if idx >= len(self._type_packets): break
+            types[name] = {
+                'packets' : int(self._type_packets[idx]),
+                'bytes' : int(self._type_bytes[idx]),
+                'packets_per_sec' : rate(self._type_packets[idx]),
+                'bytes_per_sec' : rate(self._type_bytes[idx]),
+                }
+
+        sims = {}
+        for idx,name in enumerate(capture.sims):
+            if idx >= len(self._sim_packets): break
+            per_second = self._sim_second_bytes[idx]
+            sims[name] = {
+                'packets' : int(self._sim_packets[idx]),
+                'bytes' : int(self._sim_bytes[idx]),
+                'bytes_per_sec' : rate(self._sim_bytes[idx]),
+                'peak_bytes_per_sec' : float(per_second.max()) if len(per_second) else 0.0,
+                }
+
+        object_updates = {}
+        for name in OBJECT_UPDATE_TYPES:
+            if name not in types: continue
+            share = 0.0
+            if total_bytes > 0: share = types[name]['bytes'] / float(total_bytes)
+            object_updates[name] = {
+                'packets' : types[name]['packets'],
+                'bytes' : types[name]['bytes'],
+                'byte_share' : share,
+                }
+
+        return {
+            'start' : capture.start,
+            'duration' : duration,
+            'packets' : int(total_packets),
+            'bytes' : int(total_bytes),
+            'types' : types,
+            'sims' : sims,
+            'object_updates' : object_updates,
+            }
+
+    def series(self):
+        """
+        Returns a list of (start time, packets, bytes, object update
+        packets, object update bytes) per interval.
+        """
+        if self.interval is None: return []
+        nbuckets = max([len(col) for col in self._series])
+        cols = [list(col) + [0.0] * (nbuckets - len(col)) for col in self._series]
+        return [(idx * self.interval,) + tuple([int(col[idx]) for col in cols])
+                for idx in range(nbuckets)]
+
+    def report(self, fp=sys.stdout):
+        summ = self.summary()
+        print >>fp, "Capture file:", self.capture_file
+        print >>fp, "Duration: %.3fs" % summ['duration']
+        print >>fp, "Packets: %d (%.1f/s)" % (summ['packets'], summ['packets'] / max(summ['duration'], 1e-9))
+        print >>fp, "Bytes: %d (%.1f KB/s)" % (summ['bytes'], summ['bytes'] / max(summ['duration'], 1e-9) / 1024.0)
+
+        print >>fp
+        print >>fp, "%-32s %10s %10s %12s %10s" % ('Type', 'Packets', 'Pkts/s', 'Bytes', 'KB/s')
+        by_bytes = sorted(summ['types'].items(), key=lambda item: item[1]['bytes'], reverse=True)
+        for name,info in by_bytes:
+            print >>fp, "%-32s %10d %10.2f %12d %10.2f" % (name, info['packets'], info['packets_per_sec'],
+                                                         info['bytes'], info['bytes_per_sec'] / 1024.0)
+
+        print >>fp
+        print >>fp, "%-32s %10s %12s %10s %10s" % ('Sim', 'Packets', 'Bytes', 'KB/s', 'Peak KB/s')
+        for name,info in sorted(summ['sims'].items()):
+            print >>fp, "%-32s %10d %12d %10.2f %10.2f" % (name, info['packets'], info['bytes'],
+                                                         info['bytes_per_sec'] / 1024.0,
+                                                         info['peak_bytes_per_sec'] / 1024.0)
+
+        print >>fp
+        print >>fp, "%-32s %10s %12s %10s" % ('Object update type', 'Packets', 'Bytes', '% bytes')
+        for name,info in sorted(summ['object_updates'].items()):
+            print >>fp, "%-32s %10d %12d %10.2f" % (name, info['packets'], info['bytes'],
+                                                   info['byte_share'] * 100.0)
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    as_json = False
+    interval = None
+    args = []
+    for arg in argv:
+        if arg == '--json':
+            as_json = True
+        elif arg.startswith('--interval='):
+            interval = float(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
+
+    if len(args) < 1:
+        print "Usage: packet_trace.py capture_file [--json] [--interval=seconds]"
+        return -1
+
+    stats = PacketStats(args[0], interval=interval).run()
+    if as_json:
+        summ = stats.summary()
+        if interval is not None: summ['series'] = stats.series()
+        print json.dumps(summ, indent=2)
+        return 0
+
+    stats.report()
+    if interval is not None:
+        print
+        print "# time packets bytes object_update_packets object_update_bytes"
+        for row in stats.series():
+            print "%.3f %d %d %d %d" % row
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# proximity.py trace_file [--distance=d | --bounds] [--interval=seconds]
+#              [--cache=dir]
+#
+# Finds pairs of objects which are near each other over the course of
+# a trace, printing an event each time a pair comes into or goes out
+# of range:
+#
+#   time enter|exit objid1 objid2
+#
+# With --distance (default 10m) pairs are in range when their centers
+# are within distance d. With --bounds they are in range when their
+# aggregate bounding boxes (ObjectPathTrace.aggregate_sizes) overlap.
+# Positions of root objects are sampled every --interval seconds
+# (default 1).  --cache caches paths extracted from the trace (see
+# trace_cache.py).
+#
+# Pairs are found with sweep-and-prune: boxes are kept sorted along
+# the x axis between samples, so since objects move only a little
+# between samples re-sorting is nearly linear, and only boxes which
+# overlap on x are checked on the other axes.
+
+import sys
+import math
+import vec3
+from motion_path import resample_paths
+from object_path import load_trace
+from trace_cache import open_cache
+
+class SweepAndPrune:
+    """
+    SweepAndPrune finds overlapping pairs among a set of axis aligned
+    boxes which are updated over time, exploiting temporal coherence
+    by keeping the boxes sorted along the x axis between updates.
+    """
+
+    def __init__(self):
+        self._order = [] # ids, sorted by box min x as of the last update
+
+    def update(self, boxes):
+        """
+        Updates the set of boxes, given as a dict of id ->
+        (min_vec3, max_vec3), and returns the set of overlapping pairs
+        as (id1, id2) tuples with id1 < id2.
+        """
+        # Keep the previous order for ids still present and append new
+        # ones, then re-sort.  The sort is nearly linear when the order
+        # has barely changed, and unlike an insertion sort isn't
+        # quadratic when many new ids arrive at once.
+        order = [objid for objid in self._order if objid in boxes]
+        present = set(order)
+        order.extend([objid for objid in boxes if objid not in present])
+        order.sort(key=lambda objid: boxes[objid][0][0])
+        self._order = order
+
+        # Sweep along x, checking y and z only for overlaps on x
+        pairs = set()
+        count = len(order)
+        for idx in xrange(count):
+            a = order[idx]
+            a_min, a_max = boxes[a]
+            # Index rather than slice, which would copy the rest of order
+            # for every box
+            for other in xrange(idx+1, count):
+                b = order[other]
+                b_min, b_max = boxes[b]
+                if b_min[0] > a_max[0]: break
+                if (b_min[1] <= a_max[1] and a_min[1] <= b_max[1] and
+                    b_min[2] <= a_max[2] and a_min[2] <= b_max[2]):
+                    if a < b: pairs.add( (a, b) )
+                    else: pairs.add( (b, a) )
+        return pairs
+
+class ProximityTracker:
+    """
+    ProximityTracker consumes object positions one sample time at a
+    time and reports pairs of objects entering and leaving range.
+    """
+
+    def __init__(self, distance=None, sizes=None):
+        """
+        Exactly one of distance or sizes should be specified.
+
+        Keyword arguments:
+        distance -- pairs are in range when within this distance
+        sizes -- dict of id -> (bbox_min, bbox_max) relative to the
+                 object's position; pairs are in range when their
+                 boxes overlap. Objects without a size are points.
+        """
+        assert (distance is None) != (sizes is None)
+        self.distance = distance
+        self.sizes = sizes
+        self._sap = SweepAndPrune()
+        self._pairs = set()
+
+    def _boxes(self, positions):
+        boxes = {}
+        if self.distance is not None:
+            # boxes overlap when centers are within distance on every axis
+            half = (self.distance*0.5, self.distance*0.5, self.distance*0.5)
+            for objid,pos in positions.items():
+                boxes[objid] = (vec3.sub(pos, half), vec3.add(pos, half))
+        else:
+            for objid,pos in positions.items():
+                bbox = self.sizes.get(objid, ((0.0,0.0,0.0), (0.0,0.0,0.0)))
+                boxes[objid] = (vec3.add(pos, bbox[0]), vec3.add(pos, bbox[1]))
+        return boxes
+
+    def update(self, t, positions):
+        """
+        Processes the positions (a dict of id -> vec3) at time t,
+        returning a list of (t, 'enter'|'exit', id1, id2) events.
+        """
+        pairs = self._sap.update(self._boxes(positions))
+        if self.distance is not None:
+            dist2 = self.distance*self.distance
+            pairs = set([(a,b) for a,b in pairs
+                         if vec3.dist2(positions[a], positions[b]) <= dist2])
+
+        events = [(t, 'exit', a, b) for a,b in sorted(self._pairs - pairs)]
+        events.extend([(t, 'enter', a, b) for a,b in sorted(pairs - self._pairs)])
+        self._pairs = pairs
+        return events
+
+    def finish(self, t):
+        """Reports all remaining pairs as exiting at time t."""
+        events = [(t, 'exit', a, b) for a,b in sorted(self._pairs)]
+        self._pairs = set()
+        return events
+
+def sampled_positions_iter(trace, objids, interval, window=60.0):
+    """
+    Generates (t, {objid -> pos}) for each multiple of interval over
+    the trace, with sim-coordinate positions for each of the specified
+    objects present at that time.  Paths are resampled window seconds
+    at a time, so only one window of samples is held in memory; the
+    paths themselves are all loaded up front.
+    """
+    paths = [(objid, mot)
+             for objid,mots in trace.sim_motions_iter(objids)
+             for mot in mots]
+    if not paths: return
+    # The sort is stable, so an object's paths stay in order and later
+    # ones still win when they overlap
+    paths.sort(key=lambda item: item[1].start_time())
+
+    start = paths[0][1].start_time()
+    end = max([mot.end_time() for objid,mot in paths])
+    # Align windows with sample times so none fall between windows
+    start = math.floor(start / interval) * interval
+    window = max(1, round(window / interval)) * interval
+
+    # Paths overlapping the current window: those starting before its
+    # end are added in start order, and those ending before its start
+    # dropped, so each window only looks at the paths near it
+    active = []
+    next_path = 0
+    window_start = start
+    while window_start <= end:
+        # Avoid sampling the time at the boundary twice
+        window_end = window_start + window - interval*0.5
+        while next_path < len(paths) and paths[next_path][1].start_time() <= window_end:
+            active.append(paths[next_path])
+            next_path += 1
+        active = [(objid, mot) for objid,mot in active if mot.end_time() >= window_start]
+        resampled = resample_paths([mot for objid,mot in active], interval,
+                                   window_start, window_end)
+
+        frames = {}
+        for (objid,mot),sampled in zip(active, resampled):
+            if sampled is None: continue
+            for t,pos in sampled:
+                frames.setdefault(t, {})[objid] = pos
+        for t in sorted(frames.keys()):
+            yield (t, frames[t])
+
+        window_start += window
+
+def proximity_events_iter(trace, interval=1.0, distance=None, bounds=False):
+    """
+    Generates (t, 'enter'|'exit', id1, id2) events for pairs of root
+    objects in the trace coming into and going out of range.  See
+    ProximityTracker for the meaning of distance and bounds.
+    """
+    trace.fill_parents()
+    roots = trace.roots()
+    sizes = None
+    if bounds: sizes = trace.aggregate_sizes()
+    tracker = ProximityTracker(distance=distance, sizes=sizes)
+
+    last_t = None
+    for t,positions in sampled_positions_iter(trace, roots, interval):
+        for evt in tracker.update(t, positions):
+            yield evt
+        last_t = t
+    if last_t is not None:
+        for evt in tracker.finish(last_t): yield evt
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    distance = None
+    bounds = False
+    interval = 1.0
+    cache_dir = None
+    args = []
+    for arg in argv:
+        if arg.startswith('--distance='):
+            distance = float(arg.split('=', 1)[1])
+        elif arg == '--bounds':
+            bounds = True
+        elif arg.startswith('--interval='):
+            interval = float(arg.split('=', 1)[1])
+        elif arg.startswith('--cache='):
+            cache_dir = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+
+    if len(args) < 1:
+        print "Specify a file."
+        return -1
+    if bounds and distance is not None:
+        print "Specify only one of --distance and --bounds."
+        return -1
+    if not bounds and distance is None:
+        distance = 10.0
+
+    trace = load_trace(args[0], event_types=['add', 'kill', 'loc', 'size'],
+                       cache=open_cache(cache_dir))
+    for t,kind,a,b in proximity_events_iter(trace, interval, distance, bounds):
+        print "%f %s %s %s" % (t, kind, a, b)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
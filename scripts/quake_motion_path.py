@@ -1,19 +1,43 @@
 #!/usr/bin/python
 
 # quake_motion_path.py input_trace_file [output_filename] [xoff] [yoff]
+#                      [--simplify=tolerance] [--resample=interval]
+#                      [--processes=N] [--archive=file] [--archive-error=d]
+#                      [--cache=dir]
 #
 # Generates a motion path file in the same format as the Quake motion
 # path files used in CBR. You may optionally specify the output
 # filename and a fixed x and y offset Each motion path is stored in a
 # file named by the object UUID, stored in the specified output
 # directory, or the current working directory if one isn't specified.
+#
+# --simplify removes waypoints which can be reconstructed by
+# interpolation to within the given distance (see
+# MotionPath.simplify), shrinking the output for objects moving
+# linearly or smoothly.
+#
+# --resample outputs positions at a fixed interval (in seconds) rather
+# than at the raw update times, for simulations which want motion at a
+# fixed tick rate.  Resampled paths are not squeezed or simplified.
+#
+# --processes decodes the trace file in parallel using N processes.
+#
+# --archive additionally stores the (unoffset) paths in a compact
+# motion archive (see motion_archive.py), with positions accurate to
+# within --archive-error (default 0.01).
+#
+# --cache stores the extracted paths in a trace_cache.TraceCache in the
+# given directory (default $SLTRACE_CACHE_DIR), so later runs on the
+# same trace skip extracting them.
 
 import sys
 import os, os.path
 import math
 import vec3
 from motion_path import MotionPath
-from object_path import ObjectPathTrace
+from motion_archive import ArchiveWriter
+from object_path import load_trace
+from trace_cache import open_cache
 from util.progress_bar import ProgressBar
 
 def _get_option_or_default(args, idx, default):
@@ -21,18 +45,53 @@ def _get_option_or_default(args, idx, default):
         return default
     return args[idx]
 
+def _split_options(args):
+    """
+    Splits --name=value options out of args, returning the remaining
+    positional arguments and a dict of name -> value.
+    """
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
 def generate_quake_motion_path(args):
+    args, options = _split_options(args)
+    simplify_tolerance = None
+    if 'simplify' in options:
+        simplify_tolerance = float(options['simplify'])
+    resample_interval = None
+    if 'resample' in options:
+        resample_interval = float(options['resample'])
+    processes = None
+    if 'processes' in options:
+        processes = int(options['processes'])
+    archive_filename = options.get('archive')
+    archive_error = float(options.get('archive-error', 0.01))
+    cache = open_cache(options.get('cache'))
+
     trace_file = args[0]      #input trace file
     output_filename = _get_option_or_default(args, 1, 'quake.txt')
     xoffset = int(_get_option_or_default(args, 2, 0)) # uniform x translation
     yoffset = int(_get_option_or_default(args, 3, 0)) # uniform y translation
 
-    trace = ObjectPathTrace(trace_file)
+    # Only these events are needed; skipping the rest (most notably
+    # properties) while parsing makes loading much faster
+    trace = load_trace(trace_file, event_types=['add', 'kill', 'loc', 'size'],
+                       processes=processes, cache=cache)
     trace.fill_parents(report=True)
-    pb = ProgressBar(len(trace.roots()))
+    pb = ProgressBar(len(trace.roots()), label='quake')
     obj_sizes = trace.aggregate_sizes()
 
     fout = open(output_filename,'w')
+    archive = None
+    if archive_filename:
+        archive = ArchiveWriter(archive_filename, error=archive_error, start=trace._start_time)
 
     trace_subsets = trace.clusters()
     subtraces = trace.subset_traces(trace_subsets)
@@ -41,8 +100,15 @@ def generate_quake_motion_path(args):
     for subtrace in subtraces:
         subtrace_roots = subtrace.roots()
 
-        for objid,mots in subtrace.sim_motions_iter(subtrace_roots):
-            # above the actual output to ensure it gets updated
+        if resample_interval is not None:
+            motions_iter = subtrace.resampled_sim_motions_iter(subtrace_roots, resample_interval)
+        else:
+            squeezed = subtrace.squeezed_sim_motions(subtrace_roots, fudge=.05)
+            motions_iter = [(objid, squeezed[objid]) for objid in subtrace_roots]
+
+        for objid,mots in motions_iter:
+            # above the actual output to ensure it gets updated. Redraws
+            # are rate limited, so this is cheap.
             obj_count += 1
             pb.update(obj_count)
             pb.report()
@@ -50,7 +116,8 @@ def generate_quake_motion_path(args):
             idx = 0
             for mot in mots:
                 num_updates = sum( [ len(mot) for mot in mots ] )
-                mot.squeeze(fudge=.05)
+                if resample_interval is None and simplify_tolerance is not None:
+                    mot.simplify(simplify_tolerance)
                 #if num_updates <= 1: continue
 
                 for t,pos in mot:
@@ -62,17 +129,23 @@ def generate_quake_motion_path(args):
                     print >>fout, line
                     idx += 1
 
+            if archive is not None:
+                archive.add(objid, mots)
+
     fout.close()
+    if archive is not None:
+        archive.close()
     pb.finish()
 
     return 0
 
-def main():
-    if len(sys.argv) < 2:
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 1:
         print "Input file must be specified."
         return -1
 
-    generate_quake_motion_path(sys.argv[1:])
+    return generate_quake_motion_path(argv)
 
 if __name__ == "__main__":
     sys.exit(main())
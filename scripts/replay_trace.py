@@ -0,0 +1,255 @@
+#!/usr/bin/python
+#
+# replay_trace.py trace_file [--speedup=X] [--output=destination]
+#                 [--report-interval=seconds]
+#
+# Replays the events in an object path trace at the times they were
+# recorded, scaled by a speedup factor (e.g. --speedup=10 replays a 1
+# hour trace in 6 minutes), for load testing code which consumes
+# trace events live.  Each event is written as a single line of JSON.
+# trace_file may also name a segmented trace (see
+# trace_events.segment_filenames).
+#
+# --output specifies where events are sent:
+#   -                  stdout (the default)
+#   unix:/path         a local (unix domain) stream socket
+#   tcp:host:port      a TCP socket
+#   anything else      a file
+# From Python, TraceReplayer also accepts a callback.
+#
+# Events are passed through as they appear in the trace rather than
+# being decoded and re-encoded, and the clock is only consulted when
+# an event isn't already due, so replay can sustain very high event
+# rates.  Lag behind the schedule is reported to stderr every
+# --report-interval seconds (default 5) and when the replay finishes.
+
+import sys
+import time
+import socket
+import itertools
+try:
+    import simplejson as json
+except:
+    import json
+from trace_events import iter_record_texts, iter_trace_events, record_time, segment_filenames
+from trace_events import has_record_layout, is_context_record
+
+# Maximum number of events emitted between clock reads when running
+# behind schedule, bounding how stale lag measurements can be
+_CLOCK_CHECK_EVENTS = 256
+
+# Events emitted more than this long after they were due are late
+LATE_THRESHOLD = 0.001
+
+class _StreamSink:
+    """Writes one event per line to a file-like object."""
+    def __init__(self, fp, close=False):
+        self._fp = fp
+        self._close = close
+
+    def __call__(self, line):
+        self._fp.write(line)
+        self._fp.write('\n')
+
+    def finish(self):
+        self._fp.flush()
+        if self._close: self._fp.close()
+
+def make_sink(destination):
+    """
+    Creates a sink for the given --output destination (see above).
+    Sinks are callables accepting a line of JSON text.
+    """
+    if destination == '-':
+        return _StreamSink(sys.stdout)
+    if destination.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(destination[len('unix:'):])
+        return _StreamSink(sock.makefile('w', 1 << 16), close=True)
+    if destination.startswith('tcp:'):
+        host, port = destination[len('tcp:'):].rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+        return _StreamSink(sock.makefile('w', 1 << 16), close=True)
+    return _StreamSink(open(destination, 'w', 1 << 16), close=True)
+
+class TraceReplayer:
+    """
+    TraceReplayer re-emits the events of a trace at their recorded
+    times divided by speedup.  Events without a relative time (e.g.
+    'started' and 'properties') are emitted along with the preceding
+    event.  Events which arrive out of order, or while replay is
+    running behind, are emitted immediately and counted as lag.
+    """
+
+    def __init__(self, trace_file, speedup=1.0, sink=None, decode=False,
+                 report_interval=None, report_fp=None):
+        """
+        Keyword arguments:
+        speedup -- factor to speed up replay by (default 1.0)
+        sink -- callable receiving each event (default: stdout)
+        decode -- if True, the sink receives decoded event dicts
+                  instead of lines of JSON text (default False)
+        report_interval -- if specified, report progress and lag every
+                           report_interval seconds (default None)
+        report_fp -- where reports are written (default stderr)
+        """
+        self.trace_file = trace_file
+        self.speedup = float(speedup)
+        self.sink = sink or make_sink('-')
+        self.decode = decode
+        self.report_interval = report_interval
+        self.report_fp = report_fp or sys.stderr
+
+        self.events = 0
+        self.late_events = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def _timed_events(self):
+        """
+        Generates (trace time in seconds or None, event) pairs, where
+        events are either lines of JSON text or decoded dicts.  The
+        segments of a segmented trace are replayed in order, skipping
+        the context events at the start of each segment after the
+        first, as iter_trace_events does.
+        """
+        segments = segment_filenames(self.trace_file)
+        for segment in segments:
+            if has_record_layout(segment): continue
+            # Not in the sltrace layout, fall back to decoding
+            for evt in iter_trace_events(self.trace_file):
+                t = None
+                if evt.get('time', '').endswith('ms'):
+                    t = float(evt['time'][:-2]) / 1000.0
+                if not self.decode: evt = json.dumps(evt)
+                yield (t, evt)
+            return
+
+        for idx,segment in enumerate(segments):
+            fp = open(segment)
+            try:
+                for item in self._segment_events(iter_record_texts(fp), skip_context=(idx > 0)):
+                    yield item
+            finally:
+                fp.close()
+
+    def _segment_events(self, texts, skip_context):
+        if skip_context:
+            texts = itertools.ifilter(lambda text: not is_context_record(text), texts)
+
+        if self.decode:
+            for text in texts:
+                try:
+                    evt = json.loads(text)
+                except ValueError:
+                    return # truncated segment
+                yield (record_time(text), evt)
+            return
+
+        # Every record but the last is followed by a separator, so
+        # only the last can be truncated and needs decoding to check
+        last = None
+        for text in texts:
+            if last is not None: yield self._raw_event(last)
+            last = text
+        if last is not None:
+            try:
+                json.loads(last)
+            except ValueError:
+                return # truncated segment
+            yield self._raw_event(last)
+
+    def _raw_event(self, text):
+        # newlines only appear between tokens
+        return (record_time(text), text.replace('\n', ''))
+
+    def run(self):
+        """Replays the entire trace, returning the stats() afterwards."""
+        clock = time.time
+        sink = self.sink
+        speedup = self.speedup
+
+        wall_start = clock()
+        now = 0.0 # cached time since wall_start
+        next_report = self.report_interval
+        trace_start = None
+        due = 0.0
+        since_clock = 0
+
+        for t,evt in self._timed_events():
+            if t is not None:
+                if trace_start is None: trace_start = t
+                due = (t - trace_start) / speedup
+
+            if due > now or since_clock >= _CLOCK_CHECK_EVENTS:
+                now = clock() - wall_start
+                since_clock = 0
+                if due > now:
+                    time.sleep(due - now)
+                    now = clock() - wall_start
+            since_clock += 1
+
+            lag = now - due
+            if lag > LATE_THRESHOLD:
+                self.late_events += 1
+                self.total_lag += lag
+                if lag > self.max_lag: self.max_lag = lag
+
+            sink(evt)
+            self.events += 1
+
+            if next_report is not None and now >= next_report:
+                self.report(now, lag)
+                next_report = now + self.report_interval
+
+        if hasattr(sink, 'finish'): sink.finish()
+        self.elapsed = clock() - wall_start
+        return self.stats()
+
+    def stats(self):
+        mean_lag = 0.0
+        if self.events: mean_lag = self.total_lag / self.events
+        return {
+            'events' : self.events,
+            'late_events' : self.late_events,
+            'max_lag' : self.max_lag,
+            'mean_lag' : mean_lag,
+            }
+
+    def report(self, elapsed, lag):
+        rate = 0.0
+        if elapsed > 0: rate = self.events / elapsed
+        print >>self.report_fp, "replay: %.1fs events=%d rate=%.0f/s lag=%.4fs max_lag=%.4fs" % \
+            (elapsed, self.events, rate, max(lag, 0.0), self.max_lag)
+        self.report_fp.flush()
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    speedup = 1.0
+    output = '-'
+    report_interval = 5.0
+    args = []
+    for arg in argv:
+        if arg.startswith('--speedup='):
+            speedup = float(arg.split('=', 1)[1])
+        elif arg.startswith('--output='):
+            output = arg.split('=', 1)[1]
+        elif arg.startswith('--report-interval='):
+            report_interval = float(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
+
+    if len(args) < 1 or speedup <= 0:
+        print "Usage: replay_trace.py trace_file [--speedup=X] [--output=destination]"
+        return -1
+
+    replayer = TraceReplayer(args[0], speedup=speedup, sink=make_sink(output),
+                             report_interval=report_interval)
+    stats = replayer.run()
+    print >>sys.stderr, "replay: finished in %.2fs, %d events, %d late, mean lag %.4fs, max lag %.4fs" % \
+        (replayer.elapsed, stats['events'], stats['late_events'], stats['mean_lag'], stats['max_lag'])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
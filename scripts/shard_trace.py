@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# shard_trace.py --shards=N [--by=cluster|time] trace_file output_prefix
+#
+# Splits an object path trace into N self-consistent shards, written
+# to output_prefix.0.json ... output_prefix.(N-1).json, each of which
+# can be analyzed independently with ObjectPathTrace.
+#
+# --by=cluster (the default) splits by ObjectPathTrace.clusters(), like
+#   subset_traces() but on disk, so related objects (parents, children
+#   and attachments) always end up in the same shard.  Clusters are
+#   assigned to shards so the number of events in each is balanced.
+#   Since the shards cover disjoint sets of objects, per-object results
+#   can simply be concatenated.
+#
+# --by=time splits the trace into N windows of equal duration.  Each
+#   shard starts with the context required to interpret it on its own:
+#   the 'started' events and the latest add, size, properties and loc
+#   events for every object present at the time the shard begins.
+#   Carried context events keep their original times and are marked
+#   with "context": true so that merged results don't count them twice
+#   (see TraceStats.merge).
+#
+# Both modes make two streaming passes over the trace and never hold
+# more than per-object state in memory.
+
+import sys
+import heapq
+from uuid import UUID
+from object_path import ObjectPathTrace, parse_time
+from trace_events import iter_trace_events, TraceWriter
+
+def _shard_filename(output_prefix, idx):
+    return '%s.%d.json' % (output_prefix, idx)
+
+def shard_by_cluster(trace_file, output_prefix, nshards):
+    """
+    Splits trace_file into nshards shards by object cluster. Returns
+    the list of shard filenames.
+    """
+    # First pass: we only need addition events to compute clusters,
+    # plus the number of events for each object to balance shards.
+    structure = []
+    obj_weights = {}
+    for evt in iter_trace_events(trace_file):
+        if evt['event'] in ('started', 'add'):
+            structure.append(dict(evt))
+        if 'id' in evt:
+            obj_weights[evt['id']] = obj_weights.get(evt['id'], 0) + 1
+
+    clusters = ObjectPathTrace(raw=structure).clusters()
+    del structure
+
+    # Greedily place the heaviest clusters in the lightest shard
+    def cluster_weight(cluster):
+        return sum([obj_weights.get(str(objid), 0) for objid in cluster])
+    weighted = sorted([(cluster_weight(cluster), cluster) for cluster in clusters],
+                      key=lambda x: x[0], reverse=True)
+    shard_loads = [(0, idx) for idx in range(nshards)]
+    obj_shards = {}
+    for weight,cluster in weighted:
+        load, idx = heapq.heappop(shard_loads)
+        for objid in cluster:
+            obj_shards[str(objid)] = idx
+        heapq.heappush(shard_loads, (load + weight, idx))
+
+    # Second pass: route events
+    filenames = [_shard_filename(output_prefix, idx) for idx in range(nshards)]
+    writers = [TraceWriter(filename) for filename in filenames]
+    for evt in iter_trace_events(trace_file):
+        if 'id' not in evt:
+            for writer in writers: writer.write(evt)
+            continue
+        # like subset_traces, drop events for objects never added
+        if evt['id'] not in obj_shards: continue
+        writers[obj_shards[evt['id']]].write(evt)
+
+    for writer in writers: writer.close()
+    return filenames
+
+def shard_by_time(trace_file, output_prefix, nshards):
+    """
+    Splits trace_file into nshards shards covering equal time
+    windows. Returns the list of shard filenames.
+    """
+    # First pass: find the time range
+    min_t, max_t = None, None
+    for evt in iter_trace_events(trace_file):
+        if 'time' not in evt or evt['event'] == 'started': continue
+        t = parse_time(evt['time'])
+        if min_t is None or t < min_t: min_t = t
+        if max_t is None or t > max_t: max_t = t
+    if min_t is None: min_t, max_t = 0.0, 0.0
+    window = (max_t - min_t) / nshards
+
+    def shard_for_time(t):
+        if window <= 0: return 0
+        return min(nshards-1, int((t - min_t) / window))
+
+    # Second pass: route events, tracking the context to carry into
+    # each shard as it is opened
+    started = []
+    context = {} # id -> {event type -> latest event}
+    filenames = [_shard_filename(output_prefix, idx) for idx in range(nshards)]
+    writers = [None] * nshards
+    cur_shard = 0
+
+    def open_shard(idx):
+        writer = TraceWriter(filenames[idx])
+        for evt in started: writer.write(evt)
+        for obj_context in context.values():
+            # only objects which are currently present
+            if 'add' not in obj_context: continue
+            for evt_type in ('add', 'size', 'properties', 'loc'):
+                if evt_type not in obj_context: continue
+                context_evt = dict(obj_context[evt_type])
+                context_evt['context'] = True
+                writer.write(context_evt)
+        writers[idx] = writer
+
+    for evt in iter_trace_events(trace_file):
+        evt_type = evt['event']
+        if evt_type == 'started':
+            started.append(evt)
+            for writer in writers:
+                if writer: writer.write(evt)
+            continue
+
+        if 'time' in evt:
+            cur_shard = shard_for_time(parse_time(evt['time']))
+        if writers[cur_shard] is None: open_shard(cur_shard)
+        writers[cur_shard].write(evt)
+
+        if 'id' not in evt: continue
+        if evt_type == 'kill':
+            context.pop(evt['id'], None)
+        else:
+            context.setdefault(evt['id'], {})[evt_type] = evt
+
+    for idx in range(nshards):
+        if writers[idx] is None: open_shard(idx)
+        writers[idx].close()
+    return filenames
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    nshards = None
+    by = 'cluster'
+    args = []
+    for arg in argv:
+        if arg.startswith('--shards='):
+            nshards = int(arg.split('=', 1)[1])
+        elif arg.startswith('--by='):
+            by = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+
+    if len(args) < 2 or nshards is None or nshards < 1:
+        print "Usage: shard_trace.py --shards=N [--by=cluster|time] trace_file output_prefix"
+        return -1
+    if by not in ('cluster', 'time'):
+        print "Unknown sharding type:", by
+        return -1
+
+    if by == 'cluster':
+        filenames = shard_by_cluster(args[0], args[1], nshards)
+    else:
+        filenames = shard_by_time(args[0], args[1], nshards)
+
+    for filename in filenames:
+        print filename
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
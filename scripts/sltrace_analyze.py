@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#
+# sltrace_analyze.py command [args ...]
+# sltrace_analyze.py batch [--cache=dir] command [args ...] [-- command [args ...] ...]
+#
+# A single entry point for the trace analysis scripts.  Each command
+# runs the main function of the script listed in COMMANDS with the
+# remaining arguments, which are the same as when running the script
+# directly.  A script's module, and whatever heavy modules it uses
+# (numpy, matplotlib), are only imported when its command runs, so
+# startup stays fast.
+#
+# batch runs several commands, separated by --, in one process.  Traces
+# loaded by the commands are shared (see object_path.share_traces), so
+# a pipeline of analyses on the same trace loads it once, and --cache
+# sets the trace cache directory (see trace_cache.py) used by all of
+# them.  A command given its own --cache (or --processes) loads a
+# separate copy of the trace with those options.  Batch mode stops at
+# the first command which fails.
+
+import os
+import sys
+import time
+
+# command -> (module, function, description)
+COMMANDS = {
+    'stats' : ('trace_stats', 'main', 'summary statistics for traces'),
+    'quake' : ('quake_motion_path', 'main', 'export Quake style motion paths'),
+    'graph' : ('graph_motion_paths', 'main', 'graph motion paths or occupancy'),
+    'events' : ('object_events', 'main', 'print the events for one object'),
+    'proximity' : ('proximity', 'main', 'proximity events between objects'),
+    'kinematics' : ('kinematics', 'main', 'speed, acceleration and update statistics'),
+    'pyramid' : ('motion_pyramid', 'main', 'motion pyramid level statistics'),
+    'archive' : ('motion_archive', 'main', 'motion archive statistics'),
+    'merge' : ('merge_traces', 'main', 'merge traces from several bots'),
+    'sort' : ('time_order', 'main', 'sort a trace by time'),
+    'shard' : ('shard_trace', 'main', 'split a trace into shards'),
+    'replay' : ('replay_trace', 'main', 'replay a trace in real time'),
+    'packets' : ('packet_trace', 'main', 'packet capture statistics'),
+    'cache' : ('trace_cache', 'main', 'trace cache status'),
+    }
+
+BATCH_SEPARATOR = '--'
+
+def usage():
+    print "Usage: sltrace_analyze.py command [args ...]"
+    print "       sltrace_analyze.py batch [--cache=dir] command [args ...] [-- command [args ...] ...]"
+    print
+    print "Commands:"
+    for name in sorted(COMMANDS.keys()):
+        print "  %-12s %s" % (name, COMMANDS[name][2])
+    print
+    print "Run a command without arguments for its usage."
+
+def run_command(name, args):
+    """
+    Runs command name with args, importing its module on demand.
+    Returns the command's exit status.
+    """
+    if name not in COMMANDS:
+        print >>sys.stderr, "Unknown command:", name
+        return -1
+    module_name, func_name, desc = COMMANDS[name]
+    module = __import__(module_name)
+    status = getattr(module, func_name)(args)
+    if status is None: status = 0
+    return status
+
+def split_batch(args):
+    """Splits batch arguments into a list of [command, args ...] lists."""
+    commands = [[]]
+    for arg in args:
+        if arg == BATCH_SEPARATOR:
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    return [cmd for cmd in commands if cmd]
+
+def run_batch(args):
+    cache_dir = None
+    while args and args[0].startswith('--cache='):
+        cache_dir = args[0].split('=', 1)[1]
+        args = args[1:]
+    commands = split_batch(args)
+    if not commands:
+        usage()
+        return -1
+
+    # Commands open their caches with trace_cache.open_cache(), which
+    # falls back to the environment
+    if cache_dir: os.environ['SLTRACE_CACHE_DIR'] = cache_dir
+    import object_path
+    object_path.share_traces()
+
+    for cmd in commands:
+        print >>sys.stderr, "==", ' '.join(cmd)
+        start = time.time()
+        status = run_command(cmd[0], cmd[1:])
+        print >>sys.stderr, "== %s finished in %.2fs with status %d" % (cmd[0], time.time() - start, status)
+        if status != 0: return status
+    return 0
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 1 or argv[0] in ('help', '--help', '-h'):
+        usage()
+        return -1
+
+    if argv[0] == 'batch':
+        return run_batch(argv[1:])
+    return run_command(argv[0], argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
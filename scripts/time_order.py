@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# time_order.py input_trace_file output_trace_file [--run-size=N]
+#               [--tmpdir=dir]
+#
+# Sorts the events in a trace by time.  sltrace records events in the
+# order libomv's callbacks run, on several threads, so times in a trace
+# are not strictly increasing, and traces concatenated or merged from
+# several sources are worse.  The rest of the scripts, e.g. MotionPath's
+# interpolation, assume each object's events are in time order.
+#
+# Traces larger than memory are sorted externally: events are read in
+# runs of up to --run-size events (default DEFAULT_RUN_SIZE), each run
+# is sorted and spilled to a temporary file, and the runs are combined
+# with a k-way merge.  The sort is stable, so events with equal times
+# keep their original order, e.g. a kill and re-add in the same
+# millisecond.
+#
+# Events without times (e.g. properties) take the time of the event
+# before them, so they stay with the events they followed, and
+# 'started' events sort before everything else.
+
+import sys
+import heapq
+import tempfile
+try:
+    import cPickle as pickle
+except:
+    import pickle
+from object_path import parse_time
+from trace_events import iter_trace_events, TraceWriter
+
+DEFAULT_RUN_SIZE = 500000
+
+def _keyed_events(events):
+    """
+    Generates (time, seq, event) for events, where seq is the event's
+    index, which breaks ties in favor of the original order.
+    """
+    t = float('-inf')
+    seq = 0
+    for evt in events:
+        if evt['event'] == 'started':
+            key = float('-inf')
+        else:
+            if 'time' in evt: t = parse_time(evt['time'])
+            key = t
+        yield (key, seq, evt)
+        seq += 1
+
+def is_time_ordered(events):
+    """Returns True if events are already in time order."""
+    last = float('-inf')
+    for key,seq,evt in _keyed_events(events):
+        if key < last: return False
+        last = key
+    return True
+
+def time_ordered(events):
+    """
+    Returns a list of events, held in memory, in time order.  Returns
+    events itself if it is already ordered.
+    """
+    if is_time_ordered(events): return events
+    keyed = list(_keyed_events(events))
+    keyed.sort()
+    return [evt for key,seq,evt in keyed]
+
+def _write_run(run, tmpdir):
+    run.sort()
+    fp = tempfile.TemporaryFile(dir=tmpdir)
+    for item in run:
+        pickle.dump(item, fp, pickle.HIGHEST_PROTOCOL)
+    fp.seek(0)
+    return fp
+
+def _read_run(fp):
+    try:
+        while True:
+            yield pickle.load(fp)
+    except EOFError:
+        pass
+    fp.close()
+
+def sort_events(events, run_size=DEFAULT_RUN_SIZE, tmpdir=None):
+    """
+    Generates events, an iterable which may be much larger than memory,
+    in time order.  At most run_size events are held in memory while
+    sorting; larger inputs are spilled to sorted runs in temporary files
+    (in tmpdir, default the system temporary directory) and merged.
+    """
+    run = []
+    runs = []
+    for item in _keyed_events(events):
+        run.append(item)
+        if len(run) >= run_size:
+            runs.append(_write_run(run, tmpdir))
+            run = []
+
+    if not runs:
+        run.sort()
+        for key,seq,evt in run:
+            yield evt
+        return
+
+    if run: runs.append(_write_run(run, tmpdir))
+    for key,seq,evt in heapq.merge(*[_read_run(fp) for fp in runs]):
+        yield evt
+
+def sort_trace(trace_file, output_file, run_size=DEFAULT_RUN_SIZE, tmpdir=None):
+    """
+    Writes the events in trace_file to output_file in time order.
+    Returns the number of events written.
+    """
+    writer = TraceWriter(output_file)
+    for evt in sort_events(iter_trace_events(trace_file), run_size=run_size, tmpdir=tmpdir):
+        writer.write(evt)
+    writer.close()
+    return writer.count
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    run_size = DEFAULT_RUN_SIZE
+    tmpdir = None
+    args = []
+    for arg in argv:
+        if arg.startswith('--run-size='):
+            run_size = int(arg.split('=', 1)[1])
+        elif arg.startswith('--tmpdir='):
+            tmpdir = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+
+    if len(args) < 2:
+        print "Usage: time_order.py input_trace_file output_trace_file [--run-size=N] [--tmpdir=dir]"
+        return -1
+
+    count = sort_trace(args[0], args[1], run_size=run_size, tmpdir=tmpdir)
+    print "Wrote %d events to %s" % (count, args[1])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# trace_cache.py -- a disk-backed cache for results derived from
+# traces, e.g. sim motions, clusters, and aggregate sizes, which are
+# otherwise recomputed identically every time a script runs on the same
+# trace.
+#
+# Results are pickled into files in the cache directory, named by a
+# hash of the trace's content, the method which computed them and its
+# arguments.  Entries are written to a temporary file and renamed into
+# place, so concurrent processes never see partial entries; at worst
+# two processes compute the same result.  Once the cache exceeds its
+# size limit, the least recently used entries, including the cached
+# hashes of trace files (by mtime, which is updated on every hit), are
+# evicted under an exclusive lock.
+#
+# Caching is enabled by passing a TraceCache to ObjectPathTrace, or for
+# all scripts by setting SLTRACE_CACHE_DIR (and optionally
+# SLTRACE_CACHE_MB, the size limit in megabytes).
+
+import os, os.path
+import sys
+import errno
+import fcntl
+import hashlib
+import tempfile
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+_ENTRY_SUFFIX = '.pickle'
+_HASH_SUFFIX = '.hash'
+_LOCK_FILE = 'lock'
+
+class TraceCache:
+    """
+    TraceCache stores pickled results in a directory, keyed by
+    strings generated by key(), evicting the least recently used
+    entries once they take up more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+    def _path(self, key, suffix=_ENTRY_SUFFIX):
+        return os.path.join(self.directory, key + suffix)
+
+    def key(self, *parts):
+        """Returns a cache key for the given (repr-able) parts."""
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def file_hash(self, filename):
+        """
+        Returns a hash of the contents of filename.  Hashes are
+        themselves cached by path, size and modification time, so large
+        traces are only read once.
+        """
+        st = os.stat(filename)
+        stat_key = self.key(os.path.abspath(filename), st.st_size, st.st_mtime)
+        hash_path = self._path(stat_key, _HASH_SUFFIX)
+        try:
+            content_hash = open(hash_path).read()
+        except IOError:
+            pass
+        else:
+            # Hashes are evicted along with entries, so record the use
+            self._touch(hash_path)
+            return content_hash
+
+        digest = hashlib.sha1()
+        fp = open(filename, 'rb')
+        while True:
+            data = fp.read(1 << 20)
+            if not data: break
+            digest.update(data)
+        fp.close()
+        content_hash = digest.hexdigest()
+        self._write(hash_path, content_hash)
+        return content_hash
+
+    def get(self, key):
+        """Returns (True, value) for a cached key, or (False, None)."""
+        path = self._path(key)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            return (False, None)
+        try:
+            try:
+                value = pickle.load(fp)
+            except Exception:
+                # Unreadable, e.g. written by an incompatible version
+                self.misses += 1
+                return (False, None)
+        finally:
+            fp.close()
+
+        self._touch(path)
+        self.hits += 1
+        return (True, value)
+
+    def _touch(self, path):
+        # Record the use for LRU eviction. The file may have just been
+        # evicted by another process, which is harmless.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def put(self, key, value):
+        """Stores value under key, evicting old entries if necessary."""
+        self._write(self._path(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def memoize(self, key, compute):
+        """
+        Returns the value cached under key, or computes it by calling
+        compute() and caches it.
+        """
+        found, value = self.get(key)
+        if found: return value
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def entries(self):
+        """
+        Returns a list of (mtime, size, path) for cached entries,
+        including cached file hashes, which count towards the size
+        limit and are evicted in the same way.
+        """
+        results = []
+        for name in os.listdir(self.directory):
+            if not (name.endswith(_ENTRY_SUFFIX) or name.endswith(_HASH_SUFFIX)): continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            results.append( (st.st_mtime, st.st_size, path) )
+        return results
+
+    def size(self):
+        return sum([size for mtime,size,path in self.entries()])
+
+    def evict(self):
+        """Removes least recently used entries until under max_bytes."""
+        entries = self.entries()
+        total = sum([size for mtime,size,path in entries])
+        if total <= self.max_bytes: return
+
+        lock = open(os.path.join(self.directory, _LOCK_FILE), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have evicted while we waited
+            entries = self.entries()
+            total = sum([size for mtime,size,path in entries])
+            entries.sort()
+            for mtime,size,path in entries:
+                if total <= self.max_bytes: break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def clear(self):
+        for mtime,size,path in self.entries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def open_cache(directory=None, max_bytes=None):
+    """
+    Returns a TraceCache for directory, or, if it isn't specified, for
+    the SLTRACE_CACHE_DIR environment variable.  Returns None if
+    neither is set.
+    """
+    if directory is None:
+        directory = os.environ.get('SLTRACE_CACHE_DIR')
+    if not directory: return None
+    if max_bytes is None:
+        max_mb = os.environ.get('SLTRACE_CACHE_MB')
+        if max_mb: max_bytes = int(float(max_mb) * 1024 * 1024)
+        else: max_bytes = DEFAULT_MAX_BYTES
+    return TraceCache(directory, max_bytes)
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) < 1:
+        print "Usage: trace_cache.py cache_dir [--clear]"
+        return -1
+
+    cache = TraceCache(argv[0])
+    if '--clear' in argv[1:]:
+        cache.clear()
+    entries = cache.entries()
+    print "Cache directory:", cache.directory
+    print "Entries:", len(entries)
+    print "Size:", sum([size for mtime,size,path in entries])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
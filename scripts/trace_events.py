@@ -0,0 +1,406 @@
+#!/usr/bin/python
+#
+# trace_events.py - streaming access to the events stored in a JSON
+# trace generated by sltrace.  A trace is one large JSON array, so
+# json.load() needs the whole file (and every decoded event) in memory
+# at once.  The functions here instead decode one event at a time,
+# keeping memory bounded regardless of the size of the trace.
+#
+# Events can also be filtered by type, object ID and time as they are
+# read.  Filters are checked against the raw text of each event, so
+# events which don't match are skipped without being decoded.
+#
+# A trace written as segments (trace.0.json, trace.1.json, ... for
+# trace.json, see ObjectPathTracer) is read as one logical trace: the
+# segments are read in order and the context events which start each
+# segment after the first are skipped, since they repeat earlier
+# events.
+
+import os
+import re
+try:
+    import simplejson as json
+except:
+    import json
+
+# SLTrace.JSON writes "}\n" at the end of each object and ",\n" before
+# each subsequent array element, and always starts an object with
+# "{\n".  Fields within an object are always written as ' "key" : ...'
+# and strings never contain raw newlines (they are escaped), so this
+# sequence only ever appears between two top-level events.
+RECORD_SEPARATOR = '\n,\n{'
+
+# Some builds of sltrace started traces with a UTF-8 byte order mark,
+# which json rejects, so it's skipped when reading
+_UTF8_BOM = '\xef\xbb\xbf'
+
+_READ_SIZE = 1 << 20
+
+# Keys and string values are always quoted and quotes inside strings
+# are always escaped, so these can't match inside a string value.
+_EVENT_RE = re.compile(r'"event"\s*:\s*"([^"]*)"')
+_ID_RE = re.compile(r'"id"\s*:\s*"([^"]*)"')
+_TIME_RE = re.compile(r'"time"\s*:\s*"([^"]*)ms"')
+_CONTEXT_RE = re.compile(r'"context"\s*:\s*true')
+
+def segment_filenames(trace_file):
+    """
+    Returns the list of files making up trace_file: just trace_file if
+    it exists, otherwise its segments (trace.0.json, trace.1.json, ...
+    for trace.json) in order, if there are any.
+    """
+    if os.path.exists(trace_file): return [trace_file]
+    prefix, ext = os.path.splitext(trace_file)
+    segments = []
+    while True:
+        segment = '%s.%d%s' % (prefix, len(segments), ext)
+        if not os.path.exists(segment): break
+        segments.append(segment)
+    # Leave reporting a missing file to the caller
+    if not segments: return [trace_file]
+    return segments
+
+def iter_record_texts(fp, read_size=_READ_SIZE, end=None):
+    """
+    Iterates over the undecoded JSON text of each top-level event in
+    the trace file fp, reading read_size bytes at a time.  fp must be
+    positioned either at the start of the trace or at the opening
+    brace of an event (see seek_to_record).  If end is specified,
+    iteration stops at the first event starting at or after that byte
+    offset.
+    """
+    at_array_start = (fp.tell() == 0)
+    piece_pos = fp.tell() # file offset of the next piece
+    first = True
+    buf = ''
+    while True:
+        data = fp.read(read_size)
+        if not data: break
+        buf += data
+        pieces = buf.split(RECORD_SEPARATOR)
+        buf = pieces.pop()
+        for piece in pieces:
+            # pieces after the first have lost their opening brace
+            # to the separator
+            if end is not None and piece_pos - (not first) >= end: return
+            piece_pos += len(piece) + len(RECORD_SEPARATOR)
+            yield _record_text(piece, first, at_array_start)
+            first = False
+
+    # The remaining buffer holds the last record and the array closing
+    if end is not None and piece_pos - (not first) >= end: return
+    buf = _record_text(buf, first, at_array_start)
+    buf = buf.rstrip().rstrip(']').rstrip()
+    if buf: yield buf
+
+def _record_text(piece, first, at_array_start):
+    if not first: return '{' + piece
+    # The first record may still have the array opening
+    if at_array_start:
+        if piece.startswith(_UTF8_BOM): piece = piece[len(_UTF8_BOM):]
+        return piece.lstrip().lstrip('[')
+    return piece
+
+def seek_to_record(fp, offset, read_size=_READ_SIZE):
+    """
+    Positions fp at the opening brace of the first event starting at
+    or after the byte offset.  Returns False if there is no such event.
+    """
+    # Start early enough to catch a separator straddling offset
+    pos = max(0, offset - (len(RECORD_SEPARATOR)-1))
+    fp.seek(pos)
+    buf = ''
+    while True:
+        data = fp.read(read_size)
+        if not data: return False
+        buf += data
+        idx = buf.find(RECORD_SEPARATOR)
+        if idx >= 0:
+            fp.seek(pos + idx + len(RECORD_SEPARATOR) - 1)
+            return True
+        # Keep enough to match a separator split across reads
+        keep = len(RECORD_SEPARATOR) - 1
+        pos += len(buf) - keep
+        buf = buf[-keep:]
+
+def record_time(text):
+    """
+    Extracts the time (in seconds since the start of the trace) from
+    the undecoded JSON text of an event, or None if it doesn't have
+    one.
+    """
+    match = _TIME_RE.search(text)
+    if match is None: return None
+    return float(match.group(1)) / 1000.0
+
+def is_context_record(text):
+    """
+    Checks whether the undecoded JSON text of an event is a context
+    event, repeated at the start of a segment after the first.
+    """
+    return _CONTEXT_RE.search(text) is not None
+
+class EventFilter:
+    """
+    EventFilter selects trace events by type, object ID and time
+    range.  Any criteria left as None match all events.  'started'
+    events have no ID or relative time, so they are only subject to
+    the event type filter, and events without a relative time (e.g.
+    'properties') are not subject to the time range.
+    """
+
+    def __init__(self, event_types=None, ids=None, time_range=None):
+        self.event_types = None
+        if event_types is not None: self.event_types = set(event_types)
+        self.ids = None
+        if ids is not None: self.ids = set([str(objid).lower() for objid in ids])
+        self.time_range = time_range
+
+    def is_trivial(self):
+        return (self.event_types is None and self.ids is None and
+                self.time_range is None)
+
+    def _check(self, evt_type, evt_id, time_ms):
+        if self.event_types is not None and evt_type not in self.event_types:
+            return False
+        if evt_type == 'started':
+            return True
+        if self.ids is not None and (evt_id is None or evt_id.lower() not in self.ids):
+            return False
+        if self.time_range is not None and time_ms is not None:
+            t = float(time_ms) / 1000.0
+            start, end = self.time_range
+            if start is not None and t < start: return False
+            if end is not None and t > end: return False
+        return True
+
+    def matches_text(self, text):
+        """Checks an undecoded event, i.e. JSON text, against the filter."""
+        evt_type = _EVENT_RE.search(text)
+        if evt_type: evt_type = evt_type.group(1)
+        evt_id = None
+        if self.ids is not None:
+            evt_id = _ID_RE.search(text)
+            if evt_id: evt_id = evt_id.group(1)
+        time_ms = None
+        if self.time_range is not None:
+            time_ms = _TIME_RE.search(text)
+            if time_ms: time_ms = time_ms.group(1)
+        return self._check(evt_type, evt_id, time_ms)
+
+    def matches(self, evt):
+        """Checks a decoded event against the filter."""
+        time_ms = None
+        if 'time' in evt and evt['time'].endswith('ms'):
+            time_ms = evt['time'][:-2]
+        return self._check(evt['event'], evt.get('id'), time_ms)
+
+def _project(evt, fields):
+    return dict([(key, evt[key]) for key in fields if key in evt])
+
+def iter_trace_events(trace_file, event_types=None, ids=None, time_range=None, fields=None):
+    """
+    Iterates over the events in the specified trace file, decoding
+    them one at a time.  Traces which are truncated (e.g. because the
+    bot collecting them crashed before closing the array) yield all
+    the complete events.  Files which weren't written in the layout
+    used by sltrace fall back to loading the entire array.
+
+    Keyword arguments:
+    event_types -- only include events of these types (default None)
+    ids -- only include events for objects with these UUIDs, given as
+           UUIDs or strings (default None)
+    time_range -- (start, end) tuple of times in seconds, either of
+                  which may be None; only include events in this
+                  range (default None)
+    fields -- only keep these fields of each event; 'event' is always
+              kept (default None, i.e. all fields)
+
+    See EventFilter for how the filters treat events without IDs or
+    times.  trace_file may also name a segmented trace (see above).
+    """
+    evt_filter = EventFilter(event_types, ids, time_range)
+    if fields is not None:
+        fields = set(fields)
+        fields.add('event')
+
+    for idx,segment in enumerate(segment_filenames(trace_file)):
+        for evt in _iter_file_events(segment, evt_filter, fields, skip_context=(idx > 0)):
+            yield evt
+
+def _iter_file_events(trace_file, evt_filter, fields, skip_context=False):
+    trivial = evt_filter.is_trivial()
+    fp = open(trace_file)
+    try:
+        texts = iter_record_texts(fp)
+        # The first record is always decoded to verify the layout
+        for text in texts:
+            try:
+                evt = json.loads(text)
+            except ValueError:
+                evt = None
+            if not isinstance(evt, dict):
+                # Not in the sltrace layout, fall back to a full load
+                for evt in _load_all(trace_file):
+                    if skip_context and evt.get('context'): continue
+                    if not trivial and not evt_filter.matches(evt): continue
+                    if fields is not None: evt = _project(evt, fields)
+                    yield evt
+                return
+            if not (skip_context and evt.get('context')) and \
+                    (trivial or evt_filter.matches(evt)):
+                if fields is not None: evt = _project(evt, fields)
+                yield evt
+            break
+
+        for evt in _decode_records(texts, evt_filter, fields, skip_context):
+            yield evt
+    finally:
+        fp.close()
+
+def _decode_records(texts, evt_filter, fields, skip_context=False):
+    """
+    Decodes the record texts which pass evt_filter, checking the
+    filter before paying for decoding.  If skip_context is True,
+    context events are skipped too.
+    """
+    trivial = evt_filter.is_trivial()
+    for text in texts:
+        if not trivial and not evt_filter.matches_text(text):
+            continue
+        if skip_context and is_context_record(text):
+            continue
+        try:
+            evt = json.loads(text)
+        except ValueError:
+            return # truncated trace
+        if fields is not None: evt = _project(evt, fields)
+        yield evt
+
+def has_record_layout(trace_file):
+    """
+    Checks that trace_file is in the layout used by sltrace, i.e. its
+    first record decodes to an event on its own, as _iter_file_events
+    does before streaming.  Compact arrays, which have no separators,
+    fail this whatever their size.
+    """
+    fp = open(trace_file)
+    try:
+        head = fp.read(_READ_SIZE)
+        if RECORD_SEPARATOR not in head and len(head) == _READ_SIZE:
+            return False
+        fp.seek(0)
+        for text in iter_record_texts(fp):
+            try:
+                return isinstance(json.loads(text), dict)
+            except ValueError:
+                return False
+        return True
+    finally:
+        fp.close()
+
+def _decode_range(job):
+    """
+    Worker for load_trace_events_parallel: decodes the events starting
+    in the byte range [start, end) of the trace file.
+    """
+    trace_file, start, end, evt_filter, fields, skip_context = job
+    fp = open(trace_file)
+    try:
+        if start > 0 and not seek_to_record(fp, start): return []
+        texts = iter_record_texts(fp, end=end)
+        return list(_decode_records(texts, evt_filter, fields, skip_context))
+    finally:
+        fp.close()
+
+def load_trace_events_parallel(trace_file, processes=None,
+                               event_types=None, ids=None, time_range=None, fields=None):
+    """
+    Loads the events in the specified trace file, returning them as a
+    list in their original order, like iter_trace_events() but
+    decoding in parallel.  The file is split into byte ranges on event
+    boundaries and each range is decoded in a separate process.  Files
+    which aren't in the layout used by sltrace are loaded serially.
+    The segments of a segmented trace are split up together.
+
+    Keyword arguments:
+    processes -- number of worker processes (default None, i.e. the
+                 number of CPUs)
+    The remaining arguments are as for iter_trace_events().
+    """
+    import multiprocessing
+
+    if fields is not None:
+        fields = set(fields)
+        fields.add('event')
+
+    segments = segment_filenames(trace_file)
+    sizes = [os.path.getsize(segment) for segment in segments]
+    for segment in segments:
+        if not has_record_layout(segment):
+            return list(iter_trace_events(trace_file, event_types, ids, time_range, fields))
+
+    if processes is None: processes = multiprocessing.cpu_count()
+    evt_filter = EventFilter(event_types, ids, time_range)
+    # Several ranges per process balance out uneven decoding costs
+    total_ranges = max(1, min(processes * 4, sum(sizes) / _READ_SIZE))
+    jobs = []
+    for idx,(segment,size) in enumerate(zip(segments, sizes)):
+        nranges = max(1, (total_ranges * size) / max(1, sum(sizes)))
+        bounds = [(size * range_idx) / nranges for range_idx in range(nranges+1)]
+        jobs.extend([(segment, bounds[range_idx], bounds[range_idx+1], evt_filter, fields, idx > 0)
+                     for range_idx in range(nranges)])
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = pool.map(_decode_range, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    events = []
+    for chunk in chunks:
+        events.extend(chunk)
+    return events
+
+def load_json(trace_file):
+    """
+    Loads an entire JSON file, skipping a byte order mark if there is
+    one.  Raises ValueError if it isn't valid JSON.
+    """
+    data = open(trace_file).read()
+    if data.startswith(_UTF8_BOM): data = data[len(_UTF8_BOM):]
+    return json.loads(data)
+
+def _load_all(trace_file):
+    try:
+        return load_json(trace_file)
+    except ValueError:
+        return []
+
+class TraceWriter:
+    """
+    TraceWriter writes events to a trace file one at a time, in the
+    same layout sltrace uses, so the result can be read back by
+    ObjectPathTrace or iter_trace_events().
+    """
+
+    def __init__(self, trace_file):
+        self._fp = open(trace_file, 'w')
+        self._fp.write('[\n')
+        self._first = True
+        self.count = 0
+
+    def write(self, evt):
+        if not self._first:
+            self._fp.write(',\n')
+        self._first = False
+        # json.dumps never emits raw newlines, so RECORD_SEPARATOR
+        # remains unambiguous
+        self._fp.write(json.dumps(evt))
+        self._fp.write('\n')
+        self.count += 1
+
+    def close(self):
+        self._fp.write(']\n')
+        self._fp.close()
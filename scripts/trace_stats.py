@@ -0,0 +1,297 @@
+#!/usr/bin/python
+#
+# trace_stats.py [--json] trace_file [trace_file ...]
+#
+# Computes summary statistics for object path traces in a single
+# streaming pass over each trace, without loading the trace into
+# memory: event counts by type, object, avatar and root object
+# counts, trace duration, per-object update rate percentiles, objects
+# with unresolvable parents, and kill/re-add churn.  Memory use is
+# proportional to the number of objects, not the number of events.
+#
+# --json prints one JSON summary per line instead of a readable report,
+# which is convenient for processing a large archive of traces.
+#
+# --merge combines the statistics for all the given traces into one
+# summary, e.g. for the shards generated by shard_trace.py.  Time
+# sharded traces must be listed in time order.
+
+import sys
+try:
+    import simplejson as json
+except:
+    import json
+from object_path import parse_time
+from trace_events import iter_trace_events
+
+def percentiles(values, pcts):
+    """
+    Returns the requested percentiles (0-100) of values, using the
+    nearest-rank method.  Returns Nones if values is empty.
+    """
+    if not values: return [None for p in pcts]
+    values = sorted(values)
+    results = []
+    for p in pcts:
+        idx = int(round((p / 100.0) * (len(values)-1)))
+        results.append(values[idx])
+    return results
+
+class _ObjectStats:
+    """Per-object counters accumulated by TraceStats."""
+    __slots__ = ('adds', 'kills', 'readds', 'locs', 'first_loc', 'last_loc',
+                 'had_parent', 'had_no_parent', 'avatar', 'killed', 'context')
+
+    def __init__(self):
+        self.adds = 0
+        self.kills = 0
+        self.readds = 0
+        self.locs = 0
+        self.first_loc = None
+        self.last_loc = None
+        self.had_parent = False
+        self.had_no_parent = False
+        self.avatar = False
+        self.killed = False
+        self.context = False # present via a carried context event
+
+    def merge(self, other):
+        """Merges stats for the same object from a later trace."""
+        if self.killed and other.adds > 0 and not other.context:
+            self.readds += 1
+        self.adds += other.adds
+        self.kills += other.kills
+        self.readds += other.readds
+        self.locs += other.locs
+        if other.first_loc is not None:
+            if self.first_loc is None or other.first_loc < self.first_loc:
+                self.first_loc = other.first_loc
+            if self.last_loc is None or other.last_loc > self.last_loc:
+                self.last_loc = other.last_loc
+        self.had_parent = self.had_parent or other.had_parent
+        self.had_no_parent = self.had_no_parent or other.had_no_parent
+        self.avatar = self.avatar or other.avatar
+        self.context = self.context or other.context
+        if other.adds > 0 or other.kills > 0:
+            self.killed = other.killed
+
+    def present(self):
+        return self.adds > 0 or self.context
+
+class TraceStats:
+    """
+    TraceStats accumulates summary statistics about a stream of trace
+    events.  Feed it events with add() (or construct it with a trace
+    file) and retrieve the results with summary().
+    """
+
+    PERCENTILES = (50, 90, 99, 100)
+
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self._event_counts = {}
+        self._objects = {} # id string -> _ObjectStats
+        self._locals = set() # local ids of added objects
+        self._unfilled_parents = {} # parent local id -> # of additions
+        self._min_time = None
+        self._max_time = None
+        self._sims = []
+
+        if trace_file:
+            for evt in iter_trace_events(trace_file):
+                self.add(evt)
+
+    def _object(self, objid):
+        obj = self._objects.get(objid)
+        if obj is None:
+            obj = _ObjectStats()
+            self._objects[objid] = obj
+        return obj
+
+    def add(self, evt):
+        """
+        Accumulates a single event.  Context events carried into a
+        shard by shard_trace.py only register the object's presence,
+        so that merged statistics don't count them twice.
+        """
+        evt_type = evt['event']
+        if evt.get('context'):
+            if evt_type == 'add': self._add_context(evt)
+            return
+
+        self._event_counts[evt_type] = self._event_counts.get(evt_type, 0) + 1
+
+        if evt_type == 'started':
+            self._sims.append(evt.get('sim'))
+            return
+
+        t = None
+        if 'time' in evt:
+            t = parse_time(evt['time'])
+            if self._min_time is None or t < self._min_time: self._min_time = t
+            if self._max_time is None or t > self._max_time: self._max_time = t
+
+        if evt_type == 'loc':
+            obj = self._object(evt['id'])
+            obj.locs += 1
+            # arrival order isn't strictly time order, so track extremes
+            if obj.first_loc is None or t < obj.first_loc: obj.first_loc = t
+            if obj.last_loc is None or t > obj.last_loc: obj.last_loc = t
+        elif evt_type == 'add':
+            obj = self._object(evt['id'])
+            if obj.killed:
+                obj.readds += 1
+                obj.killed = False
+            obj.adds += 1
+            if evt['type'] == 'avatar': obj.avatar = True
+            self._locals.add(evt['local'])
+            if 'parent_local' in evt:
+                obj.had_parent = True
+                if 'parent' not in evt:
+                    par = evt['parent_local']
+                    self._unfilled_parents[par] = self._unfilled_parents.get(par, 0) + 1
+            else:
+                obj.had_no_parent = True
+        elif evt_type == 'kill':
+            obj = self._object(evt['id'])
+            obj.kills += 1
+            obj.killed = True
+
+    def _add_context(self, evt):
+        obj = self._object(evt['id'])
+        obj.context = True
+        if evt['type'] == 'avatar': obj.avatar = True
+        self._locals.add(evt['local'])
+        if 'parent_local' in evt:
+            obj.had_parent = True
+        else:
+            obj.had_no_parent = True
+
+    def merge(self, other):
+        """
+        Merges the statistics accumulated by another TraceStats into
+        this one. If both cover the same objects, other must cover a
+        later period of time (e.g. the next time shard or segment).
+        """
+        for evt_type,count in other._event_counts.items():
+            if evt_type == 'started':
+                # shards each carry a copy of the started events
+                count = max(count - self._event_counts.get(evt_type, 0), 0)
+            self._event_counts[evt_type] = self._event_counts.get(evt_type, 0) + count
+        for objid,other_obj in other._objects.items():
+            self._object(objid).merge(other_obj)
+        self._locals.update(other._locals)
+        for par,count in other._unfilled_parents.items():
+            self._unfilled_parents[par] = self._unfilled_parents.get(par, 0) + count
+        if other._min_time is not None:
+            if self._min_time is None or other._min_time < self._min_time:
+                self._min_time = other._min_time
+            if self._max_time is None or other._max_time > self._max_time:
+                self._max_time = other._max_time
+        for sim in other._sims:
+            if sim not in self._sims: self._sims.append(sim)
+        if self.trace_file != other.trace_file:
+            self.trace_file = '%s+%s' % (self.trace_file, other.trace_file)
+        return self
+
+    def summary(self):
+        """
+        Returns a dict of summary statistics.  Objects, avatars and
+        roots follow the same definitions as ObjectPathTrace's
+        objects(), avatars() and roots(), and missing parents are
+        counted the same way ObjectPathTrace.fill_parents() reports
+        them.
+        """
+        added = [obj for obj in self._objects.values() if obj.present()]
+
+        rates = []
+        for obj in added:
+            if obj.locs < 2: continue
+            span = obj.last_loc - obj.first_loc
+            if span <= 0: continue
+            rates.append( (obj.locs-1) / span )
+
+        duration = None
+        if self._min_time is not None:
+            duration = self._max_time - self._min_time
+
+        missing_parents = sum([count
+                               for par,count in self._unfilled_parents.items()
+                               if par not in self._locals])
+
+        return {
+            'trace_file' : self.trace_file,
+            'sims' : self._sims,
+            'event_counts' : dict(self._event_counts),
+            'objects' : len(added),
+            'avatars' : len([obj for obj in added if obj.avatar]),
+            'roots' : len([obj for obj in added
+                           if obj.avatar or (obj.had_no_parent and not obj.had_parent)]),
+            'duration' : duration,
+            'update_rate_percentiles' : dict(zip(self.PERCENTILES, percentiles(rates, self.PERCENTILES))),
+            'updates_per_object_percentiles' : dict(zip(self.PERCENTILES, percentiles([obj.locs for obj in added], self.PERCENTILES))),
+            'missing_parents' : missing_parents,
+            'kills' : sum([obj.kills for obj in self._objects.values()]),
+            'readds' : sum([obj.readds for obj in added]),
+            'churned_objects' : len([obj for obj in added if obj.readds > 0]),
+            }
+
+    def report(self, fp=None):
+        """Prints a human readable version of summary() to fp."""
+        if not fp: fp = sys.stdout
+        summ = self.summary()
+
+        print >>fp, "Trace file:", summ['trace_file']
+        print >>fp, "Sims:", ', '.join([str(sim) for sim in summ['sims']])
+        print >>fp, "Number of objects:", summ['objects']
+        print >>fp, "Number of avatars:", summ['avatars']
+        print >>fp, "Number of root objects:", summ['roots']
+        if summ['duration'] is not None:
+            print >>fp, "Duration: %.3fs" % summ['duration']
+        print >>fp, "Events:"
+        for evt_type,count in sorted(summ['event_counts'].items()):
+            print >>fp, "  %s: %d" % (evt_type, count)
+        print >>fp, "Updates per object (p50/p90/p99/max):", \
+            '/'.join([str(summ['updates_per_object_percentiles'][p]) for p in self.PERCENTILES])
+        print >>fp, "Update rate per object, Hz (p50/p90/p99/max):", \
+            '/'.join([_format_rate(summ['update_rate_percentiles'][p]) for p in self.PERCENTILES])
+        print >>fp, "Objects with local parent ID but no matching object:", summ['missing_parents']
+        print >>fp, "Kills:", summ['kills']
+        print >>fp, "Re-additions after kill:", summ['readds'], "(%d objects)" % summ['churned_objects']
+
+def _format_rate(rate):
+    if rate is None: return 'n/a'
+    return '%.3f' % rate
+
+def main(args=None):
+    if args is None: args = sys.argv[1:]
+
+    as_json = False
+    merge = False
+    trace_files = []
+    for arg in args:
+        if arg == '--json':
+            as_json = True
+        elif arg == '--merge':
+            merge = True
+        else:
+            trace_files.append(arg)
+
+    if not trace_files:
+        print "Specify a file."
+        return -1
+
+    all_stats = [TraceStats(trace_file) for trace_file in trace_files]
+    if merge:
+        all_stats = [reduce(lambda x,y: x.merge(y), all_stats)]
+
+    for stats in all_stats:
+        if as_json:
+            print json.dumps(stats.summary())
+        else:
+            stats.report()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,15 @@
 #!/usr/bin/python
 
-import subprocess
 import random
 
 color_seed=0
-is_not_804 = None
 
 # Get a random color for a graph
 def get_random_color():
-    global is_not_804
-    if is_not_804 == None:
-        is_not_804 = subprocess.call(['grep', '-q', '8[.]04', '/etc/lsb-release'])
-
-    #if not is_not_804:
-    if True: # Something seems broken on 9.10 too these days...
+    # Named colors used to be limited to Ubuntu 8.04 (checked by
+    # grepping /etc/lsb-release), but the fallback below seems broken
+    # on 9.10 too these days...
+    if True:
         set_colors = [
             'aliceblue',
             'antiquewhite',
@@ -1,22 +1,49 @@
 #!/usr/bin/env python
 #
-# ascii command-line progress bar with percentage and elapsed time display
+# ascii command-line progress bar with percentage, rate and ETA display
 #
 # adapted from Pylot source code (original by Vasil Vangelovski)
 # modified by Corey Goldberg - 2010
 # modified by Ewen Cheslack-Postava - 2010
 #  (original at http://code.google.com/p/corey-projects/source/browse/trunk/python2/progress_bar.py)
+#
+# Redraws are rate limited, so update() and report() can be called for
+# every item processed.  When the output isn't a terminal, e.g. it's
+# redirected to a log, a status line of key=value pairs is printed
+# periodically instead of the bar.  Progress made in other processes
+# can be aggregated through a shared counter (see shared_counter() and
+# WorkerProgress).
 
 import time
 import sys
 
 class ProgressBar:
-    def __init__(self, duration):
+    def __init__(self, duration, fp=None, min_interval=0.1, status_interval=10.0,
+                 label='progress', counter=None):
+        """
+        Keyword arguments:
+        fp -- file to report to (default None, i.e. sys.stdout)
+        min_interval -- minimum seconds between redraws of the bar
+        status_interval -- seconds between status lines when fp isn't
+                           a terminal
+        label -- name of the task, at the start of status lines
+        counter -- a shared counter (see shared_counter()) which other
+                   processes add their progress to; poll() reports it
+        """
         self.duration = duration
+        self.fp = fp
+        self.min_interval = min_interval
+        self.status_interval = status_interval
+        self.label = label
+        self.counter = counter
         self.prog_bar = '[]'
         self.fill_char = '#'
         self.width = 40
-        self.__update_amount(0)
+        self.finished = 0
+        self.start = time.time()
+        self._last_report = None
+        self._last_len = 0
+        self._tty = None
 
     def __update_amount(self, new_amount):
         percent_done = int(round((new_amount / 100.0) * 100.0))
@@ -29,26 +56,140 @@ class ProgressBar:
             (pct_string + self.prog_bar[pct_place + len(pct_string):])
 
     def update(self, finished):
+        """Records progress; this is cheap, drawing is done by report()."""
+        self.finished = finished
+
+    def add(self, count=1):
+        self.finished += count
+
+    def rate(self):
+        """Returns the number of items finished per second so far."""
+        elapsed = time.time() - self.start
+        if elapsed <= 0: return 0.0
+        return self.finished / elapsed
+
+    def eta(self):
+        """Returns the estimated seconds remaining, or None if unknown."""
+        rate = self.rate()
+        if rate <= 0 or not self.duration: return None
+        return max(self.duration - self.finished, 0) / rate
+
+    def _fp(self, fp):
+        if fp: return fp
+        if self.fp: return self.fp
+        return sys.stdout
+
+    def _is_tty(self, fp):
+        if self._tty is None:
+            try:
+                self._tty = fp.isatty()
+            except AttributeError:
+                self._tty = False
+        return self._tty
+
+    def _bar(self):
         if (self.duration != 0):
-            frac = (finished / float(self.duration))
+            frac = (self.finished / float(self.duration))
         else:
             frac = 0
         self.__update_amount(frac * 100.0)
-        self.prog_bar += '  %d/%s' % (finished, self.duration)
+        bar = self.prog_bar + '  %d/%s  %s/s' % (self.finished, self.duration, _format_rate(self.rate()))
+        eta = self.eta()
+        if eta is not None: bar += '  ETA %s' % _format_duration(eta)
+        return bar
+
+    def status(self):
+        """Returns a status line of key=value pairs."""
+        pct = 0.0
+        if self.duration: pct = 100.0 * self.finished / self.duration
+        eta = self.eta()
+        if eta is None: eta = 'n/a'
+        else: eta = '%.1fs' % eta
+        return '%s: done=%d total=%s percent=%.1f rate=%s/s elapsed=%.1fs eta=%s' % \
+            (self.label, self.finished, self.duration, pct, _format_rate(self.rate()),
+             time.time() - self.start, eta)
+
+    def report(self, fp=None, force=False):
+        """
+        Draws the bar, or prints a status line if fp isn't a terminal,
+        unless it was drawn too recently (see the constructor).
+        """
+        fp = self._fp(fp)
+        now = time.time()
+        tty = self._is_tty(fp)
+        interval = self.min_interval
+        if not tty: interval = self.status_interval
+        if not force and self._last_report is not None and now - self._last_report < interval:
+            return
+        self._last_report = now
 
-    def report(self, fp=None):
-        if not fp: fp = sys.stdout
-        print >>fp, '\r' + str(self.prog_bar),
+        if tty:
+            bar = self._bar()
+            # Pad to overwrite the rest of a longer previous bar
+            print >>fp, '\r' + bar + ' ' * max(self._last_len - len(bar), 0),
+            self._last_len = len(bar)
+        else:
+            print >>fp, self.status()
         fp.flush()
 
+    def poll(self, fp=None):
+        """Updates from the shared counter and reports."""
+        self.update(self.counter.value)
+        self.report(fp)
+
     def finish(self, fp=None, mark_complete=True):
         if mark_complete:
             self.update(self.duration)
-            self.report()
+        elif self.counter is not None:
+            self.update(self.counter.value)
+        fp = self._fp(fp)
+        self.report(fp, force=True)
 
         # And clear to next line
-        if not fp: fp = sys.stdout
-        print >>fp, ''
+        if self._is_tty(fp):
+            print >>fp, ''
+
+def _format_rate(rate):
+    if rate >= 100: return '%.0f' % rate
+    return '%.2f' % rate
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+def shared_counter():
+    """
+    Returns a counter which can be passed to worker processes (e.g.
+    through a multiprocessing.Pool initializer) to report progress to a
+    ProgressBar in the parent.
+    """
+    import multiprocessing
+    return multiprocessing.Value('l', 0)
+
+class WorkerProgress:
+    """
+    WorkerProgress adds progress made in a worker process to a shared
+    counter, batching updates so the counter's lock is only taken every
+    flush_interval seconds.
+    """
+
+    def __init__(self, counter, flush_interval=0.5):
+        self.counter = counter
+        self.flush_interval = flush_interval
+        self._pending = 0
+        self._last_flush = time.time()
+
+    def add(self, count=1):
+        self._pending += count
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            with self.counter.get_lock():
+                self.counter.value += self._pending
+            self._pending = 0
+        self._last_flush = time.time()
 
 if __name__ == '__main__':
     p = ProgressBar(60)
@@ -10,6 +10,9 @@ __max = max
 def add(v1, v2):
     return ( v1[0]+v2[0], v1[1]+v2[1], v1[2]+v2[2] )
 
+def sub(v1, v2):
+    return ( v1[0]-v2[0], v1[1]-v2[1], v1[2]-v2[2] )
+
 def mult(val, scale):
     return ( val[0] * scale[0], val[1] * scale[1], val[2] * scale[2] )
 
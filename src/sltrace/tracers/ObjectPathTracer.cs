@@ -41,6 +41,14 @@ namespace SLTrace {
 
 /** Records events concerning object locations - addition and removal from
  *  interest set, position and velocity updates, size updates, etc.
+ *
+ *  Output can optionally be split into segments, starting a new file every
+ *  --segment-minutes minutes or --segment-mb megabytes.  Segments of
+ *  trace.json are named trace.0.json, trace.1.json, etc.  Each segment is a
+ *  complete trace on its own: after the first, each starts with context
+ *  events (marked "context" : true) recording the start time, sim, and the
+ *  objects known at the time the segment started, along with their parents,
+ *  sizes and locations.
  */
 class ObjectPathTracer : ITracer {
     public ObjectPathTracer(string args_string) {
@@ -53,6 +61,19 @@ class ObjectPathTracer : ITracer {
            mTraceFilename = arg_map["o"];
         if (arg_map.ContainsKey("out"))
            mTraceFilename = arg_map["out"];
+
+        // Maximum number of events waiting to be written before events are
+        // dropped
+        mMaxQueueDepth = AsyncJSONWriter.DefaultMaxQueueDepth;
+        if (arg_map.ContainsKey("queue"))
+           mMaxQueueDepth = Int32.Parse(arg_map["queue"]);
+
+        mSegmentDuration = TimeSpan.Zero;
+        mSegmentBytes = 0;
+        if (arg_map.ContainsKey("segment-minutes"))
+           mSegmentDuration = TimeSpan.FromMinutes(Double.Parse(arg_map["segment-minutes"]));
+        if (arg_map.ContainsKey("segment-mb"))
+           mSegmentBytes = (long)(Double.Parse(arg_map["segment-mb"]) * 1024 * 1024);
     }
 
     public void StartTrace(TraceSession parent) {
@@ -69,6 +90,9 @@ class ObjectPathTracer : ITracer {
         mObjectsByLocalID = new Dictionary<uint, Primitive>();
         mObjectsByID = new Dictionary<UUID, Primitive>();
         mObjectParents = new Dictionary<UUID, uint>();
+        mObjectTypes = new Dictionary<UUID, String>();
+        mObjectBounds = new Dictionary<UUID, ObjectBounds>();
+        mShapeBounds = new Dictionary<ShapeKey, ShapeBounds>();
 
         mParent.Client.Objects.OnObjectDataBlockUpdate +=
             new ObjectManager.ObjectDataBlockUpdateCallback(this.ObjectDataBlockUpdateHandler);
@@ -97,16 +121,126 @@ class ObjectPathTracer : ITracer {
         mParent.Client.Self.Movement.Camera.Far = 512.0f;
 
 
-        // We output JSON, one giant list of events
-        System.IO.TextWriter streamWriter =
-            new System.IO.StreamWriter(mTraceFilename);
-        mJSON = new JSON(streamWriter);
-        mJSON.BeginArray();
+        // We output JSON, one giant list of events per file. Events are
+        // formatted and written on a separate thread so callbacks return
+        // quickly; see AsyncJSONWriter.
+        mSegmentIndex = 0;
+        if (Segmented)
+            mSegmentFilename = SegmentFilename(mSegmentIndex);
+        else
+            mSegmentFilename = mTraceFilename;
+        mJSON = OpenOutput(mSegmentFilename);
+        mWriter = new AsyncJSONWriter(mJSON, mMaxQueueDepth);
+        mWriter.Start();
 
         mStartTime = DateTime.Now;
+        mSegmentStart = mStartTime;
+        mLastSegmentCheck = mStartTime;
+    }
+
+    private JSON OpenOutput(string filename) {
+        System.IO.TextWriter streamWriter =
+            new System.IO.StreamWriter(filename, false, TraceEncoding, WriteBufferSize);
+        JSON json = new JSON(streamWriter);
+        json.BeginArray();
+        return json;
+    }
+
+    private bool Segmented {
+        get { return mSegmentDuration != TimeSpan.Zero || mSegmentBytes > 0; }
+    }
+
+    private string SegmentFilename(int idx) {
+        string ext = System.IO.Path.GetExtension(mTraceFilename);
+        string prefix = mTraceFilename.Substring(0, mTraceFilename.Length - ext.Length);
+        return String.Format("{0}.{1}{2}", prefix, idx, ext);
+    }
+
+    /** Queues an event to be written, first starting a new segment if the
+     *  current one is full.
+     */
+    private void Record(Action write_event) {
+        if (Segmented && DateTime.Now - mLastSegmentCheck >= SegmentCheckInterval)
+            CheckSegment();
+        mWriter.Enqueue(write_event);
+    }
+
+    private void CheckSegment() {
+        lock(this) {
+            DateTime now = DateTime.Now;
+            // Another thread may have just checked
+            if (now - mLastSegmentCheck < SegmentCheckInterval)
+                return;
+            mLastSegmentCheck = now;
+
+            bool full = false;
+            if (mSegmentDuration != TimeSpan.Zero && now - mSegmentStart >= mSegmentDuration)
+                full = true;
+            // The file won't exist yet if the writer hasn't gotten to the
+            // start of the segment. The size lags by up to the write buffer.
+            System.IO.FileInfo info = new System.IO.FileInfo(mSegmentFilename);
+            if (mSegmentBytes > 0 && info.Exists && info.Length >= mSegmentBytes)
+                full = true;
+
+            if (full)
+                StartSegment(now);
+        }
+    }
+
+    /** Starts a new segment.  The context for the new segment is captured
+     *  now, so it is consistent with the events queued before it.  Must be
+     *  called with the lock held.
+     */
+    private void StartSegment(DateTime now) {
+        mSegmentIndex++;
+        mSegmentFilename = SegmentFilename(mSegmentIndex);
+        mSegmentStart = now;
+
+        TimeSpan time = now - mStartTime;
+        List<Action> context = new List<Action>();
+        if (mSimName != null)
+            context.Add(StartedEvent(mSimName, true));
+        foreach(Primitive prim in mObjectsByLocalID.Values) {
+            if (!mObjectParents.ContainsKey(prim.ID) || !mObjectTypes.ContainsKey(prim.ID))
+                continue;
+            uint parent_local = mObjectParents[prim.ID];
+            Primitive parent = null;
+            if (parent_local != 0 && mObjectsByLocalID.ContainsKey(parent_local))
+                parent = mObjectsByLocalID[parent_local];
+            context.Add(AddEvent(time, mObjectTypes[prim.ID], prim, parent_local, parent, true));
+            if (mObjectBounds.ContainsKey(prim.ID))
+                context.Add(SizeEvent(time, prim.ID, mObjectBounds[prim.ID], true));
+            context.Add(LocEvent(time, prim.ID, prim.Position, prim.Velocity, prim.Rotation, prim.AngularVelocity, true));
+        }
+
+        // Each segment records the counters as of its end, so they aren't lost
+        // if the bot crashes
+        mWriter.Enqueue(BoundsCacheEvent(time));
+        string filename = mSegmentFilename;
+        mWriter.Enqueue(() => {
+                mJSON.EndArray();
+                mJSON.Finish();
+                mJSON = OpenOutput(filename);
+                mWriter.Output = mJSON;
+                foreach(Action write_event in context)
+                    write_event();
+            });
     }
 
     public void StopTrace() {
+        TimeSpan time = SinceStart;
+        mWriter.Enqueue(BoundsCacheEvent(time));
+        // mJSON may be replaced by the writer thread until it stops
+        mWriter.Stop(() => {
+                mJSON.BeginObject();
+                JSONStringField("event", "writer_stats");
+                JSONTimeSpanField("time", time);
+                JSONInt64Field("enqueued", mWriter.Enqueued);
+                JSONInt64Field("written", mWriter.Written);
+                JSONInt64Field("dropped", mWriter.Dropped);
+                JSONInt64Field("max_queue_depth", mWriter.MaxQueueDepth);
+                mJSON.EndObject();
+            });
         mJSON.EndArray();
         mJSON.Finish();
     }
@@ -114,10 +248,39 @@ class ObjectPathTracer : ITracer {
 
 
     private void ComputeBounds(Primitive prim) {
+        // Meshing is expensive and sims are full of identical shapes, so
+        // unscaled bounds are cached by shape.
+        ShapeKey shape = new ShapeKey(prim);
+        ShapeBounds shape_bounds;
+        lock(this) {
+            if (mShapeBounds.TryGetValue(shape, out shape_bounds))
+                mShapeBoundsHits++;
+        }
+        if (shape_bounds == null) {
+            shape_bounds = MeshBounds(prim);
+            lock(this) {
+                mShapeBoundsMisses++;
+                if (mShapeBounds.Count >= MaxShapeBoundsEntries)
+                    mShapeBounds.Clear();
+                mShapeBounds[shape] = shape_bounds;
+            }
+        }
+
+        if (shape_bounds.Empty)
+            return;
+
+        ObjectBounds bounds = new ObjectBounds(shape_bounds.Min, shape_bounds.Max, prim.Scale);
+        lock(this) {
+            mObjectBounds[prim.ID] = bounds;
+        }
+        Record(SizeEvent(SinceStart, prim.ID, bounds, false));
+    }
+
+    private ShapeBounds MeshBounds(Primitive prim) {
         SimpleMesh mesh = mRenderer.GenerateSimpleMesh(prim, DetailLevel.High);
 
         if (mesh.Vertices.Count == 0)
-            return;
+            return new ShapeBounds();
 
         Vector3 vert_min = mesh.Vertices[0].Position;
         Vector3 vert_max = mesh.Vertices[0].Position;
@@ -127,16 +290,29 @@ class ObjectPathTracer : ITracer {
             vert_max = Vector3.Max(vert_max, v.Position);
         }
 
-        lock(mJSON) {
+        return new ShapeBounds(vert_min, vert_max);
+    }
+
+    /** Records the bounds cache counters, which are cumulative over the whole
+     *  trace.
+     */
+    private Action BoundsCacheEvent(TimeSpan time) {
+        long hits, misses;
+        int entries;
+        lock(this) {
+            hits = mShapeBoundsHits;
+            misses = mShapeBoundsMisses;
+            entries = mShapeBounds.Count;
+        }
+        return () => {
             mJSON.BeginObject();
-            JSONStringField("event", "size");
-            JSONUUIDField("id", prim.ID);
-            JSONTimeSpanField("time", SinceStart);
-            JSONVector3Field("min", vert_min);
-            JSONVector3Field("max", vert_max);
-            JSONVector3Field("scale", prim.Scale);
+            JSONStringField("event", "bounds_cache");
+            JSONTimeSpanField("time", time);
+            JSONInt64Field("hits", hits);
+            JSONInt64Field("misses", misses);
+            JSONInt64Field("entries", entries);
             mJSON.EndObject();
-        }
+        };
     }
 
     private void CheckMembershipWithLocation(Simulator sim, String primtype, Primitive prim) {
@@ -178,8 +354,10 @@ class ObjectPathTracer : ITracer {
             // store the object if an important feature has changed. Currently
             // the only important feature we track is ParentID.
             if (!is_update ||
-                mObjectParents[prim.ID] != prim.ParentID)
+                mObjectParents[prim.ID] != prim.ParentID) {
+                mObjectTypes[prim.ID] = primtype;
                 StoreNewObject(primtype, prim, prim.ParentID, parentPrim);
+            }
 
             mObjectParents[prim.ID] = prim.ParentID;
 
@@ -205,35 +383,21 @@ class ObjectPathTracer : ITracer {
                 mObjectsByLocalID.Remove(localid);
                 mObjectsByID.Remove(prim.ID);
                 mObjectParents.Remove(prim.ID);
+                mObjectTypes.Remove(prim.ID);
+                mObjectBounds.Remove(prim.ID);
                 fullid = prim.ID;
             }
         }
 
         if (fullid == UUID.Zero) return;
-        lock(mJSON) {
-            mJSON.BeginObject();
-            JSONStringField("event", "kill");
-            JSONTimeSpanField("time", SinceStart);
-            JSONUUIDField("id", fullid);
-            mJSON.EndObject();
-        }
+        Record(KillEvent(SinceStart, fullid));
     }
 
     // Note: Because we need to use this both for new prims/avatars and for
     // ObjectUpdates, and ObjectUpdates don't update the primitive until *after*
     // the callback, we need to pass the information in explicitly.
     private void StoreLocationUpdate(Primitive prim, Vector3 pos, Vector3 vel, Quaternion rot, Vector3 angvel) {
-        lock(mJSON) {
-            mJSON.BeginObject();
-            JSONStringField("event", "loc");
-            JSONUUIDField("id", prim.ID);
-            JSONTimeSpanField("time", SinceStart);
-            JSONVector3Field("pos", pos);
-            JSONVector3Field("vel", vel);
-            JSONQuaternionField("rot", rot);
-            JSONVector3Field("angvel", angvel);
-            mJSON.EndObject();
-        }
+        Record(LocEvent(SinceStart, prim.ID, pos, vel, rot, angvel, false));
     }
 
     private void StoreLocationUpdate(Primitive prim) {
@@ -260,19 +424,7 @@ class ObjectPathTracer : ITracer {
     }
 
     private void StoreNewObject(String type, Primitive obj, uint parentLocal, Primitive parent) {
-        lock(mJSON) {
-            mJSON.BeginObject();
-            JSONStringField("event", "add");
-            JSONTimeSpanField("time", SinceStart);
-            JSONStringField("type", type);
-            JSONUInt32Field("local", obj.LocalID);
-            JSONUUIDField("id", obj.ID);
-            if (parentLocal != 0)
-                JSONUInt32Field("parent_local", parentLocal);
-            if (parent != null)
-                JSONUUIDField("parent", parent.ID);
-            mJSON.EndObject();
-        }
+        Record(AddEvent(SinceStart, type, obj, parentLocal, parent, false));
 
         // Selecting avatars doesn't work for getting object properties, but the
         // same properties are available immediately here.
@@ -282,25 +434,22 @@ class ObjectPathTracer : ITracer {
     }
 
     private void StoreObjectProperties(UUID id, string name, String description) {
-        lock(mJSON) {
-            mJSON.BeginObject();
-            JSONStringField("event", "properties");
-            JSONUUIDField("id", id);
-            JSONStringField("name", name);
-            JSONStringField("description", description);
-            mJSON.EndObject();
-        }
+        Record(() => {
+                mJSON.BeginObject();
+                JSONStringField("event", "properties");
+                JSONUUIDField("id", id);
+                JSONStringField("name", name);
+                JSONStringField("description", description);
+                mJSON.EndObject();
+            });
     }
 
 
     private void SimConnectedHandler(Simulator sim) {
-        lock(mJSON) {
-            mJSON.BeginObject();
-            JSONStringField("event", "started");
-            mJSON.Field("time", new JSONString( mStartTime.ToString() ));
-            JSONStringField("sim", sim.Name);
-            mJSON.EndObject();
+        lock(this) {
+            mSimName = sim.Name;
         }
+        Record(StartedEvent(sim.Name, false));
     }
 
 
@@ -329,13 +478,97 @@ class ObjectPathTracer : ITracer {
 
 
 
-    // JSON Encoding helpers
+    // Event builders. Each captures the values an event records when it is
+    // called, returning an action which writes the event from the writer
+    // thread.  Context events are copies of earlier state carried into a new
+    // segment.
+    private Action StartedEvent(string sim_name, bool context) {
+        return () => {
+            mJSON.BeginObject();
+            JSONStringField("event", "started");
+            mJSON.Field("time", new JSONString( mStartTime.ToString() ));
+            JSONStringField("sim", sim_name);
+            if (context)
+                JSONBoolField("context", true);
+            mJSON.EndObject();
+        };
+    }
+
+    private Action AddEvent(TimeSpan time, String type, Primitive obj, uint parentLocal, Primitive parent, bool context) {
+        uint local = obj.LocalID;
+        UUID id = obj.ID;
+        UUID parent_id = (parent != null) ? parent.ID : UUID.Zero;
+        return () => {
+            mJSON.BeginObject();
+            JSONStringField("event", "add");
+            JSONTimeSpanField("time", time);
+            JSONStringField("type", type);
+            JSONUInt32Field("local", local);
+            JSONUUIDField("id", id);
+            if (parentLocal != 0)
+                JSONUInt32Field("parent_local", parentLocal);
+            if (parent_id != UUID.Zero)
+                JSONUUIDField("parent", parent_id);
+            if (context)
+                JSONBoolField("context", true);
+            mJSON.EndObject();
+        };
+    }
+
+    private Action SizeEvent(TimeSpan time, UUID id, ObjectBounds bounds, bool context) {
+        return () => {
+            mJSON.BeginObject();
+            JSONStringField("event", "size");
+            JSONUUIDField("id", id);
+            JSONTimeSpanField("time", time);
+            JSONVector3Field("min", bounds.Min);
+            JSONVector3Field("max", bounds.Max);
+            JSONVector3Field("scale", bounds.Scale);
+            if (context)
+                JSONBoolField("context", true);
+            mJSON.EndObject();
+        };
+    }
+
+    private Action LocEvent(TimeSpan time, UUID id, Vector3 pos, Vector3 vel, Quaternion rot, Vector3 angvel, bool context) {
+        return () => {
+            mJSON.BeginObject();
+            JSONStringField("event", "loc");
+            JSONUUIDField("id", id);
+            JSONTimeSpanField("time", time);
+            JSONVector3Field("pos", pos);
+            JSONVector3Field("vel", vel);
+            JSONQuaternionField("rot", rot);
+            JSONVector3Field("angvel", angvel);
+            if (context)
+                JSONBoolField("context", true);
+            mJSON.EndObject();
+        };
+    }
+
+    private Action KillEvent(TimeSpan time, UUID id) {
+        return () => {
+            mJSON.BeginObject();
+            JSONStringField("event", "kill");
+            JSONTimeSpanField("time", time);
+            JSONUUIDField("id", id);
+            mJSON.EndObject();
+        };
+    }
+
+    // JSON Encoding helpers. These may only be used by actions run by mWriter.
     private void JSONStringField(String name, String val) {
         mJSON.Field(name, new JSONString(val));
     }
     private void JSONUInt32Field(String name, uint val) {
         mJSON.Field(name, new JSONInt((long)val));
     }
+    private void JSONInt64Field(String name, long val) {
+        mJSON.Field(name, new JSONInt(val));
+    }
+    private void JSONBoolField(String name, bool val) {
+        mJSON.Field(name, new JSONBool(val));
+    }
     private void JSONUUIDField(String name, UUID val) {
         mJSON.Field(name, new JSONString( val.ToString() ));
     }
@@ -363,6 +596,87 @@ class ObjectPathTracer : ITracer {
         get { return DateTime.Now - mStartTime; }
     }
 
+    /** The size of an object, as recorded in size events. */
+    private class ObjectBounds {
+        public ObjectBounds(Vector3 min, Vector3 max, Vector3 scale) {
+            Min = min;
+            Max = max;
+            Scale = scale;
+        }
+
+        public Vector3 Min;
+        public Vector3 Max;
+        public Vector3 Scale;
+    }
+
+    /** Identifies a prim's shape, i.e. everything its mesh depends on
+     *  other than scale, so prims with equal keys have equal unscaled bounds.
+     */
+    private struct ShapeKey : IEquatable<ShapeKey> {
+        public ShapeKey(Primitive prim) {
+            Data = prim.PrimData;
+            HasSculpt = (prim.Sculpt != null);
+            SculptTexture = HasSculpt ? prim.Sculpt.SculptTexture : UUID.Zero;
+            SculptType = HasSculpt ? prim.Sculpt.Type : default(SculptType);
+        }
+
+        public bool Equals(ShapeKey other) {
+            return Data.Equals(other.Data) &&
+                HasSculpt == other.HasSculpt &&
+                SculptTexture == other.SculptTexture &&
+                SculptType == other.SculptType;
+        }
+
+        public override bool Equals(object obj) {
+            return (obj is ShapeKey) && Equals((ShapeKey)obj);
+        }
+
+        // The default hash for structs only uses the first field, so combine
+        // the parameters which usually vary between shapes
+        public override int GetHashCode() {
+            int hash = SculptTexture.GetHashCode();
+            hash = hash * 31 + Data.PCode.GetHashCode();
+            hash = hash * 31 + Data.PathCurve.GetHashCode();
+            hash = hash * 31 + Data.ProfileCurve.GetHashCode();
+            hash = hash * 31 + Data.PathBegin.GetHashCode();
+            hash = hash * 31 + Data.PathEnd.GetHashCode();
+            hash = hash * 31 + Data.PathScaleX.GetHashCode();
+            hash = hash * 31 + Data.PathScaleY.GetHashCode();
+            hash = hash * 31 + Data.PathShearX.GetHashCode();
+            hash = hash * 31 + Data.PathShearY.GetHashCode();
+            hash = hash * 31 + Data.PathTwist.GetHashCode();
+            hash = hash * 31 + Data.PathTwistBegin.GetHashCode();
+            hash = hash * 31 + Data.PathTaperX.GetHashCode();
+            hash = hash * 31 + Data.PathTaperY.GetHashCode();
+            hash = hash * 31 + Data.ProfileBegin.GetHashCode();
+            hash = hash * 31 + Data.ProfileEnd.GetHashCode();
+            hash = hash * 31 + Data.ProfileHollow.GetHashCode();
+            return hash;
+        }
+
+        public Primitive.ConstructionData Data;
+        public bool HasSculpt;
+        public UUID SculptTexture;
+        public SculptType SculptType;
+    }
+
+    /** Unscaled bounds of a shape's mesh. */
+    private class ShapeBounds {
+        public ShapeBounds() {
+            Empty = true;
+        }
+
+        public ShapeBounds(Vector3 min, Vector3 max) {
+            Empty = false;
+            Min = min;
+            Max = max;
+        }
+
+        public bool Empty; // True if the mesh had no vertices
+        public Vector3 Min;
+        public Vector3 Max;
+    }
+
     private IEnumerable<Primitive> RootObjects {
         get { return mObjectsByLocalID.Values.Where(obj => obj.ParentID == 0); }
     }
@@ -377,8 +691,32 @@ class ObjectPathTracer : ITracer {
                                                       // global UUID
     private Dictionary<UUID, uint> mObjectParents; // LocalID of parents of all
                                                    // tracked objects
-
+    private Dictionary<UUID, String> mObjectTypes; // Type recorded in the
+                                                   // latest add event
+    private Dictionary<UUID, ObjectBounds> mObjectBounds; // Latest recorded
+                                                          // sizes
+    private string mSimName; // Sim we're connected to, for segment context
+
+    private const int MaxShapeBoundsEntries = 1 << 16;
+    private Dictionary<ShapeKey, ShapeBounds> mShapeBounds; // Cached mesh bounds
+    private long mShapeBoundsHits;
+    private long mShapeBoundsMisses;
+
+    private const int WriteBufferSize = 1 << 20;
+    // UTF-8 without a byte order mark: Encoding.UTF8 writes one, which
+    // Python's json module rejects
+    private static readonly System.Text.Encoding TraceEncoding = new System.Text.UTF8Encoding(false);
+    private int mMaxQueueDepth;
     private JSON mJSON; // Stores JSON formatted output event stream
+    private AsyncJSONWriter mWriter; // Writes events to mJSON
+
+    private static readonly TimeSpan SegmentCheckInterval = TimeSpan.FromSeconds(1);
+    private TimeSpan mSegmentDuration; // Zero if not splitting by time
+    private long mSegmentBytes; // Zero if not splitting by size
+    private int mSegmentIndex;
+    private string mSegmentFilename; // Current segment, as of the latest event queued
+    private DateTime mSegmentStart;
+    private DateTime mLastSegmentCheck;
 } // class RawPacketTracer
 
 } // namespace SLTrace
\ No newline at end of file
@@ -31,19 +31,67 @@
  */
 
 using System;
+using System.Collections.Generic;
+using System.IO;
+using System.Text;
 using OpenMetaverse;
 using OpenMetaverse.Packets;
 
 namespace SLTrace {
 
-/** Records a raw packet trace. */
+/** Records a raw packet trace as a compact binary capture, which can be
+ *  analyzed with scripts/packet_trace.py.  All values are little endian:
+ *
+ *  header: "SLPK", uint16 version, byte flags, int64 start time (unix
+ *          microseconds)
+ *  records, each starting with a byte record type:
+ *    sim definition: uint16 sim index, uint16 name length, UTF-8 name
+ *    type definition: uint16 type index, uint16 name length, UTF-8 name
+ *    packet: uint16 sim index, uint16 type index, int64 microseconds since
+ *            start, uint32 packet length, packet bytes
+ *
+ *  Sims and packet types are assigned indices the first time they're seen,
+ *  and are defined before any packet refers to them.  With --no-payload the
+ *  packet bytes are omitted (flags bit 0 is clear) but their length is still
+ *  recorded, for much smaller captures when only traffic volume matters.
+ */
 class RawPacketTracer : ITracer {
+    public const ushort FormatVersion = 1;
+    public const byte FlagPayload = 0x01;
+
+    private const byte SimRecord = 1;
+    private const byte TypeRecord = 2;
+    private const byte PacketRecord = 3;
+
     public RawPacketTracer(string args_string) {
+        mTraceFilename = "packets.slpk";
+        mPayload = true;
+
+        string[] split_args = Arguments.Split(args_string);
+        Dictionary<string, string> arg_map = Arguments.Parse(split_args);
+
+        if (arg_map.ContainsKey("o"))
+           mTraceFilename = arg_map["o"];
+        if (arg_map.ContainsKey("out"))
+           mTraceFilename = arg_map["out"];
+        if (arg_map.ContainsKey("no-payload"))
+           mPayload = false;
     }
 
     public void StartTrace(TraceSession parent) {
         mParent = parent;
 
+        mSims = new Dictionary<Simulator, ushort>();
+        mTypes = new Dictionary<PacketType, ushort>();
+
+        mStartTime = DateTime.Now;
+        Stream stream = new FileStream(mTraceFilename, FileMode.Create, FileAccess.Write, FileShare.Read, WriteBufferSize);
+        mWriter = new BinaryWriter(stream);
+        mWriter.Write(Encoding.ASCII.GetBytes("SLPK"));
+        mWriter.Write(FormatVersion);
+        mWriter.Write(mPayload ? FlagPayload : (byte)0);
+        mWriter.Write((mStartTime.ToUniversalTime() - UnixEpoch).Ticks / TicksPerMicrosecond);
+
         mParent.Client.Network.RegisterCallback(
             PacketType.Default,
             new NetworkManager.PacketCallback(this.PacketHandler)
@@ -51,14 +99,64 @@ class RawPacketTracer : ITracer {
     }
 
     public void StopTrace() {
-        // No need to unregister
+        // No need to unregister, but packets may still arrive
+        lock(this) {
+            mWriter.Close();
+            mWriter = null;
+        }
     }
 
     private void PacketHandler(Packet packet, Simulator sim) {
-        Console.WriteLine("Packet: " + packet.ToString());
+        long time_us = (DateTime.Now - mStartTime).Ticks / TicksPerMicrosecond;
+        byte[] data = packet.ToBytes();
+
+        lock(this) {
+            if (mWriter == null)
+                return;
+
+            ushort sim_idx;
+            if (!mSims.TryGetValue(sim, out sim_idx)) {
+                sim_idx = (ushort)mSims.Count;
+                mSims[sim] = sim_idx;
+                WriteDefinition(SimRecord, sim_idx, sim.Name);
+            }
+            ushort type_idx;
+            if (!mTypes.TryGetValue(packet.Type, out type_idx)) {
+                type_idx = (ushort)mTypes.Count;
+                mTypes[packet.Type] = type_idx;
+                WriteDefinition(TypeRecord, type_idx, packet.Type.ToString());
+            }
+
+            mWriter.Write(PacketRecord);
+            mWriter.Write(sim_idx);
+            mWriter.Write(type_idx);
+            mWriter.Write(time_us);
+            mWriter.Write((uint)data.Length);
+            if (mPayload)
+                mWriter.Write(data);
+        }
     }
 
+    private void WriteDefinition(byte record_type, ushort idx, string name) {
+        byte[] encoded = Encoding.UTF8.GetBytes(name ?? "");
+        mWriter.Write(record_type);
+        mWriter.Write(idx);
+        mWriter.Write((ushort)encoded.Length);
+        mWriter.Write(encoded);
+    }
+
+    private static readonly DateTime UnixEpoch = new DateTime(1970, 1, 1, 0, 0, 0, DateTimeKind.Utc);
+    private const long TicksPerMicrosecond = TimeSpan.TicksPerMillisecond / 1000;
+    private const int WriteBufferSize = 1 << 20;
+
     private TraceSession mParent;
+    private string mTraceFilename;
+    private bool mPayload; // Whether packet bytes are recorded
+    private DateTime mStartTime;
+    private BinaryWriter mWriter;
+    private Dictionary<Simulator, ushort> mSims; // Indices of sims seen so far
+    private Dictionary<PacketType, ushort> mTypes; // Indices of packet types
+                                                   // seen so far
 } // class RawPacketTracer
 
 } // namespace SLTrace
\ No newline at end of file
@@ -0,0 +1,202 @@
+/*  SLTrace
+ *  AsyncJSONWriter.cs
+ *
+ *  Copyright (c) 2010, Ewen Cheslack-Postava
+ *  All rights reserved.
+ *
+ *  Redistribution and use in source and binary forms, with or without
+ *  modification, are permitted provided that the following conditions are
+ *  met:
+ *  * Redistributions of source code must retain the above copyright
+ *    notice, this list of conditions and the following disclaimer.
+ *  * Redistributions in binary form must reproduce the above copyright
+ *    notice, this list of conditions and the following disclaimer in
+ *    the documentation and/or other materials provided with the
+ *    distribution.
+ *  * Neither the name of SLTrace nor the names of its contributors may
+ *    be used to endorse or promote products derived from this software
+ *    without specific prior written permission.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS
+ * IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+ * TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+ * PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER
+ * OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ * EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ * PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ * PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ * LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ * NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ * SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+ */
+
+using System;
+using System.Collections.Generic;
+using System.Threading;
+
+namespace SLTrace {
+
+/** Writes events to a JSON stream on a dedicated writer thread.  Producers,
+ *  e.g. tracer callbacks running on libomv's network threads, enqueue an
+ *  Action which writes one event and return immediately; the writer thread
+ *  runs queued actions in batches, so formatting and IO never happen on the
+ *  producer's thread.  Actions should capture all the values they write,
+ *  including timestamps, when they are enqueued, since they run later.
+ *
+ *  The queue is bounded: if the writer falls too far behind, new events are
+ *  dropped and counted rather than growing memory without limit.
+ */
+class AsyncJSONWriter {
+    public const int DefaultMaxQueueDepth = 1 << 20;
+
+    public AsyncJSONWriter(JSON json)
+        : this(json, DefaultMaxQueueDepth)
+    {
+    }
+
+    public AsyncJSONWriter(JSON json, int max_queue_depth) {
+        mJSON = json;
+        mMaxQueueDepth = max_queue_depth;
+        mPending = new List<Action>();
+        mWriting = new List<Action>();
+        mFlushInterval = TimeSpan.FromSeconds(1);
+
+        mThread = new Thread(this.Run);
+        mThread.Name = "AsyncJSONWriter";
+        mThread.IsBackground = true;
+    }
+
+    public void Start() {
+        mThread.Start();
+    }
+
+    /** Queues an action to be run on the writer thread.  Returns false if the
+     *  event was dropped because the queue was full or the writer stopped.
+     */
+    public bool Enqueue(Action write) {
+        lock(mLock) {
+            if (mStopping || mPending.Count >= mMaxQueueDepth) {
+                mDropped++;
+                return false;
+            }
+
+            mPending.Add(write);
+            mEnqueued++;
+            if (mPending.Count > mMaxObservedDepth)
+                mMaxObservedDepth = mPending.Count;
+            // The writer only waits when the queue is empty
+            if (mPending.Count == 1)
+                Monitor.Pulse(mLock);
+        }
+        return true;
+    }
+
+    /** Stops the writer thread after all queued events have been written,
+     *  then runs last, if it isn't null, on the calling thread.  Since the
+     *  counters are final by then, last can record them in the stream.
+     */
+    public void Stop(Action last) {
+        lock(mLock) {
+            mStopping = true;
+            Monitor.Pulse(mLock);
+        }
+        mThread.Join();
+
+        if (last != null)
+            last();
+        mJSON.Flush();
+    }
+
+    private void Run() {
+        bool dirty = false;
+        while(true) {
+            bool stopping;
+            bool flush = false;
+            lock(mLock) {
+                if (mPending.Count == 0 && !mStopping) {
+                    // Flush if we've been idle for a while, so the file stays
+                    // reasonably up to date without flushing every batch
+                    if (Monitor.Wait(mLock, mFlushInterval) || !dirty)
+                        continue;
+                    flush = true;
+                    stopping = false;
+                }
+                else {
+                    // Swap buffers so producers can keep enqueuing while we write
+                    List<Action> tmp = mWriting;
+                    mWriting = mPending;
+                    mPending = tmp;
+                    stopping = mStopping;
+                }
+            }
+
+            // Like writes, flushes happen outside the lock so producers are
+            // never blocked on IO
+            if (flush) {
+                mJSON.Flush();
+                dirty = false;
+                continue;
+            }
+
+            foreach(Action write in mWriting)
+                write();
+            lock(mLock) {
+                mWritten += mWriting.Count;
+            }
+            mWriting.Clear();
+            dirty = true;
+
+            // Nothing can be enqueued after stopping, so this batch was the last
+            if (stopping)
+                break;
+        }
+    }
+
+    /** The stream being written to.  Actions which switch to a new stream,
+     *  e.g. to start a new file, must set this so it is flushed, and may only
+     *  do so from the writer thread.
+     */
+    public JSON Output {
+        get { return mJSON; }
+        set { mJSON = value; }
+    }
+
+    /** Number of events waiting to be written. */
+    public int QueueDepth {
+        get { lock(mLock) { return mPending.Count; } }
+    }
+
+    /** Largest number of events that have been waiting at once. */
+    public int MaxQueueDepth {
+        get { lock(mLock) { return mMaxObservedDepth; } }
+    }
+
+    public long Enqueued {
+        get { lock(mLock) { return mEnqueued; } }
+    }
+
+    public long Written {
+        get { lock(mLock) { return mWritten; } }
+    }
+
+    /** Number of events dropped because the queue was full. */
+    public long Dropped {
+        get { lock(mLock) { return mDropped; } }
+    }
+
+    private JSON mJSON; // Only used by the writer thread until it stops
+    private Thread mThread;
+    private TimeSpan mFlushInterval;
+    private int mMaxQueueDepth;
+
+    private object mLock = new object(); // Protects everything below
+    private List<Action> mPending; // Events waiting to be written
+    private List<Action> mWriting; // Batch being written, owned by the writer
+    private bool mStopping;
+    private int mMaxObservedDepth;
+    private long mEnqueued;
+    private long mWritten;
+    private long mDropped;
+} // class AsyncJSONWriter
+
+} // namespace SLTrace
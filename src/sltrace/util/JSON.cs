@@ -171,6 +171,10 @@ class JSON {
         mWriter = null;
     }
 
+    public void Flush() {
+        mWriter.Flush();
+    }
+
     public void BeginObject() {
         BeginObject(false);
     }